@@ -0,0 +1,159 @@
+'''Library Garbage Collection Benchmark.
+Builds a synthetic library and measures how long the garbage collector
+pauses the program while it is loaded. Two layouts are compared:
+   loaded - the library as it is: every node refers to its container, so
+            the tree is full of reference cycles
+   frozen - the same, after library.freeze_objects()
+usage info: python benchmark_gc.py --help
+'''
+import argparse
+import gc
+import statistics
+import time
+import library as l
+
+MODES = ["loaded", "frozen"]
+
+
+def build_library(books, books_per_shelf=50, shelves_per_case=10,
+                  cases_per_room=20):
+    '''Returns (Library) - A library holding the given number of books.'''
+    library = l.Library("Benchmark")
+    shelf = None
+    for i in range(books):
+        if i % books_per_shelf == 0:
+            shelf_number = i // books_per_shelf
+            if shelf_number % (shelves_per_case * cases_per_room) == 0:
+                room = l.Room("Room {}".format(len(library.children) + 1))
+                library.add_room(room)
+            if shelf_number % shelves_per_case == 0:
+                case = l.Case("Case {}".format(len(room.children) + 1))
+                room.add_case(case)
+            shelf = l.Shelf("Shelf {}".format(len(case.children) + 1),
+                            books_per_shelf)
+            case.add_shelf(shelf)
+        book = l.Book("Title {}".format(i), "Author {}".format(i % 5000),
+                      100 + i % 900, "Genre {}".format(i % 20))
+        book.is_on_shelf = True
+        shelf.add_child(book)
+    return library
+
+
+def time_full_collections(repeat):
+    '''Returns (list<float>) - Seconds taken by repeat full collections.'''
+    times = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        gc.collect()
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def time_workload(library, rounds):
+    '''Run a workload allocating many short lived objects, as searches
+    and menus do, and record every automatic collection.
+
+    Returns (dict) - Seconds of work, and the number, total and longest
+                     pauses of collections of the oldest generation.
+    '''
+    pauses = []
+    started_at = []
+
+    def on_collect(phase, info):
+        if info["generation"] != 2:
+            return
+        if phase == "start":
+            started_at.append(time.perf_counter())
+        else:
+            pauses.append(time.perf_counter() - started_at.pop())
+
+    gc.callbacks.append(on_collect)
+    started = time.perf_counter()
+    try:
+        for i in range(rounds):
+            # Lists of dicts per book, e.g. search hits, kept for a while.
+            hits = [{"title": book.title, "location": [book.author]}
+                    for book in library.get_all_books()]
+            del hits
+    finally:
+        gc.callbacks.remove(on_collect)
+    return {"seconds": time.perf_counter() - started,
+            "collections": len(pauses),
+            "pause_total": sum(pauses),
+            "pause_max": max(pauses, default=0)}
+
+
+def time_release(library_holder):
+    '''Drop the library and time until its memory is given back.
+
+    Returns (float, int) - Seconds taken, and the number of objects the
+                           collector had to find in reference cycles.
+    '''
+    started = time.perf_counter()
+    library_holder.clear()
+    collected = gc.collect()
+    return time.perf_counter() - started, collected
+
+
+def run_mode(mode, books, repeat, rounds):
+    '''Returns (dict) - Measurements of one layout, see MODES.'''
+    gc.collect()
+    started = time.perf_counter()
+    library = build_library(books)
+    built = time.perf_counter() - started
+    if mode == "frozen":
+        l.freeze_objects()
+    full = time_full_collections(repeat)
+    workload = time_workload(library, rounds)
+    if mode == "frozen":
+        l.unfreeze_objects()
+    holder = {"library": library}
+    del library
+    released, collected = time_release(holder)
+    return dict(workload, mode=mode, build=built,
+                full_median=statistics.median(full), full_max=max(full),
+                release=released, cycles_collected=collected)
+
+
+def print_results(results):
+    print("{:8} {:>9} {:>12} {:>12} {:>6} {:>12} {:>12} {:>10} {:>10}".format(
+        "layout", "build s", "full gc ms", "max ms", "gc2", "pauses ms",
+        "max pause", "free s", "in cycles"))
+    for r in results:
+        print("{:8} {:9.2f} {:12.1f} {:12.1f} {:6} {:12.1f} {:12.1f} "
+              "{:10.3f} {:10}".format(
+                  r["mode"], r["build"], r["full_median"] * 1000,
+                  r["full_max"] * 1000, r["collections"],
+                  r["pause_total"] * 1000, r["pause_max"] * 1000,
+                  r["release"], r["cycles_collected"]))
+
+
+def parse_command_line():
+    '''Parse command line arguments.
+
+    Return (dict) - Parsed command line arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description='Measure garbage collector pauses on a synthetic '
+                    'library.')
+    parser.add_argument('--books', dest='books', type=int, default=500000,
+                        help='Number of books in the library (default: '
+                             '500000)')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help='Number of full collections timed (default: 5)')
+    parser.add_argument('--rounds', dest='rounds', type=int, default=5,
+                        help='Rounds of the allocating workload (default: 5)')
+    parser.add_argument('--mode', dest='modes', action='append',
+                        choices=MODES, default=None,
+                        help='Layout to measure, may be repeated (default: '
+                             'all)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_command_line()
+    results = []
+    for mode in args.modes or MODES:
+        print("Measuring {} layout with {} books...".format(mode, args.books))
+        results.append(run_mode(mode, args.books, args.repeat, args.rounds))
+    print_results(results)
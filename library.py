@@ -3,7 +3,129 @@ Contains classes related to the management of a small home library.
 Author: Shawn Kessler
 Project 1 for INFO W18: PYTHON BRIDGE 2
 '''
+import contextlib
+import hashlib
 import json
+import gc
+import os
+import pickle
+import tempfile
+from library_render import render_lines
+from library_stats import STATS
+
+# Binary snapshots of a library are kept next to its json file with this
+# suffix. Bump SNAPSHOT_VERSION whenever the library classes change in a
+# way that makes old pickles unusable; stale snapshots are then rebuilt.
+SNAPSHOT_SUFFIX = ".snapshot"
+SNAPSHOT_VERSION = 9
+# Byte offset index of the rooms in a library json file, used to load
+# rooms lazily. Written next to the json file by Library.save_to_file.
+ROOM_INDEX_SUFFIX = ".index"
+ROOM_INDEX_VERSION = 1
+# Name of the manifest in a library saved with one file per room by
+# Library.save_to_directory.
+MANIFEST_FILE_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+def get_int(string, upper_boundary=None, min=0):
+    '''Get integer object based on the passed in string and boundaries
+
+    Return (int): Integer representation or None if string
+                  could not be converted to integer.
+
+    Args:
+       string - The string to convert to an integer
+       upper_boundary - return None if the converted string is
+                        not less than this value
+       min - return None if the converted string is less than this
+             value.
+    '''
+    if string.isdigit():
+        integer = int(string)
+        is_valid = ((upper_boundary is None or integer < upper_boundary) and
+                    integer >= min)
+        if is_valid:
+            return integer
+        else:
+            return None
+    else:
+        return None
+
+
+def get_insert_index(container, position):
+    '''Returns (int) - Index a child added to container with add_child
+                       ended up at.'''
+    if position is None:
+        return len(container.children) - 1
+    return min(position, len(container.children) - 1)
+
+
+# While keep_changed_flags is running, the flag and cached hash of each
+# node mark_changed changes, from before the first change, by node id.
+kept_flags = None
+
+
+def mark_changed(node):
+    '''Flag node and every container above it as changed and forget their
+    cached content hashes. Stops at the first node that is already flagged
+    and has no cached hash, since the containers above it are the same.
+    '''
+    while node is not None and (not node._dirty or
+                                node._content_hash is not None):
+        if kept_flags is not None and id(node) not in kept_flags:
+            kept_flags[id(node)] = (node, node._dirty, node._content_hash)
+        node._dirty = True
+        node._content_hash = None
+        node = getattr(node, "contained_in", None)
+
+
+def freeze_objects():
+    '''Move every object in the process that exists now out of the garbage
+    collector's reach (see gc.freeze), so later collections no longer walk
+    a loaded library. Call it after loading a library that is kept for
+    the life of the program.
+
+    This is not limited to one library: every other library and every
+    other object alive at the time is frozen too. Frozen objects in
+    reference cycles, such as a library's tree, are never freed until
+    unfreeze_objects is called.
+    '''
+    gc.collect()
+    gc.freeze()
+
+
+def unfreeze_objects():
+    '''Give every frozen object back to the garbage collector, e.g. before
+    dropping a library that freeze_objects was called for.'''
+    gc.unfreeze()
+
+
+@contextlib.contextmanager
+def keep_changed_flags():
+    '''Put back the changed flags and cached content hashes of the nodes
+    changed inside a with block. Only for changes that are undone before
+    the block ends, such as previews, so the library is not saved again
+    and hashes are not recomputed for nothing.
+    '''
+    global kept_flags
+    outer = kept_flags
+    kept_flags = dict()
+    try:
+        yield
+    finally:
+        for node, dirty, content_hash in kept_flags.values():
+            node._dirty = dirty
+            node._content_hash = content_hash
+        kept_flags = outer
+
+
+def find_library(node):
+    '''Returns (Library) - The Library at the top of node's containers,
+                          or None if node is not in a library.'''
+    while node is not None and not isinstance(node, Library):
+        node = getattr(node, "contained_in", None)
+    return node
 
 
 class Containable:
@@ -13,6 +135,23 @@ class Containable:
     def __init__(self):
         super().__init__()
         self.contained_in = None
+        self._dirty = True
+        self._content_hash = None
+
+    def mark_changed(self):
+        '''Flag this object and everything containing it as changed
+        since the library was last saved.'''
+        mark_changed(self)
+
+    def is_changed(self):
+        return self._dirty
+
+    def mark_saved(self):
+        self._dirty = False
+
+    def get_library(self):
+        '''Returns (Library) - The library this object is in, if any.'''
+        return find_library(self.contained_in)
 
     def get_full_location(self):
         '''Get a list representation of where this object is'''
@@ -21,16 +160,25 @@ class Containable:
         else:
             return [self]
 
+    def get_full_location_lines(self):
+        '''Returns (list<str>) - The lines of print_full_location.'''
+        return ["--" * i + str(location)
+                for i, location in enumerate(self.get_full_location())]
+
     def print_full_location(self):
         '''Short printout of where this object is.'''
-        full_location = self.get_full_location()
-        for i, location in enumerate(full_location):
-            print("--" * i + str(location))
+        render_lines(self.get_full_location_lines())
 
     def print_human_readable_full_location(self):
         '''Printout of where this object is, written in complete sentences.'''
+        render_lines([self.get_human_readable_full_location()])
+
+    def get_human_readable_full_location(self):
+        '''Returns (str) - Where this object is, written in complete
+                           sentences.'''
         full_location = self.get_full_location()[::-1]
         frag = ""
+        sentences = []
         for i, item in enumerate(full_location):
             container = None
             if isinstance(item, Containable):
@@ -40,16 +188,21 @@ class Containable:
                 prep = container.containment_preposition
                 if i == 0:
                     if isinstance(item, Book):
-                        index = container.children.index(item)
+                        # Copies of a book are equal, so find this one
+                        # by identity rather than with list.index.
+                        index = next(i for i, child
+                                     in enumerate(container.children)
+                                     if child is item)
                         frag = '"{0}" is {1} book(s) from the left {2}'
                         frag = frag.format(item.title, index, prep)
                     else:
                         frag += "{0} is {1}".format(item.label, prep)
                 elif container:
                     frag = "{0}. {0} is {1}".format(item.label, prep)
-                print(frag, end=" ")
+                sentences.append(frag)
             else:
-                print(item.label + ".")
+                sentences.append(item.label + ".")
+        return " ".join(sentences)
 
 
 class Container:
@@ -61,6 +214,43 @@ class Container:
         self.label = label
         self.children = []
         self.containment_preposition = "in"
+        self._dirty = True
+        self._content_hash = None
+
+    def mark_changed(self):
+        '''Flag this object and everything containing it as changed
+        since the library was last saved.'''
+        mark_changed(self)
+
+    def is_changed(self):
+        return self._dirty
+
+    def get_content_hash(self):
+        '''Hash over this container and everything in it. The hash is
+        cached until something beneath this container changes, so after a
+        change only the containers above it are hashed again.
+
+        Returns (str) - hex digest
+        '''
+        if self._content_hash is None:
+            hasher = hashlib.sha1(json.dumps(self.get_hash_fields()).encode())
+            for child in self.children:
+                hasher.update(child.get_content_hash().encode())
+            self._content_hash = hasher.hexdigest()
+        return self._content_hash
+
+    def get_hash_fields(self):
+        '''Returns (list) - The fields of this container, apart from its
+                            children, that its content hash covers.'''
+        return [type(self).__name__, self.label]
+
+    def mark_saved(self):
+        '''Clear the changed flag of this object and its changed
+        descendents.'''
+        self._dirty = False
+        for child in self.children:
+            if child.is_changed():
+                child.mark_saved()
 
     def add_child(self, child, position=None):
         '''Add a child object to be contained in this obect
@@ -74,6 +264,14 @@ class Container:
         else:
             self.children.append(child)
         child.contained_in = self
+        self.mark_changed()
+
+        if isinstance(child, Container):
+            library = find_library(self)
+            if library is not None:
+                library.emit("add_container", parent=self,
+                             position=get_insert_index(self, position),
+                             container=child)
 
     def get_leaf_nodes(self):
         '''Get all leaf nodes as a single list.'''
@@ -103,19 +301,33 @@ class Container:
         layout.append(children_layout)
         return layout
 
-    def describe(self, include_leaves=True, indent=0):
+    def describe(self, include_leaves=True, indent=0, max_depth=None):
         '''Print a description of self and descendents.
 
         Args:
             include_leaves: If true include the leaf nodes
             indent: How far to indent the current printed line
+            max_depth: If given, leave out anything more than this many
+                       levels below self.
         '''
-        print("  "*indent, self)
-        for child in self.children:
-            if isinstance(child, Container):
-                child.describe(include_leaves, indent+1)
-            elif include_leaves:
-                print("  "*(indent+1), child)
+        render_lines(self.iter_describe(include_leaves, indent, max_depth))
+
+    def iter_describe(self, include_leaves=True, indent=0, max_depth=None):
+        '''Generate the lines printed by describe, one per object. Uses a
+        stack rather than recursion, so deep trees are fine.
+
+        Yields (str) - Each line, without a new line.
+        '''
+        stack = [(self, indent)]
+        while stack:
+            node, level = stack.pop()
+            yield "  " * level + " " + str(node)
+            if (not isinstance(node, Container) or
+                    (max_depth is not None and level - indent >= max_depth)):
+                continue
+            for child in reversed(node.children):
+                if include_leaves or isinstance(child, Container):
+                    stack.append((child, level + 1))
 
     def __repr__(self):
         return(type(self).__name__ + ": " + self.label)
@@ -133,20 +345,26 @@ class Book(Containable):
     3. Shelves also have a width and that width is of the same unit type as the
     book width. So a shelf might have a width of 50 which means it can hold
     fifty standard sized books.
+
+    Copies of the same book are equal and hash alike: a book is identified
+    by its title, author and (optional) edition.
     '''
-    def __init__(self, title, author, pages, genre, width=1):
+    def __init__(self, title, author, pages, genre, width=1, edition=None):
         super().__init__()
         self.pages = pages
         self.width = width
         self.author = author
         self.title = title
         self.genre = genre
+        self.edition = edition
         self.is_on_shelf = False
         self.lent_to = None
 
     def get_full_details(self):
         details = "  Title: {}\n".format(self.title)
         details += "  Author: {}\n".format(self.author)
+        if self.edition is not None:
+            details += "  Edition: {}\n".format(self.edition)
         details += "  Pages: {}\n".format(self.pages)
         details += "  Genre: {}\n".format(self.genre)
         details += "  Width: {}\n".format(self.width)
@@ -169,16 +387,53 @@ class Book(Containable):
         else:
             self.lent_to = person
             self.is_on_shelf = False
+            self.mark_changed()
+            self.emit("lend", borrower=person)
             return True
 
     def return_from_borrower(self):
         self.lent_to = None
         self.is_on_shelf = True
+        self.mark_changed()
+        self.emit("return")
+
+    def set_on_shelf(self, is_on_shelf):
+        '''Mark a book as being on or off its shelf.'''
+        self.is_on_shelf = is_on_shelf
+        self.mark_changed()
+        self.emit("shelve", is_on_shelf=is_on_shelf)
+
+    def emit(self, op, **fields):
+        '''Send a change event about this book to its library's listeners.'''
+        library = self.get_library()
+        if library is not None:
+            library.emit(op, book=self, **fields)
+
+    def get_content_hash(self):
+        '''Returns (str) - hex digest over all of the book's details.'''
+        if self._content_hash is None:
+            lent_to = self.lent_to.name if self.lent_to else None
+            fields = [type(self).__name__, self.title, self.author,
+                      self.pages, self.genre, self.width, self.is_on_shelf,
+                      lent_to]
+            if self.edition is not None:
+                fields.append(self.edition)
+            self._content_hash = hashlib.sha1(
+                json.dumps(fields).encode()).hexdigest()
+        return self._content_hash
+
+    def get_identity(self):
+        '''Returns (tuple) - What makes copies of this book the same book.'''
+        return (self.title, self.author, self.edition)
 
     def __eq__(self, other):
-        '''Books are equal if they have same Author and Title.'''
-        return (self.author == other.author and
-                self.title == other.title)
+        '''Books are equal if they have same Author, Title and Edition.'''
+        if not isinstance(other, Book):
+            return NotImplemented
+        return self.get_identity() == other.get_identity()
+
+    def __hash__(self):
+        return hash(self.get_identity())
 
     def __gt__(self, other):
         '''Books are sorted by Author then Title'''
@@ -213,6 +468,9 @@ class Shelf(Container, Containable):
     def get_books(self):
         return self.children
 
+    def get_hash_fields(self):
+        return super().get_hash_fields() + [self.width]
+
     def add_book(self, book, position=None):
         '''Add a book to the shelf. If adding the book forces
         books off the end of the shelf then remove them from this shelf.
@@ -225,12 +483,33 @@ class Shelf(Container, Containable):
             book - The Book to add
             position - Where to add the book on the shelf.
         '''
+        moved_from = book.contained_in
         self.add_child(book, position)
-        book.is_on_shelf = True
+        if not book.is_on_shelf:
+            # is_on_shelf is part of the book's content hash.
+            book.is_on_shelf = True
+            book.mark_changed()
+
+        library = find_library(self)
+        if library is not None:
+            index = get_insert_index(self, position)
+            if moved_from is None:
+                library.emit("place_book", shelf=self, position=index,
+                             book=book)
+            else:
+                library.emit("move_book", shelf=self, position=index,
+                             book=book, moved_from=moved_from)
 
         books_forced_off_end = []
         while self.get_remaining_space() < 0:
             books_forced_off_end.insert(0, self.children.pop())
+            self.mark_changed()
+            if library is not None:
+                library.emit("displace_book", shelf=self,
+                             book=books_forced_off_end[0])
+        if STATS.enabled:
+            STATS.observe("shelf.add_book.books_forced_off_end",
+                          len(books_forced_off_end))
         return books_forced_off_end
 
     def get_book_ends(self):
@@ -289,6 +568,8 @@ class Shelf(Container, Containable):
 
     def get_remaining_space(self):
         '''Returns how much space is left on the shelf for more books'''
+        if STATS.enabled:
+            STATS.increment("shelf.get_remaining_space")
         return self.width - self.get_books_width()
 
     def __repr__(self):
@@ -320,22 +601,210 @@ class Room(Container, Containable):
     def __init__(self, label):
         super().__init__(label)
 
+    def __getattr__(self, name):
+        '''Rooms of a lazily loaded library have no children attribute
+        until something asks for them; load the contents at that point.
+        '''
+        if name == "children" and "_saved_at" in self.__dict__:
+            self.load_contents()
+            return self.__dict__["children"]
+        raise AttributeError(name)
+
     def add_case(self, case, position=None):
         self.add_child(case, position)
 
     def get_cases(self):
         return self.children
 
+    def is_loaded(self):
+        '''Return True unless this room's contents are still on disk.'''
+        return "children" in self.__dict__
+
+    def set_source(self, source, summary, content_hash=None):
+        '''Leave this room's contents on disk until first accessed.
+
+        Args:
+           source: dict with the "file_name", "offset" and "length" of the
+                   room's json, and the "mtime_ns" and "size" of the file.
+           summary: dict of counts returned by get_summary().
+           content_hash: The room's saved content hash, if known, so it
+                         can be compared without loading the room.
+        '''
+        self.__dict__.pop("children", None)
+        self.set_saved_at(source, summary, content_hash)
+
+    def set_saved_at(self, source, summary, content_hash=None):
+        '''Record where the unchanged json of this room can be found.
+
+        Args:
+           source: Same as for set_source.
+           summary: dict of counts returned by get_summary().
+           content_hash: Same as for set_source.
+        '''
+        self._saved_at = source
+        self._summary = summary
+        self._dirty = False
+        if content_hash is not None:
+            self._content_hash = content_hash
+
+    def has_saved_copy(self):
+        '''Return True if this room is unchanged since it was last
+        written to, or read from, a location that is still current.'''
+        return "_saved_at" in self.__dict__ and not self.is_changed()
+
+    def read_saved(self):
+        '''Returns (bytes) - The json this room was last saved as.'''
+        source = self._saved_at
+        stat = os.stat(source["file_name"])
+        if (stat.st_mtime_ns != source["mtime_ns"] or
+                stat.st_size != source["size"]):
+            raise OSError("{} changed on disk after {} was loaded".format(
+                source["file_name"], self.label))
+        with open(source["file_name"], "rb") as f:
+            f.seek(source["offset"])
+            return f.read(source["length"])
+
+    def load_contents(self):
+        '''Read this room's cases, shelves and books from disk.'''
+        started = STATS.start() if STATS.enabled else None
+        json_data = self.read_saved()
+        room = LibraryJSONDecoder().decode_object(json.loads(json_data),
+                                                  self.get_library())
+        self.children = room.children
+        for case in self.children:
+            case.contained_in = self
+        self.mark_saved()
+        if started is not None:
+            STATS.finish("room.load_contents", started,
+                         bytes_read=len(json_data))
+
+    def encode_json(self):
+        '''Returns (bytes) - This room as json, indented to sit inside the
+        library's list of rooms. Unchanged rooms are copied from disk.
+        '''
+        if self.has_saved_copy():
+            return self.read_saved()
+        text = json.dumps(self, cls=LibraryJSONEncoder, indent=2)
+        return ("    " + text.replace("\n", "\n    ")).encode()
+
+    def get_summary(self):
+        '''Counts describing this room. Cheap for unloaded rooms, which
+        keep the summary saved in the room index.
+
+        Returns (dict) - Number of "cases", "shelves", "books" and the
+                         "free_space" left on its shelves.
+        '''
+        if self.has_saved_copy():
+            return self._summary
+        summary = {"cases": 0, "shelves": 0, "books": 0, "free_space": 0}
+        for case in self.children:
+            summary["cases"] += 1
+            for shelf in case.get_shelves():
+                summary["shelves"] += 1
+                summary["books"] += len(shelf.get_books())
+                summary["free_space"] += shelf.get_remaining_space()
+        return summary
+
+    def describe_summary(self, indent=0):
+        '''Print a one line description of this room without loading it.'''
+        render_lines([self.get_summary_line(indent)])
+
+    def get_summary_line(self, indent=0):
+        '''Returns (str) - The line printed by describe_summary.'''
+        summary = self.get_summary()
+        return "  " * indent + " {} ({} cases, {} shelves, {} books, {} " \
+            "spaces available)".format(self, summary["cases"],
+                                       summary["shelves"], summary["books"],
+                                       summary["free_space"])
+
 
 class Library(Container):
     '''Class representing a library. It can contain rooms.'''
     def __init__(self, label):
         super().__init__(label)
         self.borrowers = dict()
+        self._listeners = []
+        self._sequence = 0
+        self._copy_index = None
+        self._facets = None
+        self._history = None
+        # Indexes of library_search and library_query.
+        self._search_index = None
+        self._autocomplete_index = None
+        self._query_index = None
+
+    def __getstate__(self):
+        # Listeners hold open files and sockets; they are not part of
+        # the library's state. The indexes and undo history listen for
+        # changes so they are started again when next needed.
+        state = self.__dict__.copy()
+        state["_listeners"] = []
+        for name in ("_copy_index", "_facets", "_history", "_search_index",
+                     "_autocomplete_index", "_query_index"):
+            state[name] = None
+        return state
 
     def get_full_location(self):
         return [self]
 
+    def add_borrower(self, person):
+        '''Add a Person who can borrow books from this library.'''
+        self.borrowers[person.name] = person
+        self.emit("add_borrower", person=person)
+
+    def add_listener(self, listener):
+        '''Register a function called with every change event.
+
+        Each event is a dict with an increasing "seq" number, an "op" and
+        op specific fields referring to the objects involved:
+           add_container - parent, position, container
+           place_book - shelf, position, book
+           move_book - shelf, position, book, moved_from (a book forced
+                       off the end of moved_from earlier in a cascade)
+           displace_book - shelf, book (forced off the end of shelf)
+           lend - book, borrower
+           return - book
+           shelve - book, is_on_shelf
+           add_borrower - person
+           snapshot - library (anything may have changed, for example
+                      after an undo, so start over from the whole library)
+        Listeners are called right after the change, while the library
+        is in the state the event describes.
+        '''
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def set_listeners(self, listeners):
+        '''Replace every listener, e.g. to make changes the usual listeners
+        should not see.
+
+        Returns (list) - The listeners that were replaced.
+        '''
+        old_listeners = self._listeners
+        self._listeners = listeners
+        return old_listeners
+
+    def get_sequence(self):
+        '''Returns (int) - Sequence number of the last change event.'''
+        return self._sequence
+
+    def set_sequence(self, sequence):
+        '''Continue numbering change events after sequence.'''
+        self._sequence = sequence
+
+    def emit(self, op, **fields):
+        '''Number a change event and pass it to the listeners. Does
+        nothing when there are no listeners.'''
+        if not self._listeners:
+            return
+        self._sequence += 1
+        event = dict(fields, seq=self._sequence, op=op)
+        # Listeners may remove themselves, e.g. on "snapshot".
+        for listener in list(self._listeners):
+            listener(event)
+
     def add_room(self, room, position=None):
         self.add_child(room, position)
 
@@ -345,7 +814,54 @@ class Library(Container):
     def get_all_books(self):
         return self.get_leaf_nodes()
 
-    def add_book(self, book, shelf=None, position=None):
+    def get_copy_index(self):
+        '''Returns (CopyIndex) - Index of the copies of every book in the
+                                library, built the first time it is needed.
+        '''
+        if self._copy_index is None:
+            self._copy_index = CopyIndex(self)
+        return self._copy_index
+
+    def find_copies(self, book):
+        '''Returns (list<Book>) - Every copy of book in the library, which
+                                 includes book itself if it is shelved here.
+        '''
+        return self.get_copy_index().get_copies(book)
+
+    def count_copies(self, book):
+        '''Returns (int) - Number of copies of book in the library.'''
+        return len(self.get_copy_index().copies.get(book.get_identity(), []))
+
+    def get_facets(self):
+        '''Returns (FacetCounts) - Counts of books by genre, author, room
+                                  and status, built the first time they
+                                  are needed.
+        '''
+        if self._facets is None:
+            self._facets = FacetCounts(self)
+        return self._facets
+
+    def get_facet_counts(self, facet, **filters):
+        '''Count books by one of FACETS, e.g.
+        library.get_facet_counts("genre", room="Main Room")
+
+        Returns (dict<str, int>) - Number of books with each value of facet
+                                   among the books matching filters.
+        '''
+        return self.get_facets().get_counts(facet, filters)
+
+    def is_fully_loaded(self):
+        '''Return True if no room's contents are still waiting on disk.'''
+        return all(room.is_loaded() for room in self.children)
+
+    def describe_summary(self):
+        '''Print the rooms of this library with their summary counts.
+        Unlike describe this does not load lazily loaded rooms.
+        '''
+        render_lines([" " + str(self)] +
+                     [room.get_summary_line(1) for room in self.children])
+
+    def add_book(self, book, shelf=None, position=None, note_copies=True):
         '''Add a book to the library if there is room.
 
         Returns (shelf) - The Shelf the book was successfully
@@ -358,23 +874,39 @@ class Library(Container):
            position - Where the book should be added on the shelf. If
                       not specified the book will be added at the beginning
                       of the shelf.
+           note_copies - If True print a note when the library already had
+                         copies of the book. Callers that check for copies
+                         themselves pass False.
         '''
+        started = STATS.start() if STATS.enabled else None
         shelf = self.find_shelf_with_space(book, shelf)
         if position is None:
             position = 0
 
+        shelves_touched = 0
+        books_displaced = 0
         if shelf is None:
             print("No space remains in your Library. Add more Shelves.")
         else:
-            shelf_found = False
             books_to_add = [book]
-            for inner_shelf in self.get_all_shelves_flattened(shelf):
+            for inner_shelf in self.iter_shelves(shelf):
                 books_to_add = self.move_books_to_shelf(books_to_add,
                                                         inner_shelf,
                                                         position)
                 position = 0
+                shelves_touched += 1
+                books_displaced += len(books_to_add)
                 if not books_to_add:
-                    return shelf
+                    break
+            if note_copies and self.count_copies(book) > 1:
+                print('Note: the library now has {} copies of "{}".'.format(
+                    self.count_copies(book), book.title))
+
+        if started is not None:
+            STATS.finish("add_book", started,
+                         shelves_touched=shelves_touched,
+                         books_displaced=books_displaced,
+                         found_space=shelf is not None)
         return shelf
 
     def get_all_shelves_flattened(self, start_shelf=None):
@@ -386,15 +918,56 @@ class Library(Container):
            start_shelf: If included only include this shelf and
                         and shelves after it.
         '''
-        shelves = []
-        for room in self.get_rooms():
-            for case in room.get_cases():
-                for shelf in case.get_shelves():
-                    if start_shelf is None or start_shelf == shelf:
-                        shelves.append(shelf)
-                        start_shelf = None
+        return list(self.iter_shelves(start_shelf))
+
+    def iter_shelves(self, start_shelf=None):
+        '''Iterate over the shelves of this library in order, like
+        get_all_shelves_flattened. Starting from a shelf begins at that
+        shelf's case and room instead of walking past the shelves before
+        it.
+        '''
+        if start_shelf is None:
+            for room in self.get_rooms():
+                for case in room.get_cases():
+                    yield from case.get_shelves()
+            return
+        case = start_shelf.contained_in
+        room = case.contained_in if case is not None else None
+        if room is None or room.contained_in is not self:
+            return
+        # Containers compare by identity, so index finds the very one.
+        yield from case.get_shelves()[case.get_shelves().index(start_shelf):]
+        for later_case in room.get_cases()[room.get_cases().index(case) + 1:]:
+            yield from later_case.get_shelves()
+        for later_room in self.get_rooms()[self.get_rooms().index(room) + 1:]:
+            for later_case in later_room.get_cases():
+                yield from later_case.get_shelves()
+
+    def query(self, text):
+        '''Find books with a query such as
+        genre == "Fiction" and pages > 300 and not lent
+        See library_query for the query language.
+
+        Returns (list<Book>) - Matching books in shelf order.
+        Raises QueryError if the query can not be parsed.
+        '''
+        import library_query
+        return library_query.run_query(self, text)
+
+    def explain_query(self, text):
+        '''Returns (str) - The index and filters query(text) would use.'''
+        import library_query
+        return library_query.explain_query(self, text)
 
-        return shelves
+    def fuzzy_search(self, text, k=10):
+        '''Find books by title or author, tolerating typos.
+        See library_search.
+
+        Returns (list<(Book, float)>) - Up to k books with a similarity
+                                        score between 0 and 1, best first.
+        '''
+        import library_search
+        return library_search.fuzzy_search(self, text, k)
 
     def has_shelves(self):
         '''Return true if library has any shelves, False otherwise.'''
@@ -436,9 +1009,22 @@ class Library(Container):
            start_from_shelf - Only consider this shelf and those that
                               come after it.
         '''
-        total_remaining_space = 0
-        first_shelf = None
-        start_shelf_found = False
+        if STATS.enabled:
+            started = STATS.start()
+            shelf, shelves_scanned = self._find_shelf_with_space(
+                book, start_from_shelf)
+            STATS.finish("find_shelf_with_space", started,
+                         shelves_scanned=shelves_scanned)
+            return shelf
+        return self._find_shelf_with_space(book, start_from_shelf)[0]
+
+    def _find_shelf_with_space(self, book, start_from_shelf=None):
+        '''Does the work of find_shelf_with_space.
+
+        Returns (Shelf, int) - The shelf found (or None) and how many
+                               shelves were looked at to find it.
+        '''
+        shelves_scanned = 0
 
         # If no shelf was specified then search for a shelf with enough
         # room for the book without rearranging books. If no such shelf
@@ -447,16 +1033,18 @@ class Library(Container):
             for room in self.get_rooms():
                 for case in room.get_cases():
                     for shelf in case.get_shelves():
+                        shelves_scanned += 1
                         if shelf.get_remaining_space() >= book.width:
-                            return shelf
+                            return shelf, shelves_scanned
             # First shelf in library
-            start_from_shelf = self.get_rooms[0].get_cases[0].get_shelves[0]
+            start_from_shelf = next(self.iter_shelves(), None)
+            if start_from_shelf is None:
+                return None, shelves_scanned
 
         books_to_move = [book]
 
-        shelves = self.get_all_shelves_flattened(start_from_shelf)
-
-        for shelf in shelves:
+        for shelf in self.iter_shelves(start_from_shelf):
+            shelves_scanned += 1
             remaining_space = shelf.get_remaining_space()
 
             space_needed = sum([book.width
@@ -467,47 +1055,521 @@ class Library(Container):
             space_freed = 0
 
             if space_needed <= remaining_space:
-                return start_from_shelf
+                return start_from_shelf, shelves_scanned
 
             while space_needed > (space_freed + remaining_space):
+                if i < 0:
+                    # Too wide for this shelf even when it is emptied.
+                    return None, shelves_scanned
                 books_to_move.append(shelf.get_books()[i])
                 space_freed += shelf.get_books()[i].width
                 i -= 1
 
                 if not books_to_move:
-                    return start_from_shelf
+                    return start_from_shelf, shelves_scanned
 
-        return None
+        return None, shelves_scanned
 
-    def save_to_file(self, file_name):
-        '''Write Library data to json file
+    def save_to_file(self, file_name, use_snapshot=True):
+        '''Write Library data to json file. Each room is written as one
+        contiguous block and its byte offset is recorded in a room index
+        next to the file so the library can later be loaded lazily. Rooms
+        that are unchanged since they were loaded are copied from the old
+        file as is instead of being encoded again.
 
         Args:
            file_name: Name of json file
+           use_snapshot: If True also refresh the binary snapshot cache
+                         so the next load can skip json parsing.
+        '''
+        started = STATS.start() if STATS.enabled else None
+        hasher = hashlib.sha256()
+        rooms_index = []
+        rooms_encoded = 0
+        temp_name = file_name + ".tmp"
+        with open(temp_name, "wb") as f:
+            def write(data):
+                hasher.update(data)
+                f.write(data)
+
+            write(self.encode_json_head())
+            for i, room in enumerate(self.get_rooms()):
+                if i:
+                    write(b",\n")
+                if not room.has_saved_copy():
+                    rooms_encoded += 1
+                data = room.encode_json()
+                rooms_index.append({"label": room.label,
+                                    "offset": f.tell(),
+                                    "length": len(data),
+                                    "summary": room.get_summary(),
+                                    "content_hash": room.get_content_hash()})
+                write(data)
+            write(b"\n  ]\n}")
+            bytes_written = f.tell()
+        os.replace(temp_name, file_name)
+
+        stat = os.stat(file_name)
+        for room, entry in zip(self.get_rooms(), rooms_index):
+            room.set_saved_at(self._get_room_source(file_name, stat, entry),
+                              entry["summary"], entry["content_hash"])
+        self.mark_saved()
+        self._write_room_index(file_name, stat, rooms_index)
+
+        if use_snapshot and self.is_fully_loaded():
+            stamp = {"version": SNAPSHOT_VERSION,
+                     "mtime_ns": stat.st_mtime_ns,
+                     "size": bytes_written,
+                     "sha256": hasher.hexdigest()}
+            write_snapshot(file_name, stamp, self)
+        if started is not None:
+            STATS.finish("save_to_file", started, bytes_written=bytes_written,
+                         rooms_encoded=rooms_encoded)
+
+    def save_to_directory(self, directory):
+        '''Write Library data to a directory holding a manifest plus one
+        json file per room. Only rooms changed since they were last saved
+        to this directory are written; each goes to a new file and the
+        manifest is then atomically replaced, so a crash leaves either the
+        old or the new library on disk. Files no longer referenced by the
+        manifest are removed afterwards.
+
+        Args:
+           directory: Directory to save to. Created if it does not exist.
+        '''
+        started = STATS.start() if STATS.enabled else None
+        directory = os.path.abspath(directory)
+        os.makedirs(directory, exist_ok=True)
+        manifest_name = os.path.join(directory, MANIFEST_FILE_NAME)
+        old_manifest = read_manifest(directory) or {}
+        old_files = set(entry["file"]
+                        for entry in old_manifest.get("rooms", []))
+        generation = old_manifest.get("generation", 0) + 1
+
+        rooms_index = []
+        bytes_written = 0
+        for i, room in enumerate(self.get_rooms()):
+            saved_at = room.__dict__.get("_saved_at")
+            name = None
+            if saved_at and room.has_saved_copy():
+                saved_directory, saved_name = os.path.split(
+                    saved_at["file_name"])
+                if saved_directory == directory and saved_name in old_files:
+                    name = saved_name
+            if name is None:
+                data = room.encode_json()
+                name = "room-{}-{}.json".format(i, generation)
+                write_file_atomically(os.path.join(directory, name), data)
+                bytes_written += len(data)
+            rooms_index.append({"label": room.label,
+                                "file": name,
+                                "summary": room.get_summary(),
+                                "content_hash": room.get_content_hash()})
+
+        manifest = {"version": MANIFEST_VERSION,
+                    "generation": generation,
+                    "label": self.label,
+                    "borrowers": sorted(self.borrowers),
+                    "rooms": rooms_index}
+        data = json.dumps(manifest, indent=2).encode()
+        write_file_atomically(manifest_name, data)
+        bytes_written += len(data)
+
+        for name in old_files - set(entry["file"] for entry in rooms_index):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+        for room, entry in zip(self.get_rooms(), rooms_index):
+            file_name = os.path.join(directory, entry["file"])
+            room.set_saved_at(self._get_room_source(file_name),
+                              entry["summary"], entry["content_hash"])
+        self.mark_saved()
+        if started is not None:
+            STATS.finish("save_to_directory", started,
+                         bytes_written=bytes_written)
+
+    def encode_json_head(self):
+        '''Returns (bytes) - The json of this library up to and including
+                            the opening bracket of its list of rooms.
+        '''
+        head = LibraryJSONEncoder().default(self)
+        del head["children"]
+        text = json.dumps(head, cls=LibraryJSONEncoder, indent=2)
+        return (text[:-2] + ',\n  "children": [\n').encode()
+
+    def _write_room_index(self, file_name, stat, rooms_index):
+        '''Write the byte offsets and summaries of this library's rooms
+        next to the json file they were saved in.'''
+        index = {"version": ROOM_INDEX_VERSION,
+                 "mtime_ns": stat.st_mtime_ns,
+                 "size": stat.st_size,
+                 "label": self.label,
+                 "borrowers": sorted(self.borrowers),
+                 "rooms": rooms_index}
+        try:
+            with open(file_name + ROOM_INDEX_SUFFIX, "wt") as f:
+                json.dump(index, f)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _get_room_source(file_name, stat=None, entry=None):
+        '''Build the dict describing where a room's json is. Without an
+        index entry the room is the whole file.'''
+        if stat is None:
+            stat = os.stat(file_name)
+        if entry is None:
+            entry = {"offset": 0, "length": stat.st_size}
+        return {"file_name": os.path.abspath(file_name),
+                "offset": entry["offset"],
+                "length": entry["length"],
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size}
+
+    @staticmethod
+    def _from_index(index, room_sources):
+        '''Create a Library with unloaded rooms from a room index or
+        directory manifest.'''
+        library = Library(index["label"])
+        for name in index["borrowers"]:
+            library.borrowers[name] = Person(name)
+        for entry, source in zip(index["rooms"], room_sources):
+            room = Room(entry["label"])
+            library.add_room(room)
+            room.set_source(source, entry["summary"],
+                            entry.get("content_hash"))
+        library.mark_saved()
+        return library
+
+    @staticmethod
+    def _read_room_index(file_name):
+        '''Returns (dict, os.stat_result) - The room index of a json file
+        and the file's stat, or None if there is no current index.'''
+        try:
+            stat = os.stat(file_name)
+            with open(file_name + ROOM_INDEX_SUFFIX, "rt") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        is_current = (index.get("version") == ROOM_INDEX_VERSION and
+                      index.get("mtime_ns") == stat.st_mtime_ns and
+                      index.get("size") == stat.st_size)
+        if is_current:
+            return index, stat
+        return None
+
+    @staticmethod
+    def load_lazily(file_name):
+        '''Create a Library from the room index next to a json file without
+        reading the rooms themselves. Each room is loaded the first time
+        its cases are asked for.
+
+        Returns (Library) - Library whose rooms are not loaded yet, or None
+                            if the json file has no up to date room index.
+        Args:
+           file_name: file that contains the json representation of a Library.
         '''
-        with open(file_name, "wt") as f:
-            f.write(json.dumps(self, cls=LibraryJSONEncoder, indent=2))
+        found = Library._read_room_index(file_name)
+        if found is None:
+            return None
+        index, stat = found
+        return Library._from_index(
+            index, [Library._get_room_source(file_name, stat, entry)
+                    for entry in index["rooms"]])
 
     @staticmethod
-    def load_from_file(file_name):
+    def load_from_directory(directory, lazy=False):
+        '''Read a library saved with save_to_directory.
+
+        Returns (Library) - The Library, or None if directory has no manifest.
+        Args:
+           directory: Directory the library was saved to.
+           lazy: If True only load each room on first access.
+        '''
+        started = STATS.start() if STATS.enabled else None
+        directory = os.path.abspath(directory)
+        manifest = read_manifest(directory)
+        if manifest is None:
+            return None
+        library = Library._from_index(
+            manifest, [Library._get_room_source(os.path.join(directory,
+                                                             entry["file"]))
+                       for entry in manifest["rooms"]])
+        if not lazy:
+            for room in library.get_rooms():
+                room.load_contents()
+        if started is not None:
+            STATS.finish("load_from_directory", started)
+        return library
+
+    @staticmethod
+    def load_from_file(file_name, use_snapshot=True, lazy=False):
         '''Read a json file and load it into a Library object
 
         Returns (Library) - Fully populated Library with Room, Cases,
                             Shelves, and Books.
         Args:
            file_name: file that contains the json representation of a Library.
+           use_snapshot: If True use the binary snapshot cache next to the
+                         json file when it is still current, and rebuild
+                         it when it is not.
+           lazy: If True and the file has a current room index, only
+                 create the rooms and load their contents on first access.
         '''
+        if lazy:
+            library = Library.load_lazily(file_name)
+            if library is not None:
+                return library
+
+        started = STATS.start() if STATS.enabled else None
+        snapshot_hit = False
         try:
-            with open(file_name, "rt") as f:
+            with open(file_name, "rb") as f:
                 json_data = f.read()
-        except FileNotFoundError as e:
+        except FileNotFoundError:
             library = None
         else:
-            library = json.loads(json_data, cls=LibraryJSONDecoder)
-
+            library = None
+            if use_snapshot:
+                stamp = get_snapshot_stamp(file_name, json_data)
+                library = read_snapshot(file_name, stamp)
+                snapshot_hit = library is not None
+            if library is None:
+                library = json.loads(json_data, cls=LibraryJSONDecoder)
+                library.mark_saved()
+                found = Library._read_room_index(file_name)
+                if found is not None:
+                    index, stat = found
+                    for room, entry in zip(library.get_rooms(),
+                                           index["rooms"]):
+                        room.set_saved_at(
+                            Library._get_room_source(file_name, stat, entry),
+                            entry["summary"], entry.get("content_hash"))
+                if use_snapshot:
+                    write_snapshot(file_name, stamp, library)
+
+        if started is not None and library is not None:
+            if snapshot_hit:
+                STATS.increment("load_from_file.snapshot_hits")
+            STATS.finish("load_from_file", started, bytes_read=len(json_data),
+                         snapshot_hit=snapshot_hit)
         return library
 
 
+def read_manifest(directory):
+    '''Returns (dict) - The manifest of a library saved with
+                        Library.save_to_directory, or None if there is none.
+    '''
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE_NAME), "rt") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_file_atomically(file_name, data):
+    '''Write data to a temporary file and rename it over file_name, so
+    readers see either the old or the new contents but never a mix.
+    '''
+    temp_name = file_name + ".tmp"
+    with open(temp_name, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_name, file_name)
+
+
+def get_snapshot_stamp(file_name, json_data):
+    '''Identify the current contents of a library json file.
+
+    Returns (dict) - The snapshot format version plus the file's
+                     modification time, size and sha256 hash.
+    Args:
+       file_name: The library json file.
+       json_data: The bytes currently in that file.
+    '''
+    return {"version": SNAPSHOT_VERSION,
+            "mtime_ns": os.stat(file_name).st_mtime_ns,
+            "size": len(json_data),
+            "sha256": hashlib.sha256(json_data).hexdigest()}
+
+
+def read_snapshot(file_name, stamp):
+    '''Load the Library pickled next to a json file.
+
+    Snapshots are pickles, so only use them for library files you trust
+    as much as your own code.
+
+    Returns (Library) - The cached Library, or None if there is no snapshot
+                        or it does not match stamp.
+    Args:
+       file_name: The library json file the snapshot belongs to.
+       stamp: Value returned by get_snapshot_stamp for the json file.
+    '''
+    try:
+        with open(file_name + SNAPSHOT_SUFFIX, "rb") as f:
+            if pickle.load(f) != stamp:
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # A truncated or incompatible snapshot is just a cache miss.
+        return None
+
+
+def write_snapshot(file_name, stamp, library):
+    '''Pickle a Library next to its json file. The stamp is written first
+    so a stale snapshot can be rejected without unpickling the library.
+    Failing to write the cache is not an error.
+
+    Args:
+       file_name: The library json file the snapshot belongs to.
+       stamp: Value returned by get_snapshot_stamp for the json file.
+       library: The Library loaded from, or saved to, the json file.
+    '''
+    snapshot_name = file_name + SNAPSHOT_SUFFIX
+    temp_name = snapshot_name + ".tmp"
+    try:
+        with open(temp_name, "wb") as f:
+            pickle.dump(stamp, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(library, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_name, snapshot_name)
+    except (OSError, pickle.PicklingError):
+        pass
+
+
+class BookChange:
+    '''Class describing how a single book differs between two libraries.
+
+    kind is one of "added", "removed", "moved", "loan" (lent or returned)
+    or "shelved" (taken off or put back on its shelf). book_a and
+    location_a describe the book in the first library, book_b and
+    location_b in the second; either side is None for added and removed
+    books. Locations are tuples of room, case and shelf labels.
+    '''
+    def __init__(self, kind, book_a, location_a, book_b, location_b):
+        self.kind = kind
+        self.book_a = book_a
+        self.location_a = location_a
+        self.book_b = book_b
+        self.location_b = location_b
+
+    def __repr__(self):
+        book = self.book_a or self.book_b
+        text = '{}: "{}" by {}'.format(self.kind, book.title, book.author)
+        if self.kind == "moved":
+            text += " from {} to {}".format("/".join(self.location_a),
+                                            "/".join(self.location_b))
+        elif self.kind == "loan":
+            text += " {} -> {}".format(
+                _get_borrower_name(self.book_a) or "nobody",
+                _get_borrower_name(self.book_b) or "nobody")
+        else:
+            text += " " + "/".join(self.location_a or self.location_b)
+        return text
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def diff(library_a, library_b):
+    '''Compare two libraries, skipping every pair of containers whose
+    content hashes match. The work done is proportional to the parts of
+    the libraries that differ rather than to their size.
+
+    Yields (BookChange) - Books added, removed, moved to another shelf,
+                          lent or returned, or taken off or put back on
+                          their shelf between library_a and library_b.
+    Args:
+       library_a: The library to compare from.
+       library_b: The library to compare to.
+    '''
+    removed = dict()
+    added = dict()
+    _collect_differences(library_a, library_b, removed, added)
+
+    for key in list(removed):
+        books_a = removed[key]
+        books_b = added.pop(key, [])
+        # Pair up copies left on the same shelf first, then treat the
+        # remaining pairs as moves.
+        for pairs_on_same_shelf in (True, False):
+            for book_a, location_a in books_a[:]:
+                for book_b, location_b in books_b:
+                    if pairs_on_same_shelf and location_a != location_b:
+                        continue
+                    books_a.remove((book_a, location_a))
+                    books_b.remove((book_b, location_b))
+                    if location_a != location_b:
+                        yield BookChange("moved", book_a, location_a,
+                                         book_b, location_b)
+                    if _get_borrower_name(book_a) != _get_borrower_name(
+                            book_b):
+                        yield BookChange("loan", book_a, location_a,
+                                         book_b, location_b)
+                    elif book_a.is_on_shelf != book_b.is_on_shelf:
+                        yield BookChange("shelved", book_a, location_a,
+                                         book_b, location_b)
+                    break
+        for book_a, location_a in books_a:
+            yield BookChange("removed", book_a, location_a, None, None)
+        if books_b:
+            added[key] = books_b
+    for books_b in added.values():
+        for book_b, location_b in books_b:
+            yield BookChange("added", None, None, book_b, location_b)
+
+
+def _collect_differences(node_a, node_b, removed, added):
+    '''Collect the books of every differing pair of containers beneath
+    node_a and node_b, keyed by book identity (title, author, edition).
+
+    Args:
+       node_a: Container from the first library, or None.
+       node_b: Matching container from the second library, or None.
+       removed: dict filled with (book, location) pairs from node_a.
+       added: dict filled with (book, location) pairs from node_b.
+    '''
+    if node_a is not None and node_b is not None:
+        if node_a.get_content_hash() == node_b.get_content_hash():
+            return
+        if isinstance(node_a, Shelf) or isinstance(node_b, Shelf):
+            _collect_books(node_a, removed)
+            _collect_books(node_b, added)
+            return
+        # Match children by label, pairing repeated labels in order.
+        children_b = dict()
+        for child in node_b.children:
+            children_b.setdefault(child.label, []).append(child)
+        for child in node_a.children:
+            matches = children_b.get(child.label)
+            match = matches.pop(0) if matches else None
+            _collect_differences(child, match, removed, added)
+        for matches in children_b.values():
+            for child in matches:
+                _collect_differences(None, child, removed, added)
+    elif node_a is not None:
+        _collect_books(node_a, removed)
+    elif node_b is not None:
+        _collect_books(node_b, added)
+
+
+def _get_borrower_name(book):
+    return book.lent_to.name if book.lent_to else None
+
+
+def _collect_books(node, books):
+    for book in node.get_leaf_nodes():
+        location = tuple(item.label for item in book.get_full_location()[1:-1])
+        books.setdefault(book.get_identity(), []).append((book, location))
+
+
 class Person:
     '''Class representing a person. For our purposes a Person
     can only borrow books.
@@ -516,8 +1578,175 @@ class Person:
         self.name = name
 
     def __eq__(self, other):
+        if not isinstance(other, Person):
+            return NotImplemented
         return self.name == other.name
 
+    def __hash__(self):
+        return hash(self.name)
+
+
+class CopyIndex:
+    '''Class mapping each book identity (title, author, edition) to every
+    copy of that book in a library. Kept current by listening to the
+    library's change events, so duplicates can be found without comparing
+    a book against every other book.
+    '''
+    def __init__(self, library):
+        self.copies = dict()
+        for book in library.get_all_books():
+            self.add(book)
+        library.add_listener(self.on_change)
+
+    def add(self, book):
+        copies = self.copies.setdefault(book.get_identity(), [])
+        if not any(copy is book for copy in copies):
+            copies.append(book)
+
+    def remove(self, book):
+        copies = self.copies.get(book.get_identity(), [])
+        for i, copy in enumerate(copies):
+            if copy is book:
+                del copies[i]
+                break
+        if not copies:
+            self.copies.pop(book.get_identity(), None)
+
+    def get_copies(self, book):
+        '''Returns (list<Book>) - The copies of book, in the order they
+                                 were added to the library.'''
+        return list(self.copies.get(book.get_identity(), []))
+
+    def on_change(self, event):
+        if event["op"] in ("place_book", "move_book"):
+            self.add(event["book"])
+        elif event["op"] == "displace_book":
+            # Added again when the cascade moves it to another shelf;
+            # a book that finds no shelf has left the library.
+            self.remove(event["book"])
+        elif event["op"] == "add_container":
+            for book in event["container"].get_leaf_nodes():
+                self.add(book)
+        elif event["op"] == "snapshot":
+            # Rebuilt when next needed.
+            event["library"]._copy_index = None
+            event["library"].remove_listener(self.on_change)
+
+
+# Facets books can be counted by. A book's status is one of "on_shelf",
+# "lent" or "off_shelf".
+FACETS = ["genre", "author", "room", "status"]
+
+
+class FacetCounts:
+    '''Class counting the books of a library by each of FACETS, and by
+    each facet within every value of every other facet (genre counts
+    within a room, rooms within an author, ...). Kept current by listening
+    to the library's change events, so counts and single level drill downs
+    take time proportional to the number of facet values rather than the
+    number of books.
+    '''
+    def __init__(self, library):
+        self.entries = dict()
+        self.counts = {facet: dict() for facet in FACETS}
+        self.within = dict()
+        for book in library.get_all_books():
+            self.update(book)
+        library.add_listener(self.on_change)
+
+    @staticmethod
+    def get_entry(book):
+        '''Returns (dict<str, str>) - The value of each facet for book.'''
+        location = book.get_full_location()
+        if book.lent_to:
+            status = "lent"
+        elif book.is_on_shelf:
+            status = "on_shelf"
+        else:
+            status = "off_shelf"
+        return {"genre": book.genre,
+                "author": book.author,
+                "room": location[1].label if len(location) > 2 else None,
+                "status": status}
+
+    def update(self, book):
+        '''Recount a book that was added or changed.'''
+        entry = self.get_entry(book)
+        old_entry = self.entries.get(id(book))
+        if old_entry is not None and old_entry[1] == entry:
+            return
+        self.remove(book)
+        self.entries[id(book)] = (book, entry)
+        self._add_entry(entry, 1)
+
+    def remove(self, book):
+        '''Stop counting a book that has left the library.'''
+        old_entry = self.entries.pop(id(book), None)
+        if old_entry is not None:
+            self._add_entry(old_entry[1], -1)
+
+    def _add_entry(self, entry, amount):
+        for facet, value in entry.items():
+            self._add_count(self.counts[facet], value, amount)
+            within = self.within.setdefault((facet, value), dict())
+            for other, other_value in entry.items():
+                if other != facet:
+                    self._add_count(within.setdefault(other, dict()),
+                                    other_value, amount)
+
+    @staticmethod
+    def _add_count(counts, value, amount):
+        count = counts.get(value, 0) + amount
+        if count:
+            counts[value] = count
+        else:
+            del counts[value]
+
+    def get_counts(self, facet, filters=None):
+        '''Count books by facet among the books matching filters.
+
+        Returns (dict<str, int>) - Number of books with each value of facet.
+
+        Args:
+           facet - One of FACETS
+           filters - dict of facet to the value books must have. With more
+                     than one filter the matching books are counted one by
+                     one.
+        '''
+        if facet not in self.counts:
+            raise ValueError("Unknown facet {!r}".format(facet))
+        filters = filters or dict()
+        if not filters:
+            return dict(self.counts[facet])
+        if len(filters) == 1:
+            (other, value), = filters.items()
+            if other == facet:
+                count = self.counts[facet].get(value, 0)
+                return {value: count} if count else dict()
+            return dict(self.within.get((other, value), dict()).get(facet,
+                                                                    dict()))
+        counts = dict()
+        for book, entry in self.entries.values():
+            if all(entry[key] == value for key, value in filters.items()):
+                counts[entry[facet]] = counts.get(entry[facet], 0) + 1
+        return counts
+
+    def on_change(self, event):
+        if event["op"] in ("place_book", "move_book", "lend", "return",
+                           "shelve"):
+            self.update(event["book"])
+        elif event["op"] == "displace_book":
+            # Counted again when the cascade moves it to another shelf;
+            # a book that finds no shelf has left the library.
+            self.remove(event["book"])
+        elif event["op"] == "add_container":
+            for book in event["container"].get_leaf_nodes():
+                self.update(book)
+        elif event["op"] == "snapshot":
+            # Rebuilt when next needed.
+            event["library"]._facets = None
+            event["library"].remove_listener(self.on_change)
+
 
 class LibraryJSONEncoder(json.JSONEncoder):
     '''JSON encoder that knows how to encode our various library objects.
@@ -526,10 +1755,13 @@ class LibraryJSONEncoder(json.JSONEncoder):
     def default(self, o):
         '''Called during Dump. Saves the dictionary of attributes associated
         with the object, removes the "contained_in" attribute to prevent
-        circular references, and saves the class name so "load" knows the
+        circular references and any private "_" attributes, and saves the class name so "load" knows the
         type of object to recreate.'''
-        temp_dict = o.__dict__.copy()
+        temp_dict = {key: value for key, value in o.__dict__.items()
+                     if not key.startswith("_")}
         temp_dict.pop("contained_in", None)
+        if isinstance(o, Container):
+            temp_dict["children"] = o.children
         temp_dict["__class__"] = o.__class__.__name__
         return temp_dict
 
@@ -561,7 +1793,8 @@ class LibraryJSONDecoder(json.JSONDecoder):
                               default_object["author"],
                               default_object["pages"],
                               default_object["genre"],
-                              default_object["width"])
+                              default_object["width"],
+                              default_object.get("edition"))
             new_object.is_on_shelf = default_object["is_on_shelf"]
             lent_to = default_object.get("lent_to", None)
             if lent_to:
@@ -580,8 +1813,108 @@ class LibraryJSONDecoder(json.JSONDecoder):
         return self.decode_object(default_object)
 
 
+def make_test_library(rooms=2, cases=2, shelves=3, width=10, books=50):
+    '''Returns (Library) - A small library for tests, with books of a few
+                          widths, genres and authors added by add_book.'''
+    library = Library("Test Library")
+    for r in range(rooms):
+        room = Room("Room {}".format(r + 1))
+        library.add_room(room)
+        for c in range(cases):
+            case = Case("Case {}".format(c + 1))
+            room.add_case(case)
+            for s in range(shelves):
+                case.add_shelf(Shelf("Shelf {}".format(s + 1), width))
+    for i in range(books):
+        library.add_book(Book("Title {}".format(i), "Author {}".format(i % 7),
+                              100 + i * 37 % 400, "Genre {}".format(i % 3),
+                              1 + i % 3))
+    return library
+
+
 def run_unit_tests():
     '''Run unit tests based on a pre-configured library of data. Incomplete.'''
     print("Running Unit Tests")
     assert(Person("James") == Person("James"))
     assert(Person("James") in [Person("James")])
+
+    # Hashes kept up to date through the changed flags match hashes
+    # worked out from scratch on a copy of the library.
+    def copy_library(library):
+        return LibraryJSONDecoder().decode(json.dumps(library,
+                                                      cls=LibraryJSONEncoder))
+
+    library = make_test_library()
+    reader = Person("Reader")
+    library.add_borrower(reader)
+    content_hash = library.get_content_hash()
+    assert(content_hash == copy_library(library).get_content_hash())
+    first_shelf = library.get_all_shelves_flattened()[0]
+    first_shelf.children[-1].set_on_shelf(False)
+    library.get_all_books()[10].lend_to(reader)
+    assert(library.get_content_hash() ==
+           copy_library(library).get_content_hash())
+    # Pushes the book set off its shelf along to the next shelf.
+    library.add_book(Book("New", "Author", 100, "Genre", 2), first_shelf)
+    assert(library.get_content_hash() ==
+           copy_library(library).get_content_hash())
+    library.get_rooms()[0].add_case(Case("New Case"))
+    library.get_all_books()[10].return_from_borrower()
+    assert(library.get_content_hash() ==
+           copy_library(library).get_content_hash())
+    assert(library.get_content_hash() != content_hash)
+
+    # A library saved to a directory loads back the same, eagerly or
+    # lazily, and saving again only writes the rooms that changed.
+    with tempfile.TemporaryDirectory() as directory:
+        library.save_to_directory(directory)
+        assert(not library.is_changed())
+        for lazy in (False, True):
+            loaded = Library.load_from_directory(directory, lazy)
+            # Hashes of rooms still on disk come from the manifest.
+            assert(loaded.get_content_hash() == library.get_content_hash())
+            assert(loaded.is_fully_loaded() != lazy)
+            assert(json.dumps(loaded, cls=LibraryJSONEncoder,
+                              sort_keys=True) ==
+                   json.dumps(library, cls=LibraryJSONEncoder,
+                              sort_keys=True))
+        files = [entry["file"] for entry in read_manifest(directory)["rooms"]]
+        library.get_rooms()[1].get_leaf_nodes()[0].lend_to(reader)
+        library.save_to_directory(directory)
+        manifest = read_manifest(directory)
+        assert(manifest["rooms"][0]["file"] == files[0])
+        assert(manifest["rooms"][1]["file"] != files[1])
+        assert(sorted(os.listdir(directory)) ==
+               sorted([MANIFEST_FILE_NAME] +
+                      [entry["file"] for entry in manifest["rooms"]]))
+        loaded = Library.load_from_directory(directory, lazy=True)
+        assert(loaded.get_content_hash() == library.get_content_hash())
+        assert(loaded.get_rooms()[1].get_leaf_nodes()[0].lent_to.name ==
+               "Reader")
+
+    # The copy index follows books pushed along the shelves.
+    def get_copies(copy_index):
+        return {identity: sorted(id(book) for book in books)
+                for identity, books in copy_index.copies.items()}
+
+    library = make_test_library()
+    copy_index = library.get_copy_index()
+    book = library.get_all_books()[20]
+    copy = Book(book.title, book.author, book.pages, book.genre, book.width)
+    library.add_book(copy, library.get_all_shelves_flattened()[0])
+    assert(library.count_copies(book) == 2)
+    assert(library.get_copy_index() is copy_index)
+    assert(get_copies(copy_index) == get_copies(CopyIndex(library)))
+
+    # Another edition in the same place is a different book to diff.
+    library_a = make_test_library(books=20)
+    library_b = make_test_library(books=20)
+    library_a.add_book(Book("Dune", "Frank Herbert", 412, "Fiction", 2, 1))
+    library_b.add_book(Book("Dune", "Frank Herbert", 412, "Fiction", 2, 2))
+    changes = list(diff(library_a, library_b))
+    assert(sorted((change.kind, (change.book_a or change.book_b).edition)
+                  for change in changes) == [("added", 2), ("removed", 1)])
+    assert(changes[0].location_a == changes[1].location_b)
+    library_b.get_all_books()[3].lend_to(reader)
+    assert(sorted(change.kind for change in diff(library_a, library_b)) ==
+           ["added", "loan", "removed"])
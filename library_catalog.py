@@ -0,0 +1,434 @@
+'''Library Catalog.
+Contains a catalog of many library files, for example one per site, that
+searches and reports on all of them at once. The files are split into
+shards and each shard is served by its own worker process, so a file is
+always searched by the same worker. Workers keep the libraries they have
+loaded until the file changes, and loading goes through the binary
+snapshot next to each file, so unchanged files are not parsed again.
+Packed catalogs written by library_packed can be searched and reported on
+too, without loading any books.
+usage info: python library_catalog.py --help
+'''
+import argparse
+import concurrent.futures
+import json
+import os
+import library as l
+import library_packed
+
+# Kinds of search a catalog can fan out to every library.
+SEARCH_KINDS = ["title", "author", "query", "fuzzy"]
+
+# Libraries loaded by this worker process: file name to the
+# (mtime_ns, size) the file had when loaded and the Library.
+WORKER_CACHE = dict()
+
+
+def get_file_key(file_name):
+    '''Returns (int, int) - mtime_ns and size of a library file, or of the
+                            manifest of a library saved as a directory.'''
+    if os.path.isdir(file_name):
+        file_name = os.path.join(file_name, l.MANIFEST_FILE_NAME)
+    stat = os.stat(file_name)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load_cached(file_name):
+    '''Load a library file in this worker, reusing the library loaded
+    earlier while the file is unchanged.
+
+    Returns (Library) - The loaded library, or a PackedCatalog if file_name
+                        is a packed catalog.
+    Raises FileNotFoundError if there is no library in file_name.
+    '''
+    key = get_file_key(file_name)
+    cached = WORKER_CACHE.get(file_name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    if cached is not None:
+        # Let the collector free the old library, which was frozen.
+        del WORKER_CACHE[file_name]
+        cached = None
+        l.unfreeze_objects()
+    if library_packed.is_packed(file_name):
+        library = library_packed.PackedCatalog(file_name)
+        WORKER_CACHE[file_name] = (key, library)
+        return library
+    if os.path.isdir(file_name):
+        library = l.Library.load_from_directory(file_name)
+    else:
+        library = l.Library.load_from_file(file_name)
+    if library is None:
+        raise FileNotFoundError("No library in " + file_name)
+    l.freeze_objects()
+    WORKER_CACHE[file_name] = (key, library)
+    return library
+
+
+def describe_hit(file_name, library, book, score=None):
+    '''Returns (dict) - A found book and where it is, as plain values that
+                        are cheap to send back from a worker.'''
+    location = book.get_full_location()
+    return {"file": file_name,
+            "library": library.label,
+            "title": book.title,
+            "author": book.author,
+            "genre": book.genre,
+            "edition": book.edition,
+            "location": [node.label for node in location[1:-1]],
+            "lent_to": book.lent_to.name if book.lent_to else None,
+            "score": score}
+
+
+def describe_packed_hit(file_name, catalog, number):
+    '''Returns (dict) - Book number of a packed catalog and where it is,
+                        like describe_hit.'''
+    book = catalog.get_book(number)
+    return {"file": file_name,
+            "library": catalog.get_label(),
+            "title": book["title"],
+            "author": book["author"],
+            "genre": book["genre"],
+            "edition": book["edition"],
+            "location": catalog.get_location(number),
+            "lent_to": book["lent_to"],
+            "score": None}
+
+
+def search_file(file_name, kind, text, k=10):
+    '''Search one library file. Runs in a worker process.
+
+    Returns (list<dict>) - Matching books, see describe_hit.
+
+    Args:
+       file_name: The library file to search.
+       kind: One of SEARCH_KINDS. "title" and "author" match text anywhere
+             in the field, "query" runs a library_query query and "fuzzy"
+             is a typo tolerant search of titles and authors.
+       text: What to search for.
+       k: Number of books a fuzzy search returns.
+    '''
+    library = load_cached(file_name)
+    if isinstance(library, library_packed.PackedCatalog):
+        if kind not in ("title", "author"):
+            raise ValueError("A packed catalog can only be searched by "
+                             "title or author")
+        return [describe_packed_hit(file_name, library, number)
+                for number in library.search(kind, text)]
+    if kind == "fuzzy":
+        return [describe_hit(file_name, library, book, score)
+                for book, score in library.fuzzy_search(text, k)]
+    if kind == "query":
+        books = library.query(text)
+    else:
+        text = text.lower()
+        books = [book for book in library.get_all_books()
+                 if text in getattr(book, kind).lower()]
+    return [describe_hit(file_name, library, book) for book in books]
+
+
+def report_file(file_name):
+    '''Count the books and shelf space of one library file. Runs in a
+    worker process.
+
+    Returns (dict) - Counts, see Catalog.report.
+    '''
+    library = load_cached(file_name)
+    if isinstance(library, library_packed.PackedCatalog):
+        return {"files": 1,
+                "rooms": library.count_containers("room"),
+                "shelves": library.count_containers("shelf"),
+                "free_space": library.get_free_space(),
+                "books": library.book_count,
+                "genre": library.count_by("genre"),
+                "status": library.count_by("status")}
+    shelves = library.get_all_shelves_flattened()
+    return {"files": 1,
+            "rooms": len(library.get_rooms()),
+            "shelves": len(shelves),
+            "free_space": sum(shelf.get_remaining_space()
+                              for shelf in shelves),
+            "books": len(library.get_all_books()),
+            "genre": library.get_facet_counts("genre"),
+            "status": library.get_facet_counts("status")}
+
+
+def merge_reports(reports):
+    '''Returns (dict) - The sum of several reports from report_file.'''
+    merged = {"files": 0, "rooms": 0, "shelves": 0, "free_space": 0,
+              "books": 0, "genre": dict(), "status": dict()}
+    for report in reports:
+        for key, value in report.items():
+            if isinstance(value, dict):
+                for name, count in value.items():
+                    merged[key][name] = merged[key].get(name, 0) + count
+            else:
+                merged[key] += value
+    return merged
+
+
+class Catalog:
+    '''Class searching many library files at once with a pool of worker
+    processes. Each shard of files has its own single process pool, so
+    every search of a file goes to the worker that already loaded it.
+    '''
+    def __init__(self, file_names, workers=None):
+        '''
+        Args:
+           file_names: The library files, or directories, in the catalog.
+           workers: Number of worker processes. Defaults to one per file,
+                    up to the number of CPUs.
+        '''
+        self.file_names = list(file_names)
+        if workers is None:
+            workers = min(len(self.file_names), os.cpu_count() or 1)
+        workers = max(1, workers)
+        self.pools = [concurrent.futures.ProcessPoolExecutor(max_workers=1)
+                      for i in range(workers)]
+        # The worker serving each file.
+        self.assigned = {file_name: self.pools[i % workers]
+                         for i, file_name in enumerate(self.file_names)}
+        self.errors = dict()
+
+    def _map(self, function, *args):
+        '''Run function(file_name, *args) for every file in its worker.
+
+        Returns (list) - The results of the files that did not fail, in
+                         catalog order. Failures are kept in self.errors.
+        '''
+        futures = [(file_name,
+                    self.assigned[file_name].submit(function, file_name,
+                                                    *args))
+                   for file_name in self.file_names]
+        self.errors = dict()
+        results = []
+        for file_name, future in futures:
+            try:
+                results.append(future.result())
+            except (OSError, ValueError, KeyError) as e:
+                # Missing or unreadable files and invalid queries
+                # (library_query.QueryError is a ValueError).
+                self.errors[file_name] = e
+        return results
+
+    def search(self, kind, text, k=10):
+        '''Search every library in the catalog.
+
+        Returns (list<dict>) - Matching books with the file and location
+                               they were found in, see describe_hit. Fuzzy
+                               searches return the k best matches overall,
+                               best first.
+
+        Args:
+           kind: One of SEARCH_KINDS
+           text: What to search for
+           k: Number of books a fuzzy search returns
+        '''
+        if kind not in SEARCH_KINDS:
+            raise ValueError("Unknown search {!r}".format(kind))
+        hits = [hit for hits in self._map(search_file, kind, text, k)
+                for hit in hits]
+        if kind == "fuzzy":
+            hits.sort(key=lambda hit: -hit["score"])
+            hits = hits[:k]
+        return hits
+
+    def report(self):
+        '''Count books and space across every library in the catalog.
+
+        Returns (dict) - Number of "files", "rooms", "shelves", "books",
+                         the "free_space" on all shelves and the number
+                         of books by "genre" and by "status".
+        '''
+        return merge_reports(self._map(report_file))
+
+    def close(self):
+        for pool in self.pools:
+            pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def format_hit(hit):
+    '''Returns (str) - A found book and where it is on one line.'''
+    text = '"{}" by {} - {} ({}): {}'.format(
+        hit["title"], hit["author"], hit["library"], hit["file"],
+        " / ".join(hit["location"]))
+    if hit["lent_to"]:
+        text += " (lent to {})".format(hit["lent_to"])
+    if hit["score"] is not None:
+        text += " ({:.0%} match)".format(hit["score"])
+    return text
+
+
+def format_report(report):
+    '''Returns (str) - A report from Catalog.report as text.'''
+    lines = ["{files} libraries, {rooms} rooms, {shelves} shelves, "
+             "{books} books, {free_space} free space".format(**report)]
+    for key in ("status", "genre"):
+        lines.append("By {}:".format(key))
+        for name, count in sorted(report[key].items(),
+                                  key=lambda item: (-item[1], item[0])):
+            lines.append("  {}: {}".format(name, count))
+    return "\n".join(lines)
+
+
+def print_results(catalog, results, as_json):
+    '''Print search hits or a report, and any files that failed.'''
+    if as_json:
+        print(json.dumps(results, indent=2))
+    elif isinstance(results, dict):
+        print(format_report(results))
+    else:
+        for hit in results:
+            print(format_hit(hit))
+        print("{} book(s) found.".format(len(results)))
+    for file_name, error in catalog.errors.items():
+        print("Could not search {}: {}".format(file_name, error))
+
+
+def run_interactive(catalog, as_json):
+    '''Read searches such as "title moby" from the user until "q". The
+    workers keep their libraries loaded between searches.'''
+    print("Enter a search: " + ", ".join(kind + " <text>"
+                                         for kind in SEARCH_KINDS) +
+          ", report, or q to quit.")
+    while True:
+        text = input("> ").strip()
+        if text == "q":
+            break
+        kind, _, text = text.partition(" ")
+        if kind == "report":
+            print_results(catalog, catalog.report(), as_json)
+        elif kind in SEARCH_KINDS and text:
+            print_results(catalog, catalog.search(kind, text), as_json)
+        else:
+            print("Unrecognized search, please try again.")
+
+
+def parse_command_line():
+    '''Parse command line arguments.
+
+    Return (dict) - Parsed command line arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description='Search many library files at once.')
+    parser.add_argument('file_names', nargs='+', metavar='FILE',
+                        help='Library JSON files, directories or packed '
+                             'catalogs')
+    for kind, help_text in [("title", "Find books whose title contains "
+                                      "TEXT"),
+                            ("author", "Find books whose author contains "
+                                       "TEXT"),
+                            ("query", 'Find books matching a query such as '
+                                      'genre == "Fiction" and not lent'),
+                            ("fuzzy", "Find the books best matching TEXT by "
+                                      "title or author, tolerating typos")]:
+        parser.add_argument('--' + kind, dest=kind, metavar='TEXT',
+                            default=None, help=help_text)
+    parser.add_argument('--report', dest='report', action='store_const',
+                        const=True, default=False,
+                        help='Count books and space across the libraries')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help='Number of worker processes (default: one per '
+                             'file, up to the number of CPUs)')
+    parser.add_argument('--json', dest='json', action='store_const',
+                        const=True, default=False,
+                        help='Print results as json')
+    return parser.parse_args()
+
+
+def run_unit_tests():
+    '''Run unit tests of a catalog split over several workers against a
+    plain scan of the same libraries.'''
+    import tempfile
+    print("Running Catalog Unit Tests")
+    libraries = [l.make_test_library(books=books) for books in (50, 30, 20)]
+    reader = l.Person("Reader")
+    libraries[1].add_borrower(reader)
+    libraries[1].get_all_books()[3].lend_to(reader)
+    with tempfile.TemporaryDirectory() as directory:
+        file_names = []
+        for i, library in enumerate(libraries):
+            file_names.append(os.path.join(directory,
+                                           "site{}.json".format(i)))
+            library.save_to_file(file_names[-1])
+
+        def scan(kind, text, k=10):
+            hits = []
+            for file_name, library in zip(file_names, libraries):
+                if kind == "fuzzy":
+                    hits += [describe_hit(file_name, library, book, score)
+                             for book, score
+                             in library.fuzzy_search(text, k)]
+                    continue
+                if kind == "query":
+                    books = library.query(text)
+                else:
+                    books = [book for book in library.get_all_books()
+                             if text.lower() in getattr(book, kind).lower()]
+                hits += [describe_hit(file_name, library, book)
+                         for book in books]
+            if kind == "fuzzy":
+                hits.sort(key=lambda hit: -hit["score"])
+                hits = hits[:k]
+            return hits
+
+        searches = [("title", "title 1"), ("author", "AUTHOR 3"),
+                    ("query", 'genre == "Genre 1" and not lent'),
+                    ("query", "lent"), ("fuzzy", "Titel 12"),
+                    ("fuzzy", "Auther 3")]
+        # Three files on two workers, so one worker serves two files.
+        with Catalog(file_names, workers=2) as catalog:
+            for kind, text in searches:
+                hits = catalog.search(kind, text)
+                assert(hits == scan(kind, text))
+                assert(hits)
+                assert(not catalog.errors)
+            # Searching again uses the libraries the workers loaded.
+            assert(catalog.search("title", "title 2") ==
+                   scan("title", "title 2"))
+
+            report = catalog.report()
+            shelves = [shelf for library in libraries
+                       for shelf in library.get_all_shelves_flattened()]
+            books = [book for library in libraries
+                     for book in library.get_all_books()]
+            genres = dict()
+            for book in books:
+                genres[book.genre] = genres.get(book.genre, 0) + 1
+            assert(report["files"] == 3)
+            assert(report["rooms"] == sum(len(library.get_rooms())
+                                          for library in libraries))
+            assert(report["shelves"] == len(shelves))
+            assert(report["free_space"] == sum(shelf.get_remaining_space()
+                                               for shelf in shelves))
+            assert(report["books"] == len(books))
+            assert(report["genre"] == genres)
+            assert(sum(report["status"].values()) == len(books))
+
+        with Catalog(file_names + [os.path.join(directory, "missing.json")],
+                     workers=2) as catalog:
+            assert(catalog.search("author", "author 3") ==
+                   scan("author", "author 3"))
+            assert(list(catalog.errors) == [catalog.file_names[-1]])
+
+
+if __name__ == '__main__':
+    args = parse_command_line()
+    with Catalog(args.file_names, args.workers) as catalog:
+        searched = False
+        for kind in SEARCH_KINDS:
+            if getattr(args, kind) is not None:
+                print_results(catalog,
+                              catalog.search(kind, getattr(args, kind)),
+                              args.json)
+                searched = True
+        if args.report:
+            print_results(catalog, catalog.report(), args.json)
+        elif not searched:
+            run_interactive(catalog, args.json)
@@ -0,0 +1,494 @@
+'''Library Forecast.
+Contains a Monte Carlo simulation of when the shelves, cases and rooms of
+a library fill up. Each trial starts from the library as it is and adds a
+random stream of future books, placing them with the same rules as
+Library.add_book: the first shelf with room for a book gets it at the
+front, and when no shelf has room books are pushed along the shelves from
+the first one. Only book widths matter for placement; genres are drawn
+too so the mix of books added can be reported.
+
+numpy is used to draw the random books and to compute the confidence
+intervals when it is installed; otherwise the random module is used.
+usage info: python library_forecast.py --help
+'''
+import argparse
+import datetime
+import math
+import random
+import library as l
+from library_render import render_lines
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DAYS_PER_MONTH = 365.25 / 12
+# Books drawn at a time for each trial.
+BATCH_SIZE = 4096
+
+
+def count_values(books, attribute, default):
+    '''Returns (dict) - How many books have each value of attribute, or
+                        {default: 1} if there are no books.'''
+    counts = dict()
+    for book in books:
+        value = getattr(book, attribute)
+        counts[value] = counts.get(value, 0) + 1
+    return counts or {default: 1}
+
+
+class BookStream:
+    '''Class drawing random future books: the days between acquisitions
+    are exponentially distributed, and widths and genres are drawn with
+    the given weights.
+    '''
+    def __init__(self, books_per_month, widths, genres, seed=None):
+        '''
+        Args:
+           books_per_month: Average number of books acquired per month.
+           widths: dict of book width to weight, e.g. {1: 8, 3: 2}
+           genres: dict of genre to weight
+           seed: Seed for repeatable draws.
+        '''
+        if books_per_month <= 0:
+            raise ValueError("books_per_month must be positive")
+        self.mean_gap = DAYS_PER_MONTH / books_per_month
+        self.widths = list(widths)
+        self.width_weights = [widths[width] for width in self.widths]
+        self.genres = list(genres)
+        self.genre_weights = [genres[genre] for genre in self.genres]
+        if numpy is not None:
+            self.rng = numpy.random.default_rng(seed)
+            self.width_p = self._normalize(self.width_weights)
+            self.genre_p = self._normalize(self.genre_weights)
+        else:
+            self.rng = random.Random(seed)
+
+    @staticmethod
+    def _normalize(weights):
+        total = sum(weights)
+        return [weight / total for weight in weights]
+
+    def get_min_width(self):
+        return min(self.widths)
+
+    def sample(self, count):
+        '''Returns (list<float>, list<int>, list<str>) - Days between
+                   books, and the width and genre of each of count books.'''
+        if numpy is not None:
+            gaps = self.rng.exponential(self.mean_gap, count).tolist()
+            widths = self.rng.choice(len(self.widths), count, p=self.width_p)
+            genres = self.rng.choice(len(self.genres), count, p=self.genre_p)
+            return (gaps, [self.widths[i] for i in widths.tolist()],
+                    [self.genres[i] for i in genres.tolist()])
+        return ([self.rng.expovariate(1 / self.mean_gap)
+                 for i in range(count)],
+                self.rng.choices(self.widths, self.width_weights, k=count),
+                self.rng.choices(self.genres, self.genre_weights, k=count))
+
+
+class Layout:
+    '''Class holding the shelves of a library as plain lists: the widths
+    of the books on each shelf, front of the shelf last, and which case
+    and room each shelf is in.
+    '''
+    def __init__(self, library):
+        self.library = library
+        self.rooms = library.get_rooms()
+        self.cases = [case for room in self.rooms for case in room.children]
+        self.shelves = library.get_all_shelves_flattened()
+        case_numbers = {id(case): i for i, case in enumerate(self.cases)}
+        room_numbers = {id(room): i for i, room in enumerate(self.rooms)}
+        self.shelf_case = [case_numbers[id(shelf.contained_in)]
+                           for shelf in self.shelves]
+        self.case_room = [room_numbers[id(case.contained_in)]
+                          for case in self.cases]
+        self.shelf_width = [shelf.width for shelf in self.shelves]
+        self.shelf_books = [[book.width for book in reversed(shelf.children)]
+                            for shelf in self.shelves]
+
+
+class Trial:
+    '''Class running one trial: the state of every shelf as books are
+    added, and the day each shelf, case and room filled up.
+
+    A shelf is full once it has less room left than the narrowest book
+    that can arrive, a case once all of its shelves are full and a room
+    once all of its cases are. Cases and rooms without shelves are full
+    from the start.
+    '''
+    def __init__(self, layout, min_width):
+        self.layout = layout
+        self.min_width = min_width
+        self.books = [list(books) for books in layout.shelf_books]
+        self.remaining = [width - sum(books) for width, books
+                          in zip(layout.shelf_width, self.books)]
+        self.first = dict()
+        self.shelf_days = [None] * len(self.books)
+        self.case_days = [None] * len(layout.cases)
+        self.room_days = [None] * len(layout.rooms)
+        self.library_day = None
+        self.open_shelves = len(self.books)
+        self.case_open = [0] * len(layout.cases)
+        self.room_open = [0] * len(layout.rooms)
+        for case in layout.shelf_case:
+            self.case_open[case] += 1
+        for case, room in enumerate(layout.case_room):
+            if self.case_open[case]:
+                self.room_open[room] += 1
+            else:
+                self.case_days[case] = 0.0
+        for room, open_cases in enumerate(self.room_open):
+            if not open_cases:
+                self.room_days[room] = 0.0
+        for shelf in range(len(self.books)):
+            self.check_full(shelf, 0.0)
+
+    def check_full(self, shelf, day):
+        if self.shelf_days[shelf] is not None or \
+                self.remaining[shelf] >= self.min_width:
+            return
+        self.shelf_days[shelf] = day
+        self.open_shelves -= 1
+        case = self.layout.shelf_case[shelf]
+        self.case_open[case] -= 1
+        if not self.case_open[case]:
+            self.case_days[case] = day
+            room = self.layout.case_room[case]
+            self.room_open[room] -= 1
+            if not self.room_open[room]:
+                self.room_days[room] = day
+
+    def add_book(self, width, day):
+        '''Place a book like Library.add_book.
+
+        Returns (bool) - False if there was no space for it.
+        '''
+        shelf = self.first.get(width, 0)
+        while shelf < len(self.books) and self.remaining[shelf] < width:
+            shelf += 1
+        # Shelves only lose space until books are pushed along, so the
+        # first shelf a width fits on only moves forward.
+        self.first[width] = shelf
+        if shelf < len(self.books):
+            self.books[shelf].append(width)
+            self.remaining[shelf] -= width
+            self.check_full(shelf, day)
+            return True
+        if not self.can_push_along(width):
+            return False
+        self.push_along(width, day)
+        self.first = dict()
+        return True
+
+    def can_push_along(self, width):
+        '''Mirror of the search in Library.find_shelf_with_space when no
+        shelf has room: can the books be pushed along from the first
+        shelf to make room?'''
+        books_to_move = [width]
+        for shelf, books in enumerate(self.books):
+            space_needed = sum(books_to_move)
+            books_to_move = []
+            if space_needed <= self.remaining[shelf]:
+                return True
+            # Books in shelf order, taken from the end of the shelf.
+            in_order = books[::-1]
+            i = len(in_order) - 1
+            space_freed = 0
+            try:
+                while space_needed > space_freed + self.remaining[shelf]:
+                    books_to_move.append(in_order[i])
+                    space_freed += in_order[i]
+                    i -= 1
+            except IndexError:
+                return False
+        return False
+
+    def push_along(self, width, day):
+        '''Mirror of Library.add_book inserting at the front of the first
+        shelf, each shelf passing the books forced off its end on to the
+        front of the next.'''
+        books_to_add = [width]
+        for shelf, books in enumerate(self.books):
+            displaced = []
+            for book in reversed(books_to_add):
+                books.append(book)
+                self.remaining[shelf] -= book
+                forced_off = []
+                while self.remaining[shelf] < 0:
+                    forced_off.insert(0, books.pop(0))
+                    self.remaining[shelf] += forced_off[0]
+                displaced = forced_off + displaced
+            self.check_full(shelf, day)
+            books_to_add = displaced
+            if not books_to_add:
+                break
+
+    def run(self, stream, horizon):
+        '''Add books from stream until every shelf is full or horizon
+        days have passed. A book that does not fit is turned away, as
+        Library.add_book does, but narrower books may still fit later.
+
+        Returns (dict) - Number of books added by genre.
+        '''
+        day = 0.0
+        added = dict()
+        while True:
+            for gap, width, genre in zip(*stream.sample(BATCH_SIZE)):
+                day += gap
+                if day > horizon:
+                    return added
+                if self.add_book(width, day):
+                    added[genre] = added.get(genre, 0) + 1
+                elif self.library_day is None:
+                    self.library_day = day
+                if self.open_shelves == 0 and self.library_day is not None:
+                    return added
+
+
+def get_percentiles(days, fractions):
+    '''Percentiles of fill days across trials, by the nearest rank.
+
+    Returns (list<list<float>>) - For each fraction, the day of each column
+                                  of days, or math.inf if fewer trials
+                                  than that filled it in time.
+    Args:
+       days: list of trials, each a list of days or None for not full.
+       fractions: list of fractions between 0 and 1.
+    '''
+    if not days or not days[0]:
+        return [[] for fraction in fractions]
+    if numpy is not None:
+        table = numpy.array([[math.inf if day is None else day
+                              for day in trial] for trial in days])
+        return numpy.quantile(table, fractions, axis=0,
+                              method="inverted_cdf").tolist()
+    found = []
+    columns = [sorted(math.inf if day is None else day for day in column)
+               for column in zip(*days)]
+    for fraction in fractions:
+        rank = max(1, math.ceil(fraction * len(days)))
+        found.append([column[rank - 1] for column in columns])
+    return found
+
+
+class Forecast:
+    '''Class holding the results of a capacity forecast: for every shelf,
+    case and room, and the library as a whole, the median day it fills up
+    and a confidence interval, in days from start. The library is full
+    when a book does not fit anywhere, even by pushing books along.
+    '''
+    def __init__(self, layout, days, start, horizon, confidence, added):
+        '''
+        Args:
+           layout: Layout of the library forecast.
+           days: dict of "shelf", "case", "room" and "library" to a list
+                 with, for each trial, the list of days each of those
+                 filled up (None if not within the horizon).
+           start: Date of day 0.
+           horizon: Number of days simulated.
+           confidence: Fraction of trials the intervals cover.
+           added: dict of genre to the number of books added in all trials.
+        '''
+        self.layout = layout
+        self.trial_count = len(days["library"])
+        self.start = start
+        self.horizon = horizon
+        self.confidence = confidence
+        low = (1 - confidence) / 2
+        fractions = [low, 0.5, 1 - low]
+        self.days = dict()
+        for level, nodes in (("shelf", layout.shelves),
+                             ("case", layout.cases),
+                             ("room", layout.rooms),
+                             ("library", [layout.library])):
+            columns = get_percentiles(days[level], fractions)
+            for i, node in enumerate(nodes):
+                self.days[id(node)] = tuple(column[i] for column in columns)
+        self.added = {genre: count / self.trial_count
+                      for genre, count in added.items()}
+
+    def get_days(self, node):
+        '''Returns (float, float, float) - Low end of the confidence
+                   interval, median and high end of the day node fills up,
+                   math.inf if after the horizon.'''
+        return self.days[id(node)]
+
+    def get_date(self, day):
+        '''Returns (date) - The date day days after the start, or None if
+                            day is after the horizon.'''
+        if day == math.inf:
+            return None
+        return self.start + datetime.timedelta(days=day)
+
+    def describe_node(self, node):
+        '''Returns (str) - When node fills up, in words.'''
+        days = self.get_days(node)
+        if days[2] == 0:
+            return "full now"
+        low, median, high = (self.get_date(day) or
+                             "after {}".format(self.get_date(self.horizon))
+                             for day in days)
+        if days[1] == math.inf:
+            text = "not full by {}".format(self.get_date(self.horizon))
+        else:
+            text = "full around {}".format(median)
+        return text + " ({:.0%} between {} and {})".format(
+            self.confidence, low, high)
+
+    def iter_lines(self, max_depth=3):
+        '''Generate the report lines, the library first and then each room,
+        case and shelf down to max_depth levels below the library.'''
+        yield "Forecast of {} trials up to {}:".format(
+            self.trial_count, self.get_date(self.horizon))
+        stack = [(self.layout.library, 0)]
+        while stack:
+            node, level = stack.pop()
+            yield "{} {} - {}".format("  " * level, node,
+                                      self.describe_node(node))
+            if level < max_depth and not isinstance(node, l.Shelf):
+                for child in reversed(node.children):
+                    stack.append((child, level + 1))
+        if self.added:
+            yield "Books added per trial by genre:"
+            for genre, count in sorted(self.added.items(),
+                                       key=lambda item: -item[1]):
+                yield "  {}: {:.1f}".format(genre, count)
+
+
+def forecast(library, books_per_month, trials=200, years=10, widths=None,
+             genres=None, confidence=0.9, seed=None, start=None):
+    '''Simulate adding books to the library and forecast when each shelf,
+    case and room fills up. Loads every room.
+
+    Returns (Forecast) - The fill days found.
+
+    Args:
+       library: The library to forecast, which is not changed.
+       books_per_month: Average number of books acquired per month.
+       trials: Number of Monte Carlo trials.
+       years: How far ahead to simulate.
+       widths: dict of book width to weight. Defaults to the widths of the
+               books in the library.
+       genres: dict of genre to weight. Defaults to the genres of the
+               books in the library.
+       confidence: Fraction of trials the interval reported covers.
+       seed: Seed for repeatable forecasts.
+       start: Date the simulation starts at, defaults to today.
+    '''
+    books = library.get_all_books()
+    if widths is None:
+        widths = count_values(books, "width", 1)
+    if genres is None:
+        genres = count_values(books, "genre", "Unknown")
+    stream = BookStream(books_per_month, widths, genres, seed)
+    layout = Layout(library)
+    horizon = years * 365.25
+    days = {"shelf": [], "case": [], "room": [], "library": []}
+    added = dict()
+    for i in range(trials):
+        trial = Trial(layout, stream.get_min_width())
+        for genre, count in trial.run(stream, horizon).items():
+            added[genre] = added.get(genre, 0) + count
+        for level in ("shelf", "case", "room"):
+            days[level].append(getattr(trial, level + "_days"))
+        days["library"].append([trial.library_day])
+    return Forecast(layout, days, start or datetime.date.today(), horizon,
+                    confidence, added)
+
+
+def parse_weights(text):
+    '''Returns (dict) - Weights from text such as "1=8,3=2". Keys are
+                        kept as text.'''
+    weights = dict()
+    for item in text.split(","):
+        key, _, weight = item.partition("=")
+        weights[key.strip()] = float(weight) if weight else 1.0
+    return weights
+
+
+def parse_command_line():
+    '''Parse command line arguments.
+
+    Return (dict) - Parsed command line arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description='Forecast when the shelves of a library fill up.')
+    parser.add_argument('file_name', help='Library JSON file')
+    parser.add_argument('--rate', dest='rate', type=float, required=True,
+                        help='Books acquired per month')
+    parser.add_argument('--trials', dest='trials', type=int, default=200,
+                        help='Number of simulated futures (default: 200)')
+    parser.add_argument('--years', dest='years', type=float, default=10,
+                        help='How far ahead to simulate (default: 10)')
+    parser.add_argument('--widths', dest='widths', default=None,
+                        help='Book widths and weights such as 1=8,3=2 '
+                             '(default: as in the library)')
+    parser.add_argument('--genres', dest='genres', default=None,
+                        help='Genres and weights such as Fiction=3,Horror=1 '
+                             '(default: as in the library)')
+    parser.add_argument('--confidence', dest='confidence', type=float,
+                        default=0.9,
+                        help='Confidence of the intervals (default: 0.9)')
+    parser.add_argument('--depth', dest='depth', type=int, default=2,
+                        help='Levels below the library to report: 1 rooms, '
+                             '2 cases, 3 shelves (default: 2)')
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help='Random seed for repeatable forecasts')
+    return parser.parse_args()
+
+
+def run_unit_tests():
+    '''Run unit tests of trials placing books like Library.add_book.'''
+    print("Running Forecast Unit Tests")
+    test_library = l.make_test_library(books=0)
+    rng = random.Random(4)
+    # Leave one space on each shelf, so wider books are pushed along.
+    for shelf in test_library.get_all_shelves_flattened():
+        while shelf.get_remaining_space() > 1:
+            width = min(rng.choice([1, 2]), shelf.get_remaining_space() - 1)
+            shelf.add_book(l.Book("Filler", "Author", 100, "Genre", width))
+    layout = Layout(test_library)
+    trial = Trial(layout, 1)
+    turned_away = 0
+    for i in range(20):
+        width = rng.choice([1, 2, 2, 3])
+        book = l.Book("Forecast {}".format(i), "Author", 100, "Genre", width)
+        shelf = test_library.add_book(book, note_copies=False)
+        assert(trial.add_book(width, float(i)) == (shelf is not None))
+        turned_away += shelf is None
+        books = [[book.width for book in reversed(shelf.children)]
+                 for shelf in layout.shelves]
+        assert(trial.books == books)
+        assert(trial.remaining == [shelf.get_remaining_space()
+                                   for shelf in layout.shelves])
+        # Pushing books along can free a little room on a full shelf,
+        # but it keeps the day it first filled up.
+        for shelf, day in enumerate(trial.shelf_days):
+            if trial.remaining[shelf] < 1:
+                assert(day is not None)
+    # Every shelf filled up and later books were turned away.
+    assert(trial.open_shelves == 0)
+    assert(turned_away > 0)
+    assert(all(day is not None for day in trial.room_days))
+
+    # Shelves already full count as full from the start.
+    trial = Trial(Layout(test_library), 1)
+    assert(trial.shelf_days == [0.0] * len(layout.shelves))
+    assert(trial.library_day is None)
+
+
+if __name__ == '__main__':
+    args = parse_command_line()
+    library = l.Library.load_from_file(args.file_name)
+    if library is None:
+        raise SystemExit("No library in " + args.file_name)
+    widths = None
+    if args.widths:
+        widths = {int(width): weight for width, weight
+                  in parse_weights(args.widths).items()}
+    genres = parse_weights(args.genres) if args.genres else None
+    result = forecast(library, args.rate, args.trials, args.years, widths,
+                      genres, args.confidence, args.seed)
+    render_lines(result.iter_lines(args.depth))
@@ -0,0 +1,322 @@
+'''Library History.
+Contains snapshots of a library's rooms, cases, shelves and books that are
+cheap enough to take before every change, undo and redo built on them,
+and previews of where adding a book would move other books.
+
+The tree is mirrored by nested tuples that are never changed: a
+container's shadow is (container, tuple of its children's shadows) and a
+book's shadow is (book, is_on_shelf, lent_to). When a change event touches
+a shelf a new shadow is made for the shelf and each container above it,
+sharing every other subtree with the previous version. Taking a snapshot
+is just keeping the current root shadow, and restoring one only visits
+the subtrees that differ from the current shadow.
+'''
+import gc
+import weakref
+import library as l
+
+# Number of changes that can be undone.
+MAX_UNDO = 100
+
+
+def make_shadow(node):
+    '''Returns (tuple) - Shadow of a book, or of a container and everything
+                         in it. Rooms still on disk are not loaded.'''
+    if isinstance(node, l.Book):
+        return (node, node.is_on_shelf, node.lent_to)
+    if isinstance(node, l.Room) and not node.is_loaded():
+        return (node, None)
+    return (node, tuple(make_shadow(child) for child in node.children))
+
+
+class History:
+    '''Class keeping the current shadow of a library up to date from its
+    change events, with stacks of snapshots to undo and redo.
+
+    Rooms that are still on disk are shadowed as (room, None). A room that
+    is loaded and changed before the next snapshot has no shadow of its
+    contents from before the change, so the undo history is started over.
+
+    A library keeps its own history (see get_history), which is freed
+    along with the library.
+    '''
+    def __init__(self, library):
+        self.library = library
+        self.shadows = dict()
+        self.root = self._build(library)
+        self.undo_stack = []
+        self.redo_stack = []
+        self.forgotten = False
+        library.add_listener(self.on_change)
+
+    def _build(self, container):
+        shadow = make_shadow(container)
+        self._register(shadow)
+        return shadow
+
+    def _register(self, shadow):
+        '''Remember the shadow of every container in a subtree.'''
+        if not isinstance(shadow[0], l.Book):
+            self.shadows[shadow[0]] = shadow
+            for child in shadow[1] or ():
+                self._register(child)
+
+    def _get_child_shadow(self, child):
+        if isinstance(child, l.Book):
+            return make_shadow(child)
+        shadow = self.shadows.get(child)
+        if shadow is None:
+            shadow = self._build(child)
+        return shadow
+
+    def on_change(self, event):
+        op = event["op"]
+        if op == "add_container":
+            self.refresh(event["parent"])
+        elif op in ("place_book", "move_book", "displace_book"):
+            self.refresh(event["shelf"])
+        elif op in ("lend", "return", "shelve"):
+            if event["book"].contained_in is not None:
+                self.refresh(event["book"].contained_in)
+
+    def refresh(self, container):
+        '''Make new shadows for container and each container above it.'''
+        while container is not None:
+            old = self.shadows.get(container)
+            if old is not None and old[1] is None:
+                # Loaded from disk and changed since the last snapshot.
+                self.undo_stack = []
+                self.redo_stack = []
+                self.forgotten = True
+            shadow = (container, tuple(self._get_child_shadow(child)
+                                       for child in container.children))
+            self.shadows[container] = shadow
+            container = getattr(container, "contained_in", None)
+        self.root = self.shadows[self.library]
+
+    def adopt_loaded_rooms(self):
+        '''Shadow the contents of rooms loaded from disk since the last
+        snapshot. Only safe while they are unchanged since loading.'''
+        if any(shadow[1] is None and shadow[0].is_loaded()
+               for shadow in self.root[1]):
+            for room in self.library.children:
+                if self.shadows[room][1] is None and room.is_loaded():
+                    self._build(room)
+            self.refresh(self.library)
+
+    def snapshot(self):
+        '''Returns (tuple) - The current state of the library.'''
+        return self.root
+
+    def restore(self, snapshot, notify=True):
+        '''Put the library back in the state of an earlier snapshot. Only
+        containers whose shadow differs are touched, and those are marked
+        as changed since the last save.
+
+        Args:
+           snapshot - Value returned by snapshot()
+           notify - If True send a "snapshot" event afterwards, telling
+                    other listeners that anything may have changed.
+        '''
+        if snapshot is self.root:
+            return
+        removed = []
+        placed = set()
+        self._restore(snapshot, self.root, removed, placed)
+        for node in removed:
+            if id(node) not in placed:
+                # Added after the snapshot was taken.
+                node.contained_in = None
+                if isinstance(node, l.Book) and node.is_on_shelf:
+                    node.is_on_shelf = False
+                    node.mark_changed()
+        self.root = snapshot
+        if notify:
+            self.library.emit("snapshot", library=self.library)
+
+    def _restore(self, target, current, removed, placed):
+        container = target[0]
+        self.shadows[container] = target
+        if target is current or target[1] is None:
+            return
+        current_children = dict()
+        if current is not None and current[1] is not None:
+            removed.extend(shadow[0] for shadow in current[1])
+            current_children = {id(shadow[0]): shadow
+                                for shadow in current[1]}
+
+        container.children = [shadow[0] for shadow in target[1]]
+        container.mark_changed()
+        for shadow in target[1]:
+            child = shadow[0]
+            child.contained_in = container
+            placed.add(id(child))
+            if isinstance(child, l.Book):
+                if (child.is_on_shelf, child.lent_to) != shadow[1:]:
+                    child.is_on_shelf, child.lent_to = shadow[1:]
+                    child.mark_changed()
+            else:
+                # A container that is not in the library at the moment is
+                # restored in full, since books may have left it since.
+                self._restore(shadow, current_children.get(id(child)),
+                              removed, placed)
+
+    def begin(self):
+        '''Returns (tuple) - Snapshot to pass to commit after a change.'''
+        self.adopt_loaded_rooms()
+        self.forgotten = False
+        return self.snapshot()
+
+    def commit(self, description, before):
+        '''Remember the state before a change so it can be undone. Does
+        nothing if the change left the library as it was.
+
+        Args:
+           description - What the change was, e.g. "Add Book"
+           before - Value returned by begin() before the change
+        '''
+        if self.root is before or self.forgotten:
+            return
+        self.undo_stack.append((description, before))
+        del self.undo_stack[:-MAX_UNDO]
+        self.redo_stack = []
+
+    def undo(self):
+        '''Undo the last change.
+
+        Returns (str) - Description of the change undone, or None if there
+                        is nothing to undo.
+        '''
+        if not self.undo_stack:
+            return None
+        description, snapshot = self.undo_stack.pop()
+        self.redo_stack.append((description, self.root))
+        self.restore(snapshot)
+        return description
+
+    def redo(self):
+        '''Redo the last change undone.
+
+        Returns (str) - Description of the change redone, or None if there
+                        is nothing to redo.
+        '''
+        if not self.redo_stack:
+            return None
+        description, snapshot = self.redo_stack.pop()
+        self.undo_stack.append((description, self.root))
+        self.restore(snapshot)
+        return description
+
+    def preview(self, change):
+        '''Run a change, then put the library back as it was. Other
+        listeners do not see the change's events.
+
+        The library's changed flags and content hashes are put back too.
+
+        Returns (object, list<dict>) - What change returned and the change
+                                       events it caused.
+
+        Args:
+           change - function taking no arguments that changes the library
+        '''
+        # Anything the change could touch must be shadowed beforehand,
+        # so load every room still on disk.
+        self.library.get_all_shelves_flattened()
+        before = self.begin()
+        events = []
+        sequence = self.library.get_sequence()
+        listeners = self.library.set_listeners([self.on_change,
+                                                events.append])
+        # Nothing is left flagged as changed since the last save.
+        with l.keep_changed_flags():
+            try:
+                result = change()
+            finally:
+                self.library.set_listeners(listeners)
+                self.library.set_sequence(sequence)
+                self.restore(before, notify=False)
+        return result, events
+
+
+def get_history(library):
+    '''Returns (History) - The history of library, started the first time
+                          it is needed.'''
+    if library._history is None:
+        library._history = History(library)
+    return library._history
+
+
+def get_index_contents(library):
+    '''Returns (list) - What the copy, facet, search, autocomplete and
+                        query indexes of library hold, building any that
+                        are not built yet.'''
+    import library_search
+
+    def ids(books):
+        return sorted(id(book) for book in books)
+
+    search = library_search.get_index(library)
+    tries = library_search.get_autocomplete_index(library)
+    return [{key: ids(books) for key, books in
+             library.get_copy_index().copies.items() if books},
+            {facet: dict(counts) for facet, counts in
+             library.get_facets().counts.items()},
+            {word: ids(books) for word, books in
+             search.books_by_word.items() if books},
+            [ids(tries.get_trie(field).items(
+                limit=tries.get_trie(field).count()))
+             for field in ("title", "author")],
+            [id(book) for book in library.query('genre == "Genre 1"')]]
+
+
+def run_unit_tests():
+    '''Run unit tests of undo, redo and preview on a small library.'''
+    print("Running History Unit Tests")
+    library = l.make_test_library()
+    history = get_history(library)
+    # Every index is listening while history restores snapshots.
+    initial = get_index_contents(library)
+    before = history.begin()
+    for i in range(5):
+        library.add_book(l.Book("New {}".format(i), "New Author", 100,
+                                "Genre 1", 2))
+    history.commit("Add Books", before)
+    added = get_index_contents(library)
+    assert(added != initial)
+    assert(history.undo() == "Add Books")
+    assert(get_index_contents(library) == initial)
+    assert(history.redo() == "Add Books")
+    assert(get_index_contents(library) == added)
+
+    # A preview leaves the library, its changed flags and its hashes as
+    # they were, including for books set back off their shelves.
+    first_shelf = library.get_all_shelves_flattened()[0]
+    pushed_along = first_shelf.children[-1]
+    pushed_along.set_on_shelf(False)
+    library.mark_saved()
+    content_hash = library.get_content_hash()
+    before = history.snapshot()
+    book = l.Book("Preview", "New Author", 100, "Genre 1", 3)
+    shelf, events = history.preview(
+        lambda: library.add_book(book, first_shelf, note_copies=False))
+    assert(shelf is first_shelf and not pushed_along.is_on_shelf)
+    assert(any(event["book"] is pushed_along for event in events))
+    assert(book.contained_in is None and history.snapshot() is before)
+    assert(not any(node.is_changed() for node in
+                   [library] + library.get_all_shelves_flattened() +
+                   library.get_all_books()))
+    assert(library.get_content_hash() == content_hash)
+    assert(library._content_hash is not None)
+
+    # The history is freed with its library.
+    def make_history():
+        library = l.make_test_library(books=10)
+        history = get_history(library)
+        before = history.begin()
+        library.add_book(l.Book("Freed", "New Author", 100, "Genre 1", 1))
+        history.commit("Add Book", before)
+        return weakref.ref(library), weakref.ref(history)
+
+    library_ref, history_ref = make_history()
+    gc.collect()
+    assert(library_ref() is None and history_ref() is None)
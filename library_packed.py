@@ -0,0 +1,379 @@
+'''Library Packed Catalog.
+Contains an export of a library to a compact read-only binary file, and a
+reader that memory maps the file and answers searches, counts and location
+lookups straight from the mapped bytes without creating any Book objects.
+Opening a packed catalog only reads its header, and every process opening
+the same file shares its pages.
+
+The file is made of fixed size little-endian records:
+   header       - HEADER
+   string table - (number of strings + 1) uint32 offsets into the string
+                  data, then the UTF-8 string data. Every label, title,
+                  author, genre, edition and borrower name is stored once.
+   containers   - CONTAINER records in depth first order, the library
+                  first. Books are stored in the same order, so the books
+                  beneath any container are a contiguous range of records.
+   books        - BOOK records
+   title order  - uint32 book numbers sorted by lower cased title
+   author order - uint32 book numbers sorted by lower cased author
+'''
+import bisect
+import mmap
+import struct
+import library as l
+
+PACKED_MAGIC = b"PLIBPACK"
+PACKED_VERSION = 1
+# Magic, version, then the number of strings, containers and books.
+HEADER = struct.Struct("<8sIIII")
+# Kind, parent container number (-1 for the library), label, width, width
+# of the books on it (shelves only), first book and number of books
+# beneath the container.
+CONTAINER = struct.Struct("<B3xiIIIII")
+# Title, author, genre, edition, borrower, pages, width, shelf container
+# number and flags.
+BOOK = struct.Struct("<IIIIIIIIB3x")
+BOOK_FIELDS = ["title", "author", "genre", "edition", "lent_to", "pages",
+               "width", "shelf", "flags"]
+OFFSET = struct.Struct("<I")
+# String number of a missing edition or borrower, and the page count of
+# a book whose pages are not a number.
+NO_STRING = 0xFFFFFFFF
+NO_PAGES = 0xFFFFFFFF
+ON_SHELF = 1
+
+KINDS = [l.Library, l.Room, l.Case, l.Shelf]
+KIND_NAMES = ["library", "room", "case", "shelf"]
+
+
+class StringTable:
+    '''Class numbering distinct strings as they are added.'''
+    def __init__(self):
+        self.numbers = dict()
+        self.strings = []
+
+    def add(self, text):
+        '''Returns (int) - The number of text, or NO_STRING for None.'''
+        if text is None:
+            return NO_STRING
+        text = str(text)
+        number = self.numbers.get(text)
+        if number is None:
+            number = len(self.strings)
+            self.numbers[text] = number
+            self.strings.append(text)
+        return number
+
+    def pack(self):
+        '''Returns (bytes) - The offsets followed by the string data.'''
+        data = [text.encode("utf-8") for text in self.strings]
+        offsets = [0]
+        for encoded in data:
+            offsets.append(offsets[-1] + len(encoded))
+        return (struct.pack("<{}I".format(len(offsets)), *offsets) +
+                b"".join(data))
+
+
+def get_pages(book):
+    '''Returns (int) - Page count of book, which older files may hold
+                       as text, or NO_PAGES.'''
+    pages = str(book.pages)
+    return int(pages) if pages.isdigit() and int(pages) < NO_PAGES \
+        else NO_PAGES
+
+
+def pack_library(library):
+    '''Returns (bytes) - library as a packed catalog. Loads every room.'''
+    strings = StringTable()
+    containers = []
+    books = []
+    # Container records are finished once every book beneath them is
+    # numbered, so keep them as lists until then.
+    nodes = [(library, -1)]
+    while nodes:
+        container, parent = nodes.pop()
+        if container is None:
+            containers[parent][6] = len(books) - containers[parent][5]
+            continue
+        number = len(containers)
+        is_shelf = isinstance(container, l.Shelf)
+        containers.append([KINDS.index(type(container)), parent,
+                           strings.add(container.label),
+                           container.width if is_shelf else 0,
+                           container.get_books_width() if is_shelf else 0,
+                           len(books), 0])
+        nodes.append((None, number))
+        if is_shelf:
+            for book in container.children:
+                books.append((strings.add(book.title),
+                              strings.add(book.author),
+                              strings.add(book.genre),
+                              strings.add(book.edition),
+                              strings.add(book.lent_to.name
+                                          if book.lent_to else None),
+                              get_pages(book), book.width, number,
+                              ON_SHELF if book.is_on_shelf else 0))
+        else:
+            for child in reversed(container.children):
+                nodes.append((child, number))
+
+    def get_order(field):
+        text = [strings.strings[book[field]].lower() for book in books]
+        order = sorted(range(len(books)), key=text.__getitem__)
+        return struct.pack("<{}I".format(len(order)), *order)
+
+    parts = [HEADER.pack(PACKED_MAGIC, PACKED_VERSION, len(strings.strings),
+                         len(containers), len(books)),
+             strings.pack()]
+    parts.extend(CONTAINER.pack(*record) for record in containers)
+    parts.extend(BOOK.pack(*record) for record in books)
+    parts.append(get_order(BOOK_FIELDS.index("title")))
+    parts.append(get_order(BOOK_FIELDS.index("author")))
+    return b"".join(parts)
+
+
+def export_packed(library, file_name):
+    '''Write library to file_name as a packed catalog, replacing it
+    atomically so open readers keep the old file.'''
+    l.write_file_atomically(file_name, pack_library(library))
+
+
+def is_packed(file_name):
+    '''Returns (bool) - True if file_name is a packed catalog.'''
+    try:
+        with open(file_name, "rb") as f:
+            return f.read(len(PACKED_MAGIC)) == PACKED_MAGIC
+    except OSError:
+        return False
+
+
+class PackedCatalog:
+    '''Class reading a packed catalog through a read-only memory map.
+    Books are referred to by their number, in library order; only the
+    values asked for are read from the file.
+    '''
+    def __init__(self, file_name):
+        '''
+        Args:
+           file_name: File written by export_packed.
+
+        Raises ValueError if file_name is not a packed catalog of this
+        version.
+        '''
+        self.file_name = file_name
+        with open(file_name, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, strings, containers, books = \
+            HEADER.unpack_from(self.buffer)
+        if magic != PACKED_MAGIC or version != PACKED_VERSION:
+            self.buffer.close()
+            raise ValueError("{} is not a packed library catalog".format(
+                file_name))
+        self.string_count = strings
+        self.container_count = containers
+        self.book_count = books
+        self.strings_at = HEADER.size
+        self.string_data_at = self.strings_at + (strings + 1) * OFFSET.size
+        end = OFFSET.unpack_from(self.buffer,
+                                 self.string_data_at - OFFSET.size)[0]
+        self.containers_at = self.string_data_at + end
+        self.books_at = self.containers_at + containers * CONTAINER.size
+        self.orders_at = {"title": self.books_at + books * BOOK.size}
+        self.orders_at["author"] = (self.orders_at["title"] +
+                                    books * OFFSET.size)
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_string(self, number):
+        '''Returns (str) - String number from the string table, or None.'''
+        if number == NO_STRING:
+            return None
+        start, end = struct.unpack_from("<2I", self.buffer,
+                                        self.strings_at + number * 4)
+        return str(self.buffer[self.string_data_at + start:
+                               self.string_data_at + end], "utf-8")
+
+    def get_container_record(self, number):
+        '''Returns (tuple) - The fields of a CONTAINER record.'''
+        return CONTAINER.unpack_from(self.buffer, self.containers_at +
+                                     number * CONTAINER.size)
+
+    def get_book_record(self, number):
+        '''Returns (tuple) - The fields of a BOOK record.'''
+        return BOOK.unpack_from(self.buffer,
+                                self.books_at + number * BOOK.size)
+
+    def _iter_records(self, record, start, end):
+        # Unpack straight from the mapped pages rather than a copy.
+        with memoryview(self.buffer) as view, view[start:end] as records:
+            yield from record.iter_unpack(records)
+
+    def iter_book_records(self):
+        '''Iterate over the BOOK records of every book, in order.'''
+        return self._iter_records(BOOK, self.books_at,
+                                  self.orders_at["title"])
+
+    def iter_container_records(self):
+        '''Iterate over the CONTAINER records, the library first.'''
+        return self._iter_records(CONTAINER, self.containers_at,
+                                  self.books_at)
+
+    def get_label(self):
+        '''Returns (str) - The label of the library.'''
+        return self.get_string(self.get_container_record(0)[2])
+
+    def get_book(self, number):
+        '''Returns (dict) - Everything stored about a book.'''
+        (title, author, genre, edition, lent_to, pages, width, shelf,
+         flags) = self.get_book_record(number)
+        return {"title": self.get_string(title),
+                "author": self.get_string(author),
+                "genre": self.get_string(genre),
+                "edition": self.get_string(edition),
+                "lent_to": self.get_string(lent_to),
+                "pages": pages if pages != NO_PAGES else None,
+                "width": width,
+                "is_on_shelf": bool(flags & ON_SHELF)}
+
+    def get_location(self, number):
+        '''Returns (list<str>) - Labels of the room, case and shelf a book
+                                 is in.'''
+        labels = []
+        container = self.get_book_record(number)[7]
+        while container > 0:
+            record = self.get_container_record(container)
+            labels.append(self.get_string(record[2]))
+            container = record[1]
+        labels.reverse()
+        return labels
+
+    def _get_ordered_key(self, field, position):
+        number = OFFSET.unpack_from(self.buffer, self.orders_at[field] +
+                                    position * OFFSET.size)[0]
+        index = BOOK_FIELDS.index(field)
+        return self.get_string(self.get_book_record(number)[index]).lower()
+
+    def _find_prefix_range(self, field, prefix):
+        '''Returns (int, int) - Positions in the field's order of the first
+                                book starting with prefix and the one after
+                                the last.'''
+        prefix = prefix.lower()
+        if not prefix:
+            return 0, self.book_count
+        keys = _OrderedKeys(self, field)
+        start = bisect.bisect_left(keys, prefix)
+        # Every key starting with prefix sorts before prefix followed by
+        # the highest character.
+        end = bisect.bisect_left(keys, prefix + "\U0010ffff", start)
+        return start, end
+
+    def count_prefix(self, field, prefix):
+        '''Returns (int) - Number of books whose "title" or "author" starts
+                           with prefix, ignoring case.'''
+        start, end = self._find_prefix_range(field, prefix)
+        return end - start
+
+    def find_prefix(self, field, prefix, offset=0, limit=10):
+        '''Return list<int>: Up to limit book numbers whose "title" or
+        "author" starts with prefix ignoring case, in order of that field,
+        skipping the first offset of them.'''
+        start, end = self._find_prefix_range(field, prefix)
+        start = min(start + offset, end)
+        end = min(end, start + limit)
+        return list(struct.unpack_from("<{}I".format(end - start),
+                                       self.buffer, self.orders_at[field] +
+                                       start * OFFSET.size))
+
+    def search(self, field, text):
+        '''Return list<int>: Numbers of the books whose "title", "author"
+        or "genre" contains text, ignoring case, in library order. Each
+        distinct string is only compared once.'''
+        index = BOOK_FIELDS.index(field)
+        text = text.lower()
+        matches = set(number for number in range(self.string_count)
+                      if text in self.get_string(number).lower())
+        return [number for number, record
+                in enumerate(self.iter_book_records())
+                if record[index] in matches]
+
+    def count_by(self, facet):
+        '''Returns (dict) - Number of books by each value of one of
+                            library.FACETS.'''
+        counts = dict()
+        if facet == "room":
+            # Rooms own contiguous ranges of books. Like the other facets,
+            # rooms without books are not counted.
+            for record in self.iter_container_records():
+                if record[0] == KIND_NAMES.index("room") and record[6]:
+                    label = self.get_string(record[2])
+                    counts[label] = counts.get(label, 0) + record[6]
+            return counts
+        if facet == "status":
+            for record in self.iter_book_records():
+                if record[4] != NO_STRING:
+                    status = "lent"
+                elif record[8] & ON_SHELF:
+                    status = "on_shelf"
+                else:
+                    status = "off_shelf"
+                counts[status] = counts.get(status, 0) + 1
+            return counts
+        index = BOOK_FIELDS.index(facet)
+        by_number = dict()
+        for record in self.iter_book_records():
+            by_number[record[index]] = by_number.get(record[index], 0) + 1
+        return {self.get_string(number): count
+                for number, count in by_number.items()}
+
+    def count_containers(self, kind):
+        '''Returns (int) - Number of "room", "case" or "shelf" containers.'''
+        kind = KIND_NAMES.index(kind)
+        return sum(1 for record in self.iter_container_records()
+                   if record[0] == kind)
+
+    def get_free_space(self):
+        '''Returns (int) - Space left on every shelf together.'''
+        shelf = KIND_NAMES.index("shelf")
+        return sum(record[3] - record[4]
+                   for record in self.iter_container_records()
+                   if record[0] == shelf)
+
+
+class _OrderedKeys:
+    '''Sequence of the lower cased keys of a field in sorted order, read
+    from the file as bisect asks for them.'''
+    def __init__(self, catalog, field):
+        self.catalog = catalog
+        self.field = field
+
+    def __len__(self):
+        return self.catalog.book_count
+
+    def __getitem__(self, position):
+        return self.catalog._get_ordered_key(self.field, position)
+
+
+def run_unit_tests():
+    '''Run unit tests comparing a packed catalog with its library.'''
+    import os
+    import tempfile
+    print("Running Packed Catalog Unit Tests")
+    library = l.make_test_library()
+    library.add_room(l.Room("Empty Room"))
+    reader = l.Person("Reader")
+    library.add_borrower(reader)
+    library.get_all_books()[4].lend_to(reader)
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "library.packed")
+        export_packed(library, file_name)
+        with PackedCatalog(file_name) as catalog:
+            for facet in l.FACETS:
+                assert(catalog.count_by(facet) ==
+                       library.get_facet_counts(facet))
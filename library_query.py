@@ -0,0 +1,504 @@
+'''Library Queries.
+Contains a small query language for finding books, for example
+
+    genre == "Fiction" and pages > 300 and room == "Main Room" and not lent
+
+and a planner that answers the most selective indexable part of a query
+from an index before filtering the remaining books.
+
+Fields: title, author, genre, borrower, room, case, shelf (text);
+pages, width (numbers); lent, on_shelf (true/false).
+Operators: == != < <= > >= and "contains" (text only). Conditions can be
+combined with "and", negated with "not" and grouped with parentheses.
+Text comparisons ignore case.
+'''
+import bisect
+import re
+import weakref
+
+TEXT_FIELDS = ["title", "author", "genre", "borrower", "room", "case", "shelf"]
+NUMBER_FIELDS = ["pages", "width"]
+BOOLEAN_FIELDS = ["lent", "on_shelf"]
+OPERATORS = ["==", "!=", "<", "<=", ">", ">=", "contains"]
+
+TOKEN_PATTERN = re.compile(r'''\s*(?:
+    (?P<op>==|!=|<=|>=|<|>)|
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+    (?P<number>-?\d+)|
+    (?P<word>[A-Za-z_]+)|
+    (?P<paren>[()]))''', re.VERBOSE)
+
+
+class QueryError(ValueError):
+    '''Raised when a query can not be parsed.'''
+    pass
+
+
+def get_field(book, field):
+    '''Get the value a query field has for a book.'''
+    if field in ("room", "case", "shelf"):
+        location = book.get_full_location()
+        depth = ["room", "case", "shelf"].index(field) + 1
+        if len(location) > depth + 1:
+            return location[depth].label
+        return None
+    if field == "borrower":
+        return book.lent_to.name if book.lent_to else None
+    if field == "lent":
+        return book.lent_to is not None
+    if field == "on_shelf":
+        return book.is_on_shelf
+    if field in NUMBER_FIELDS:
+        return get_number(getattr(book, field))
+    return getattr(book, field)
+
+
+def get_number(value):
+    '''Returns (int) - value as an integer, or None if it is not one. Older
+                       library files sometimes hold numbers as strings.'''
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+
+class Condition:
+    '''A single comparison of a book field against a value.'''
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def matches(self, book):
+        value = get_field(book, self.field)
+        if self.field in BOOLEAN_FIELDS:
+            return bool(value) == self.value
+        if value is None:
+            return self.op == "!="
+        if self.field in TEXT_FIELDS:
+            value = value.lower()
+        if self.op == "==":
+            return value == self.value
+        if self.op == "!=":
+            return value != self.value
+        if self.op == "contains":
+            return self.value in value
+        if self.op == "<":
+            return value < self.value
+        if self.op == "<=":
+            return value <= self.value
+        if self.op == ">":
+            return value > self.value
+        return value >= self.value
+
+    def __repr__(self):
+        if self.field in BOOLEAN_FIELDS:
+            return self.field if self.value else "not " + self.field
+        return "{} {} {!r}".format(self.field, self.op, self.value)
+
+
+class Not:
+    '''Negation of a condition or group of conditions.'''
+    def __init__(self, expression):
+        self.expression = expression
+
+    def matches(self, book):
+        return not self.expression.matches(book)
+
+    def __repr__(self):
+        return "not ({!r})".format(self.expression)
+
+
+class And:
+    '''Conjunction of conditions.'''
+    def __init__(self, expressions):
+        self.expressions = expressions
+
+    def matches(self, book):
+        return all(e.matches(book) for e in self.expressions)
+
+    def __repr__(self):
+        return " and ".join(repr(e) for e in self.expressions)
+
+
+def tokenize(text):
+    '''Split query text into (kind, value) tokens.'''
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if not match:
+            raise QueryError("Unexpected text: " + text[position:])
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        elif kind == "number":
+            value = int(value)
+        elif kind == "word":
+            value = value.lower()
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    '''Recursive descent parser turning tokens into expressions.'''
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        if token[0] is None:
+            raise QueryError("Query ended unexpectedly")
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError("Empty query")
+        expression = self.parse_and()
+        if self.peek()[0] is not None:
+            raise QueryError("Unexpected {!r}".format(self.peek()[1]))
+        return expression
+
+    def parse_and(self):
+        expressions = [self.parse_term()]
+        while self.peek() == ("word", "and"):
+            self.take()
+            expressions.append(self.parse_term())
+        if len(expressions) == 1:
+            return expressions[0]
+        return And(expressions)
+
+    def parse_term(self):
+        kind, value = self.take()
+        if (kind, value) == ("word", "not"):
+            term = self.parse_term()
+            if isinstance(term, Condition) and term.field in BOOLEAN_FIELDS:
+                return Condition(term.field, "==", not term.value)
+            return Not(term)
+        if (kind, value) == ("paren", "("):
+            expression = self.parse_and()
+            if self.take() != ("paren", ")"):
+                raise QueryError("Expected )")
+            return expression
+        if kind != "word":
+            raise QueryError("Expected a field name but got {!r}".format(
+                value))
+        return self.parse_condition(value)
+
+    def parse_condition(self, field):
+        if field in BOOLEAN_FIELDS:
+            if self.peek()[0] != "op":
+                return Condition(field, "==", True)
+            op = self.take()[1]
+            kind, value = self.take()
+            if op not in ("==", "!=") or value not in ("true", "false"):
+                raise QueryError("{} can only be compared with == or != "
+                                 "to true or false".format(field))
+            return Condition(field, "==", (value == "true") == (op == "=="))
+        if field not in TEXT_FIELDS and field not in NUMBER_FIELDS:
+            raise QueryError("Unknown field {!r}".format(field))
+
+        kind, op = self.take()
+        if kind != "op" and (kind, op) != ("word", "contains"):
+            raise QueryError("Expected an operator after {}".format(field))
+        kind, value = self.take()
+        if field in NUMBER_FIELDS:
+            if kind != "number" or op == "contains":
+                raise QueryError("{} must be compared to a number".format(
+                    field))
+        elif kind == "string":
+            value = value.lower()
+        else:
+            raise QueryError("{} must be compared to a quoted string".format(
+                field))
+        return Condition(field, op, value)
+
+
+class BookIndex:
+    '''Indexes over every book in a library, used by the query planner:
+    hash tables on genre and author, an array of books sorted by pages and
+    the range of positions each room, case and shelf covers in the list
+    of books in shelf order.
+
+    Kept current by listening to the library's change events. The hash
+    tables and the pages array are updated as books are placed and
+    displaced. The shelf order is worked out again when it is next needed
+    after books were placed or moved. Lending, returning and shelving
+    books changes none of them.
+    '''
+    def __init__(self, library):
+        self.library = weakref.ref(library)
+        self.by_genre = dict()
+        self.by_author = dict()
+        self.pages = []
+        self.books_by_pages = []
+        self.order = None
+        for book in library.get_all_books():
+            self.add(book)
+        library.add_listener(self.on_change)
+
+    def add(self, book):
+        '''Add a book to the hash tables and the pages array.'''
+        self.by_genre.setdefault(book.genre.lower(), dict())[id(book)] = book
+        self.by_author.setdefault(book.author.lower(),
+                                  dict())[id(book)] = book
+        pages = get_number(book.pages)
+        if pages is not None:
+            i = bisect.bisect_right(self.pages, pages)
+            self.pages.insert(i, pages)
+            self.books_by_pages.insert(i, book)
+
+    def remove(self, book):
+        '''Remove a book from the hash tables and the pages array.'''
+        for index, key in ((self.by_genre, book.genre.lower()),
+                           (self.by_author, book.author.lower())):
+            books = index.get(key, dict())
+            books.pop(id(book), None)
+            if not books:
+                index.pop(key, None)
+        pages = get_number(book.pages)
+        if pages is not None:
+            for i in range(bisect.bisect_left(self.pages, pages),
+                           bisect.bisect_right(self.pages, pages)):
+                if self.books_by_pages[i] is book:
+                    del self.pages[i]
+                    del self.books_by_pages[i]
+                    break
+
+    def on_change(self, event):
+        if event["op"] in ("place_book", "move_book"):
+            self.add(event["book"])
+            self.order = None
+        elif event["op"] == "displace_book":
+            # Added again when the cascade moves it to another shelf;
+            # a book that finds no shelf has left the library.
+            self.remove(event["book"])
+            self.order = None
+        elif event["op"] == "add_container":
+            for book in event["container"].get_leaf_nodes():
+                self.add(book)
+            self.order = None
+        elif event["op"] == "snapshot":
+            # Rebuilt when next needed.
+            event["library"]._query_index = None
+            event["library"].remove_listener(self.on_change)
+
+    def get_order(self):
+        '''Returns (list<Book>, dict, dict) - Every book in shelf order,
+        the position of each book by id and the ranges of positions of
+        each room, case and shelf by field and lower case label.'''
+        if self.order is None:
+            books = []
+            ranges = {"room": dict(), "case": dict(), "shelf": dict()}
+
+            def add_range(field, container, start):
+                ranges[field].setdefault(container.label.lower(),
+                                         []).append((start, len(books)))
+
+            for room in self.library().get_rooms():
+                room_start = len(books)
+                for case in room.get_cases():
+                    case_start = len(books)
+                    for shelf in case.get_shelves():
+                        shelf_start = len(books)
+                        books.extend(shelf.get_books())
+                        add_range("shelf", shelf, shelf_start)
+                    add_range("case", case, case_start)
+                add_range("room", room, room_start)
+            positions = {id(book): i for i, book in enumerate(books)}
+            self.order = books, positions, ranges
+        return self.order
+
+    def get_books(self):
+        '''Returns (list<Book>) - Every book in shelf order.'''
+        return self.get_order()[0]
+
+    def get_access_paths(self, conditions):
+        '''Work out how each indexable condition could be answered.
+
+        Return list<(int, str, function, list)>: For each possible index
+                lookup the number of books it returns, a description, a
+                function returning those books in shelf order and the
+                conditions the lookup answers exactly.
+        '''
+        paths = []
+        low, high = None, None
+        page_conditions = []
+        for condition in conditions:
+            field, op, value = condition.field, condition.op, condition.value
+            if field in ("genre", "author") and op == "==":
+                index = self.by_genre if field == "genre" else self.by_author
+                books = index.get(value, dict())
+                paths.append((len(books), field + " hash index",
+                              lambda books=books: sorted(
+                                  books.values(), key=self.get_position),
+                              [condition]))
+            elif field in ("room", "case", "shelf") and op == "==":
+                ranges = self.get_order()[2][field].get(value, [])
+                count = sum(end - start for start, end in ranges)
+                paths.append((count, field + " range index",
+                              lambda ranges=ranges: [
+                                  book for start, end in ranges
+                                  for book in self.get_books()[start:end]],
+                              [condition]))
+            elif field == "pages" and op not in ("!=", "contains"):
+                page_conditions.append(condition)
+                if op in ("==", ">="):
+                    bound = bisect.bisect_left(self.pages, value)
+                elif op == ">":
+                    bound = bisect.bisect_right(self.pages, value)
+                if op in ("==", ">=", ">"):
+                    low = bound if low is None else max(low, bound)
+                if op in ("==", "<="):
+                    bound = bisect.bisect_right(self.pages, value)
+                elif op == "<":
+                    bound = bisect.bisect_left(self.pages, value)
+                if op in ("==", "<=", "<"):
+                    high = bound if high is None else min(high, bound)
+
+        if page_conditions:
+            low = 0 if low is None else low
+            high = len(self.pages) if high is None else max(low, high)
+            paths.append((high - low, "pages sorted index",
+                          lambda: sorted(self.books_by_pages[low:high],
+                                         key=self.get_position),
+                          page_conditions))
+        return paths
+
+    def get_position(self, book):
+        '''Returns (int) - Where book is in the list of books in shelf order.
+        '''
+        return self.get_order()[1][id(book)]
+
+
+class Query:
+    '''Class representing a parsed query.'''
+    def __init__(self, text):
+        self.text = text
+        self.expression = Parser(text).parse()
+
+    def plan(self, index):
+        '''Choose how to run the query against index: the index lookup
+        returning the fewest books, or a full scan if nothing is indexable.
+
+        Return (int, str, function, list): Number of books read,
+                description of the access path, function returning the
+                candidate books and the conditions still to check.
+        '''
+        if isinstance(self.expression, And):
+            parts = self.expression.expressions
+        else:
+            parts = [self.expression]
+        conditions = [part for part in parts if isinstance(part, Condition)]
+        paths = index.get_access_paths(conditions)
+        if not paths:
+            return (len(index.get_books()), "full scan", index.get_books,
+                    parts)
+
+        count, description, lookup, answered = min(paths,
+                                                   key=lambda path: path[0])
+        description += " on " + " and ".join(repr(c) for c in answered)
+        remaining = [part for part in parts if part not in answered]
+        return count, description, lookup, remaining
+
+    def run(self, index):
+        '''Return list<Book>: Books matching the query, in shelf order.'''
+        count, description, lookup, remaining = self.plan(index)
+        return [book for book in lookup()
+                if all(part.matches(book) for part in remaining)]
+
+    def explain(self, index):
+        '''Return (str): Description of the plan chosen for this query.'''
+        count, description, lookup, remaining = self.plan(index)
+        lines = ["Query: " + repr(self.expression),
+                 "Access: {} ({} of {} books)".format(
+                     description, count, len(index.get_books()))]
+        if remaining:
+            lines.append("Filter: " + " and ".join(repr(part)
+                                                   for part in remaining))
+        return "\n".join(lines)
+
+
+def get_index(library):
+    '''Returns (BookIndex) - The index of library, built the first time it
+                            is needed.'''
+    if library._query_index is None:
+        library._query_index = BookIndex(library)
+    return library._query_index
+
+
+def run_query(library, text):
+    '''Return list<Book>: Books in library matching the query text.'''
+    return Query(text).run(get_index(library))
+
+
+def explain_query(library, text):
+    '''Return (str): The plan that would be used to run a query.'''
+    return Query(text).explain(get_index(library))
+
+
+def run_unit_tests():
+    '''Run unit tests checking queries on every field against a scan of
+    every book.'''
+    import library as l
+    print("Running Query Unit Tests")
+    library = l.make_test_library()
+    books = library.get_all_books()
+    reader = l.Person("Reader")
+    library.add_borrower(reader)
+    for book in books[::5]:
+        book.lend_to(reader)
+    for book in books[1::7]:
+        book.set_on_shelf(False)
+
+    queries = []
+    for field in TEXT_FIELDS:
+        for value in ("Genre 1", "Author 3", "Title 12", "Room 2", "Case 1",
+                      "Shelf 3", "Reader", "1"):
+            queries += ['{} == "{}"'.format(field, value.lower()),
+                        '{} != "{}"'.format(field, value),
+                        '{} contains "{}"'.format(field, value)]
+    for field in NUMBER_FIELDS:
+        for value in (1, 2, 150, 300):
+            queries += ["{} {} {}".format(field, op, value)
+                        for op in OPERATORS if op != "contains"]
+    for field in BOOLEAN_FIELDS:
+        queries += [field, "not " + field, field + " == false"]
+    queries += ['genre == "Genre 2" and pages > 200 and not lent',
+                'room == "Room 1" and author == "Author 0" and on_shelf',
+                'not (shelf == "Shelf 2" and pages < 150)']
+
+    def check_queries():
+        books = library.get_all_books()
+        for text in queries:
+            expression = Query(text).expression
+            expected = [id(book) for book in books
+                        if expression.matches(book)]
+            assert([id(book) for book in run_query(library, text)] ==
+                   expected)
+
+    check_queries()
+    # Lending and returning books leaves the index as it is.
+    index = get_index(library)
+    order = index.get_order()
+    books[2].lend_to(reader)
+    books[5].return_from_borrower()
+    assert(get_index(library) is index and index.get_order() is order)
+    check_queries()
+    # Books pushed along the shelves to make room are followed.
+    for i in range(6):
+        library.add_book(l.Book("New {}".format(i), "Author 3", 150 + i,
+                                "Genre 1", 3), books[0].contained_in)
+    assert(get_index(library) is index)
+    check_queries()
@@ -0,0 +1,127 @@
+'''Library Rendering.
+Contains a renderer that writes lines of text, such as the layout of a
+library, to a text stream in as few writes as possible. Lines can be
+shown a page at a time, and written to a file instead of the screen.
+'''
+import sys
+
+# Characters collected before they are written when not paginating.
+BUFFER_SIZE = 1 << 20
+
+
+def ask_to_continue():
+    '''Pause between pages. Returns (bool) - False if the user wants to
+                                             stop.'''
+    return input("-- More: press Enter to continue or q to stop --") != "q"
+
+
+class Renderer:
+    '''Class writing lines to a text stream. Lines are collected and
+    written together: a page at a time when paginating, otherwise in
+    writes of about BUFFER_SIZE characters.
+    '''
+    def __init__(self, stream=None, page_size=None, pause=ask_to_continue):
+        '''
+        Args:
+           stream: Text stream to write to. Defaults to sys.stdout as it is
+                   when render is called.
+           page_size: Number of lines per page, or None to write every line
+                      without pausing.
+           pause: Function called between pages, returning False to stop.
+        '''
+        self.stream = stream
+        self.page_size = page_size
+        self.pause = pause
+
+    def render(self, lines):
+        '''Write lines, each followed by a new line.
+
+        Returns (int) - Number of lines written, which is less than the
+                        number of lines if the user stopped paginating.
+        Args:
+           lines: Iterable of strings without new lines.
+        '''
+        stream = self.stream if self.stream is not None else sys.stdout
+        buffer = []
+        buffered = 0
+        written = 0
+        for line in lines:
+            if self.page_size and len(buffer) >= self.page_size:
+                stream.write("".join(buffer))
+                stream.flush()
+                written += len(buffer)
+                buffer = []
+                if not self.pause():
+                    return written
+            buffer.append(line + "\n")
+            buffered += len(line) + 1
+            if not self.page_size and buffered >= BUFFER_SIZE:
+                stream.write("".join(buffer))
+                written += len(buffer)
+                buffer = []
+                buffered = 0
+        stream.write("".join(buffer))
+        stream.flush()
+        return written + len(buffer)
+
+
+def render_lines(lines, stream=None):
+    '''Write lines to stream, or to sys.stdout, without pausing.'''
+    return Renderer(stream).render(lines)
+
+
+def render_to_file(lines, file_name):
+    '''Write lines to a text file, replacing it.'''
+    with open(file_name, "wt") as f:
+        return Renderer(f).render(lines)
+
+
+def run_unit_tests():
+    '''Run unit tests rendering the layout of make_test_library.'''
+    import io
+    import os
+    import tempfile
+    import library
+    print("Running Render Unit Tests")
+
+    class CountingStream(io.StringIO):
+        writes = 0
+
+        def write(self, text):
+            self.writes += 1
+            return super().write(text)
+
+    test_library = library.make_test_library()
+    lines = list(test_library.iter_describe())
+    stream = CountingStream()
+    assert(render_lines(test_library.iter_describe(), stream) == len(lines))
+    output = stream.getvalue().split("\n")
+    assert(output[-1] == "" and output[:-1] == lines)
+    assert(output[:4] == [" Library: Test Library",
+                          "   Room: Room 1",
+                          "     Case: Case 1",
+                          "       Shelf: Shelf 1 (0 of 10 spaces available)"])
+    assert("         Title 0" in output)
+    assert(len(output) - 1 == 1 + 2 + 4 + 12 + 50)
+    # Everything fits in one write without paginating.
+    assert(stream.writes == 1)
+
+    pauses = []
+
+    def pause():
+        pauses.append(True)
+        return len(pauses) < 2
+
+    stream = CountingStream()
+    written = Renderer(stream, 10, pause).render(lines)
+    # Stopped at the second pause, after two pages.
+    assert(written == 20 and len(pauses) == 2 and stream.writes == 2)
+    assert(stream.getvalue().split("\n")[:-1] == lines[:20])
+    stream = io.StringIO()
+    assert(Renderer(stream, 100, pause).render(lines) == len(lines))
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "layout.txt")
+        assert(render_to_file(lines, file_name) == len(lines))
+        with open(file_name) as f:
+            assert(f.read().split("\n")[:-1] == lines)
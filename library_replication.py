@@ -0,0 +1,544 @@
+'''Library Replication.
+Contains classes for publishing the change events of a Library (see
+Library.add_listener) as a feed of json lines, and for keeping read only
+replicas of the library current by applying that feed. The feed can be
+shared through a log file or a local socket.
+usage info: python library_replication.py --help
+'''
+import argparse
+import collections
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import library as l
+
+
+def get_path(node):
+    '''Get the position of a Room, Case, Shelf or Book in its library.
+
+    Return list<int>: Index of each container from the library down to,
+                      and including, node.
+    '''
+    path = []
+    while getattr(node, "contained_in", None) is not None:
+        parent = node.contained_in
+        for i, child in enumerate(parent.children):
+            if child is node:
+                path.insert(0, i)
+                break
+        node = parent
+    return path
+
+
+def get_node(library, path):
+    '''Find the Room, Case, Shelf or Book at path in library.'''
+    node = library
+    for index in path:
+        node = node.children[index]
+    return node
+
+
+def encode_object(o):
+    '''Returns (dict) - json friendly representation of a library object.'''
+    return json.loads(json.dumps(o, cls=l.LibraryJSONEncoder))
+
+
+def encode_event(event):
+    '''Turn a change event, which refers to library objects, into a json
+    friendly dict that refers to them by path instead. Must be called
+    while the library is still in the state the event describes.
+    '''
+    op = event["op"]
+    encoded = {"seq": event["seq"], "op": op}
+    if op == "snapshot":
+        encoded["library"] = encode_object(event["library"])
+    elif op == "add_container":
+        encoded["parent"] = get_path(event["parent"])
+        encoded["position"] = event["position"]
+        encoded["container"] = encode_object(event["container"])
+    elif op in ("place_book", "move_book"):
+        encoded["shelf"] = get_path(event["shelf"])
+        encoded["position"] = event["position"]
+        if op == "place_book":
+            encoded["book"] = encode_object(event["book"])
+        else:
+            encoded["moved_from"] = get_path(event["moved_from"])
+            encoded["title"] = event["book"].title
+            encoded["author"] = event["book"].author
+    elif op == "displace_book":
+        encoded["shelf"] = get_path(event["shelf"])
+    elif op in ("lend", "return", "shelve"):
+        encoded["book"] = get_path(event["book"])
+        if op == "lend":
+            encoded["borrower"] = event["borrower"].name
+        elif op == "shelve":
+            encoded["is_on_shelf"] = event["is_on_shelf"]
+    elif op == "add_borrower":
+        encoded["name"] = event["person"].name
+    return encoded
+
+
+def make_snapshot_event(library):
+    '''Returns (dict) - Encoded event carrying the whole library as of its
+                        current sequence number.'''
+    return encode_event({"seq": library.get_sequence(), "op": "snapshot",
+                         "library": library})
+
+
+class ChangeLog:
+    '''Class appending the change events of a library to a json lines file.
+
+    When created it continues the sequence numbers already in the file and
+    logs a "snapshot" event with the whole library, so replicas reading
+    the log recover even if the library was reloaded without saving.
+    '''
+    def __init__(self, library, file_name):
+        self.library = library
+        self.file_name = file_name
+        library.set_sequence(max(library.get_sequence(),
+                                 read_last_sequence(file_name)))
+        self.f = open(file_name, "at")
+        library.add_listener(self.write_event)
+        library.emit("snapshot", library=library)
+
+    def write_event(self, event):
+        if event["op"] == "snapshot":
+            encoded = make_snapshot_event(self.library)
+            encoded["seq"] = event["seq"]
+        else:
+            encoded = encode_event(event)
+        self.f.write(json.dumps(encoded) + "\n")
+        self.f.flush()
+
+    def write_checkpoint(self, file_name):
+        '''Save the library with its sequence number and the current end of
+        the log, so a replica can start there instead of reading the log
+        from the beginning.
+        '''
+        checkpoint = make_snapshot_event(self.library)
+        checkpoint["log_offset"] = self.f.tell()
+        l.write_file_atomically(file_name, json.dumps(checkpoint).encode())
+
+    def close(self):
+        self.library.remove_listener(self.write_event)
+        self.f.close()
+
+
+def read_last_sequence(file_name):
+    '''Returns (int) - The last sequence number in a change log, or 0.'''
+    try:
+        with open(file_name, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            # Read backwards until the last complete line is found.
+            chunk = b""
+            position = end
+            while position > 0:
+                step = min(4096, position)
+                position -= step
+                f.seek(position)
+                chunk = f.read(step) + chunk
+                lines = chunk.rstrip(b"\n").split(b"\n")
+                if len(lines) > 1 or position == 0:
+                    return json.loads(lines[-1])["seq"] if lines[-1] else 0
+    except (OSError, ValueError, KeyError):
+        pass
+    return 0
+
+
+class FeedTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FeedServer:
+    '''Class serving the change events of a library on a local TCP socket.
+
+    A connecting replica sends one json line {"after": seq} with the last
+    sequence number it has applied, gets every event after that (starting
+    with a snapshot if it is too far behind) and then live events.
+    '''
+    def __init__(self, library, host="127.0.0.1", port=0, max_history=10000):
+        self.library = library
+        self.max_history = max_history
+        self.lock = threading.Lock()
+        self.clients = []
+        self.snapshot = make_snapshot_event(library)
+        self.history = collections.deque()
+
+        feed = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline() or b"{}")
+                feed.add_client(self.connection, request.get("after", 0))
+                # Keep the connection open until the replica goes away.
+                while self.rfile.readline():
+                    pass
+                feed.remove_client(self.connection)
+
+        self.server = FeedTCPServer((host, port), Handler)
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        library.add_listener(self.send_event)
+
+    def add_client(self, connection, after):
+        with self.lock:
+            lines = []
+            if after < self.snapshot["seq"]:
+                lines.append(self.snapshot)
+            for encoded in self.history:
+                if encoded["seq"] > after:
+                    lines.append(encoded)
+            if self._send(connection, lines):
+                self.clients.append(connection)
+
+    def remove_client(self, connection):
+        with self.lock:
+            if connection in self.clients:
+                self.clients.remove(connection)
+
+    def send_event(self, event):
+        if event["op"] == "snapshot":
+            encoded = make_snapshot_event(self.library)
+        else:
+            encoded = encode_event(event)
+        with self.lock:
+            if (len(self.history) >= self.max_history and
+                    event["op"] not in ("displace_book", "move_book")):
+                # Start over from a snapshot rather than keep every event.
+                # Not while add_book is moving books along the shelves,
+                # since the snapshot would leave out the displaced books
+                # that later move_book events place.
+                self.snapshot = make_snapshot_event(self.library)
+                self.history.clear()
+            else:
+                self.history.append(encoded)
+            for connection in self.clients[:]:
+                if not self._send(connection, [encoded]):
+                    self.clients.remove(connection)
+
+    @staticmethod
+    def _send(connection, events):
+        data = "".join(json.dumps(encoded) + "\n" for encoded in events)
+        try:
+            connection.sendall(data.encode())
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        '''Stop serving, ending the feed of every connected replica.'''
+        self.library.remove_listener(self.send_event)
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            for connection in self.clients:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.clients = []
+
+
+class ReplicaError(Exception):
+    '''Raised when a replica is given an event it cannot apply, such as
+    one that skips sequence numbers.'''
+    pass
+
+
+class Replica:
+    '''Class keeping a read only copy of a library by applying its
+    change events in sequence order.
+    '''
+    def __init__(self, library=None, sequence=0):
+        self.library = library
+        self.sequence = sequence
+        # Books forced off the end of a shelf, waiting for a move_book
+        # event to place them on the next shelf. Library.add_book moves
+        # them along in the order they were displaced.
+        self.displaced_books = collections.deque()
+
+    @staticmethod
+    def from_checkpoint(file_name):
+        '''Create a replica from a ChangeLog checkpoint.
+
+        Return (Replica, int) - The replica and the log offset to
+                                continue reading from.
+        '''
+        with open(file_name, "rt") as f:
+            checkpoint = json.load(f)
+        replica = Replica()
+        replica.apply(checkpoint)
+        return replica, checkpoint.get("log_offset", 0)
+
+    def apply(self, event):
+        '''Apply one encoded event. Events already applied are ignored.'''
+        if self.library is not None and event["seq"] <= self.sequence:
+            return False
+        if event["op"] == "snapshot":
+            decoder = l.LibraryJSONDecoder()
+            self.library = decoder.decode_object(event["library"])
+            self.library.mark_saved()
+            self.displaced_books.clear()
+            self.sequence = event["seq"]
+            return True
+        if self.library is None or event["seq"] != self.sequence + 1:
+            raise ReplicaError("Expected event {} but got {}".format(
+                self.sequence + 1, event["seq"]))
+
+        if event["op"] not in ("displace_book", "move_book"):
+            # Books still displaced when the add_book that displaced them
+            # is over fell off the last shelf and left the library.
+            self.displaced_books.clear()
+        getattr(self, "apply_" + event["op"])(event)
+        self.sequence = event["seq"]
+        return True
+
+    def apply_add_container(self, event):
+        parent = get_node(self.library, event["parent"])
+        decoder = l.LibraryJSONDecoder()
+        container = decoder.decode_object(event["container"], self.library)
+        parent.add_child(container, event["position"])
+
+    def apply_place_book(self, event):
+        decoder = l.LibraryJSONDecoder()
+        book = decoder.decode_object(event["book"], self.library)
+        self._place(book, event)
+
+    def apply_move_book(self, event):
+        # Copies with the same title and author can only be told apart by
+        # the order they were displaced in.
+        if not self.displaced_books:
+            raise ReplicaError("Book moved by event {} was never "
+                               "displaced".format(event["seq"]))
+        book = self.displaced_books.popleft()
+        if (book.title, book.author) != (event["title"], event["author"]):
+            raise ReplicaError("Event {} moves {!r} but {!r} was displaced "
+                               "first".format(event["seq"], event["title"],
+                                              book.title))
+        self._place(book, event)
+
+    def _place(self, book, event):
+        shelf = get_node(self.library, event["shelf"])
+        shelf.add_child(book, event["position"])
+        if not book.is_on_shelf:
+            # Like Shelf.add_book; is_on_shelf is part of the book's hash.
+            book.is_on_shelf = True
+            book.mark_changed()
+
+    def apply_displace_book(self, event):
+        shelf = get_node(self.library, event["shelf"])
+        self.displaced_books.append(shelf.children.pop())
+        shelf.mark_changed()
+
+    def apply_lend(self, event):
+        name = event["borrower"]
+        if name not in self.library.borrowers:
+            self.library.add_borrower(l.Person(name))
+        get_node(self.library, event["book"]).lend_to(
+            self.library.borrowers[name])
+
+    def apply_return(self, event):
+        get_node(self.library, event["book"]).return_from_borrower()
+
+    def apply_shelve(self, event):
+        get_node(self.library, event["book"]).set_on_shelf(
+            event["is_on_shelf"])
+
+    def apply_add_borrower(self, event):
+        self.library.add_borrower(l.Person(event["name"]))
+
+    def follow_log(self, file_name, offset=0, poll_interval=0.5,
+                   callback=None, stop=None):
+        '''Apply the events in a change log, then keep waiting for more.
+
+        Args:
+           file_name: The ChangeLog file.
+           offset: Byte offset to start reading at.
+           poll_interval: Seconds to wait before looking for new events.
+           callback: Called with each applied event.
+           stop: threading.Event used to stop following. Without one this
+                 returns once the end of the log is reached.
+        '''
+        with open(file_name, "rt") as f:
+            f.seek(offset)
+            partial = ""
+            while True:
+                line = f.readline()
+                if line.endswith("\n"):
+                    self._apply_line(partial + line, callback)
+                    partial = ""
+                elif stop is None:
+                    return
+                elif stop.is_set():
+                    return
+                else:
+                    partial += line
+                    time.sleep(poll_interval)
+
+    def follow_socket(self, host, port, callback=None):
+        '''Connect to a FeedServer and apply its events until it closes.'''
+        with socket.create_connection((host, port)) as connection:
+            # Ask for a snapshot first if there is no library yet.
+            after = self.sequence if self.library is not None else -1
+            connection.sendall((json.dumps({"after": after}) +
+                                "\n").encode())
+            with connection.makefile("r") as f:
+                for line in f:
+                    self._apply_line(line, callback)
+
+    def _apply_line(self, line, callback):
+        event = json.loads(line)
+        if self.apply(event) and callback:
+            callback(event)
+
+
+def print_event(event):
+    '''Print a one line description of an applied event.'''
+    details = {key: value for key, value in event.items()
+               if key not in ("seq", "op", "library", "container", "book")}
+    print("{:>6} {} {}".format(event["seq"], event["op"], details or ""))
+
+
+def parse_command_line():
+    '''Parse command line arguments.
+
+    Return (dict) - Parsed command line arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description='Run a read only replica of a Library.')
+    parser.add_argument('--log', dest='log', default=None,
+                        help='Change log file written with --feed-log')
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None,
+                        help='Checkpoint to start from instead of reading '
+                             'the whole log')
+    parser.add_argument('--connect', dest='connect', default=None,
+                        metavar='HOST:PORT',
+                        help='Feed server started with --feed-port')
+    return parser.parse_args()
+
+
+def run_replica(args):
+    '''Follow a log or feed server, printing each event applied, and
+    print the replica's layout when interrupted.'''
+    replica = Replica()
+    offset = 0
+    if args.checkpoint:
+        replica, offset = Replica.from_checkpoint(args.checkpoint)
+    try:
+        if args.connect:
+            host, port = args.connect.rsplit(":", 1)
+            replica.follow_socket(host, int(port), print_event)
+        elif args.log:
+            replica.follow_log(args.log, offset, callback=print_event,
+                               stop=threading.Event())
+    except KeyboardInterrupt:
+        pass
+    if replica.library is not None:
+        print()
+        replica.library.describe()
+
+
+def run_unit_tests():
+    '''Run unit tests of a replica following a primary's change log.'''
+    import tempfile
+    import library_history
+    print("Running Replication Unit Tests")
+    primary = l.make_test_library(books=30)
+    with tempfile.TemporaryDirectory() as directory:
+        log_name = os.path.join(directory, "changes.log")
+        checkpoint_name = os.path.join(directory, "checkpoint.json")
+        log = ChangeLog(primary, log_name)
+        log.write_checkpoint(checkpoint_name)
+        replica, offset = Replica.from_checkpoint(checkpoint_name)
+        # Content hashes are worked out on the replica as it goes.
+        assert(replica.library.get_content_hash() ==
+               primary.get_content_hash())
+
+        history = library_history.get_history(primary)
+        reader = l.Person("Reader")
+        primary.add_borrower(reader)
+        books = primary.get_all_books()
+        books[0].lend_to(reader)
+        first_shelf = primary.get_all_shelves_flattened()[0]
+        first_shelf.children[-1].set_on_shelf(False)
+        primary.get_rooms()[1].add_case(l.Case("New Case"))
+        primary.get_rooms()[1].get_cases()[-1].add_shelf(l.Shelf("New", 5))
+        replica.follow_log(log_name, offset)
+        assert(replica.library.get_content_hash() ==
+               primary.get_content_hash())
+
+        before = history.begin()
+        for i in range(6):
+            # Pushes books along, including the one off its shelf.
+            primary.add_book(l.Book("New {}".format(i), "Author", 100,
+                                    "Genre", 3), first_shelf)
+        history.commit("Add Books", before)
+        books[0].return_from_borrower()
+        replica.follow_log(log_name, offset)
+        assert(replica.library.get_content_hash() ==
+               primary.get_content_hash())
+
+        history.undo()
+        replica.follow_log(log_name, offset)
+        assert(replica.sequence == primary.get_sequence())
+        assert(replica.library.get_content_hash() ==
+               primary.get_content_hash())
+        log.close()
+
+    # A replica joining after the feed server's history was cut short
+    # starts from a snapshot taken between two changes, never in the
+    # middle of an add_book.
+    primary = l.make_test_library(books=20)
+    feed = FeedServer(primary, max_history=5)
+    replicas = []
+
+    def join():
+        replica = Replica()
+        thread = threading.Thread(target=replica.follow_socket,
+                                  args=feed.address)
+        thread.start()
+        # Joined once it has the snapshot.
+        while replica.library is None and thread.is_alive():
+            time.sleep(0.01)
+        replicas.append((replica, thread))
+
+    join()
+    shelves = primary.get_all_shelves_flattened()
+    for i in range(30):
+        primary.add_book(l.Book("Late {}".format(i), "Author", 100, "", 1),
+                         shelves[i % 4], note_copies=False)
+        if i % 10 == 5:
+            join()
+    feed.close()
+    for replica, thread in replicas:
+        thread.join()
+        assert(replica.sequence == primary.get_sequence())
+        assert(replica.library.get_content_hash() ==
+               primary.get_content_hash())
+
+    # Copies with the same title and author are moved along in the order
+    # they were displaced, after a copy fell off the last shelf.
+    primary = l.make_test_library(books=0)
+    shelves = primary.get_all_shelves_flattened()
+    for i, shelf in enumerate(shelves):
+        for j in range(shelf.width - (shelf is shelves[1])):
+            shelf.add_book(l.Book("Same", "Author", 100 + 10 * i + j, ""))
+    replica = Replica(l.LibraryJSONDecoder().decode_object(
+        encode_object(primary)))
+    primary.add_listener(lambda event: replica.apply(encode_event(event)))
+    shelves[-1].add_book(l.Book("Same", "Author", 999, ""))
+    primary.add_book(l.Book("Same", "Author", 50, ""), shelves[0],
+                     note_copies=False)
+    assert(replica.sequence == primary.get_sequence())
+    assert(replica.library.get_content_hash() == primary.get_content_hash())
+
+
+if __name__ == '__main__':
+    run_replica(parse_command_line())
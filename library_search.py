@@ -0,0 +1,496 @@
+'''Library Search.
+Contains a typo tolerant search over book titles and authors. Titles and
+authors are normalised and split into words, and the words are kept in a
+BK-tree so that every word within a small edit distance of a searched
+word can be found without comparing against all of them.
+
+Also contains prefix tries over titles, authors and container labels used
+to narrow selection menus as the user types.
+'''
+import heapq
+import re
+import unicodedata
+import weakref
+import library as l
+
+
+def normalize(text):
+    '''Lower case text, strip accents and punctuation and collapse spaces.'''
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def edit_distance(a, b):
+    '''Levenshtein distance between two strings, computed with the bit
+    parallel algorithm of Myers (as described by Hyyro), which processes a
+    whole column of the distance table per character.
+    '''
+    if len(a) < len(b):
+        a, b = b, a
+    m = len(b)
+    if m == 0:
+        return len(a)
+    peq = dict()
+    for i, c in enumerate(b):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    for c in a:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+    return score
+
+
+def get_max_distance(word):
+    '''Number of typos tolerated in a searched word of this length.'''
+    if len(word) <= 3:
+        return 0
+    if len(word) <= 5:
+        return 1
+    if len(word) <= 9:
+        return 2
+    return 3
+
+
+class BKTree:
+    '''Class representing a BK-tree of words. Each child of a node is keyed
+    by its edit distance to the node, so by the triangle inequality a search
+    for words within distance d of a word w only needs to visit children
+    whose key is within d of the distance between w and the node.
+    '''
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, word):
+        '''Add a word to the tree. Adding a word twice does nothing.'''
+        if self.root is None:
+            self.root = (word, dict())
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, dict())
+                self.size += 1
+                return
+            node = child
+
+    def search(self, word, max_distance):
+        '''Return list<(str, int)>: Every word within max_distance edits of
+        word, with its distance.'''
+        found = []
+        if self.root is None:
+            return found
+        nodes = [self.root]
+        while nodes:
+            node_word, children = nodes.pop()
+            distance = edit_distance(word, node_word)
+            if distance <= max_distance:
+                found.append((node_word, distance))
+            for key, child in children.items():
+                if distance - max_distance <= key <= distance + max_distance:
+                    nodes.append(child)
+        return found
+
+
+class SearchIndex:
+    '''Class indexing the words of every book title and author in a
+    library. Kept current by listening to the library's change events.
+    '''
+    def __init__(self, library):
+        self.tree = BKTree()
+        self.books_by_word = dict()
+        for book in library.get_all_books():
+            self.add_book(book)
+        library.add_listener(self.on_change)
+
+    def add_book(self, book):
+        for word in set(normalize(book.title).split() +
+                        normalize(book.author).split()):
+            books = self.books_by_word.get(word)
+            if books is None:
+                books = []
+                self.books_by_word[word] = books
+                self.tree.add(word)
+            books.append(book)
+
+    def on_change(self, event):
+        '''Index books added to the library.'''
+        if event["op"] == "place_book":
+            self.add_book(event["book"])
+        elif event["op"] == "add_container":
+            for book in event["container"].get_leaf_nodes():
+                self.add_book(book)
+        elif event["op"] == "snapshot":
+            # Rebuilt when next needed.
+            event["library"]._search_index = None
+            event["library"].remove_listener(self.on_change)
+
+    def search(self, text, k=10):
+        '''Find the books whose title and author best match text.
+
+        Each searched word is matched against the words of titles and
+        authors allowing a few typos, and scores 1 - distance / length.
+        A book scores the average over the searched words of its best
+        matching word.
+
+        Return list<(Book, float)>: Up to k books with their score
+                                    between 0 and 1, best first.
+        '''
+        words = normalize(text).split()
+        if not words:
+            return []
+        scores = dict()
+        for i, word in enumerate(words):
+            for found, distance in self.tree.search(word,
+                                                    get_max_distance(word)):
+                similarity = 1 - distance / max(len(word), len(found))
+                for book in self.books_by_word[found]:
+                    best = scores.setdefault(id(book),
+                                             [book, [0] * len(words)])
+                    best[1][i] = max(best[1][i], similarity)
+
+        ranked = heapq.nlargest(k, scores.values(),
+                                key=lambda entry: sum(entry[1]))
+        return [(book, sum(similarities) / len(words))
+                for book, similarities in ranked]
+
+
+def get_index(library):
+    '''Returns (SearchIndex) - The search index of library, built the
+                              first time it is needed.'''
+    if library._search_index is None:
+        library._search_index = SearchIndex(library)
+    return library._search_index
+
+
+def fuzzy_search(library, text, k=10):
+    '''Return list<(Book, float)>: The k books in library best matching
+    text by title and author, with their scores, best first.'''
+    return get_index(library).search(text, k)
+
+
+class TrieNode:
+    '''Node of a PrefixTrie. count is the number of values stored in this
+    node and all of its descendents.'''
+    __slots__ = ("children", "values", "count")
+
+    def __init__(self):
+        self.children = dict()
+        self.values = None
+        self.count = 0
+
+
+class PrefixTrie:
+    '''Class representing a radix tree from lower cased string keys to
+    lists of values. Every node knows how many values lie beneath it, so
+    a page of the values whose keys start with a prefix can be listed in
+    key order in O(len(prefix) + page) steps, skipping whole subtrees that
+    come before the page.
+    '''
+    def __init__(self):
+        self.root = TrieNode()
+
+    def add(self, key, value):
+        '''Store value under key.'''
+        node = self.root
+        node.count += 1
+        rest = key.lower()
+        while rest:
+            entry = node.children.get(rest[0])
+            if entry is None:
+                child = TrieNode()
+                node.children[rest[0]] = (rest, child)
+                node = child
+                node.count += 1
+                break
+            edge, child = entry
+            common = 0
+            while (common < len(edge) and common < len(rest) and
+                   edge[common] == rest[common]):
+                common += 1
+            if common < len(edge):
+                # Split the edge so the shared part gets its own node.
+                middle = TrieNode()
+                middle.count = child.count
+                middle.children[edge[common]] = (edge[common:], child)
+                node.children[rest[0]] = (edge[:common], middle)
+                child = middle
+            node = child
+            node.count += 1
+            rest = rest[common:]
+        if node.values is None:
+            node.values = []
+        node.values.append(value)
+
+    def remove(self, key, value):
+        '''Remove value from key. Return True if it was found.'''
+        path = [self.root]
+        rest = key.lower()
+        while rest:
+            entry = path[-1].children.get(rest[0])
+            if entry is None or not rest.startswith(entry[0]):
+                return False
+            path.append(entry[1])
+            rest = rest[len(entry[0]):]
+        node = path[-1]
+        for i, stored in enumerate(node.values or []):
+            if stored is value:
+                del node.values[i]
+                for node in path:
+                    node.count -= 1
+                return True
+        return False
+
+    def find(self, prefix):
+        '''Returns (TrieNode) - The node holding every key that starts with
+                                prefix, or None if there are none.'''
+        node = self.root
+        rest = prefix.lower()
+        while rest:
+            entry = node.children.get(rest[0])
+            if entry is None:
+                return None
+            edge, child = entry
+            if edge.startswith(rest):
+                return child
+            if not rest.startswith(edge):
+                return None
+            node = child
+            rest = rest[len(edge):]
+        return node
+
+    def count(self, prefix=""):
+        '''Returns (int) - Number of values whose keys start with prefix.'''
+        node = self.find(prefix)
+        return node.count if node else 0
+
+    def items(self, prefix="", offset=0, limit=10):
+        '''Return list: Up to limit values whose keys start with prefix,
+        in key order, skipping the first offset of them.'''
+        found = []
+        node = self.find(prefix)
+        if node is not None and limit > 0:
+            self._collect(node, offset, limit, found)
+        return found
+
+    def _collect(self, node, skip, limit, found):
+        '''Add values beneath node to found. Returns how many of the values
+        to skip are left after this node.'''
+        if node.values:
+            if skip >= len(node.values):
+                skip -= len(node.values)
+            else:
+                found.extend(node.values[skip:skip + limit - len(found)])
+                skip = 0
+        for first in sorted(node.children):
+            if len(found) >= limit:
+                break
+            child = node.children[first][1]
+            if skip >= child.count:
+                skip -= child.count
+            else:
+                skip = self._collect(child, skip, limit, found)
+        return skip
+
+
+class AutocompleteIndex:
+    '''Class holding prefix tries over the titles and authors of every book
+    in a library, and over the labels of each container's children. Kept
+    current by listening to the library's change events.
+    '''
+    def __init__(self, library):
+        self.tries = {"title": PrefixTrie(), "author": PrefixTrie()}
+        self.label_tries = weakref.WeakKeyDictionary()
+        for book in library.get_all_books():
+            self.add_book(book)
+        library.add_listener(self.on_change)
+
+    def add_book(self, book):
+        self.tries["title"].add(book.title, book)
+        self.tries["author"].add(book.author, book)
+
+    def get_trie(self, field):
+        '''Returns (PrefixTrie) - Books by "title" or "author".'''
+        return self.tries[field]
+
+    def find_containing(self, field, text):
+        '''Returns (list<Book>) - Books whose "title" or "author" contains
+                                 text anywhere, in key order.'''
+        trie = self.tries[field]
+        text = text.lower()
+        return [book for book in trie.items("", 0, trie.count())
+                if text in getattr(book, field).lower()]
+
+    def get_label_trie(self, container):
+        '''Returns (PrefixTrie) - The children of container by label.'''
+        trie = self.label_tries.get(container)
+        if trie is None:
+            trie = build_label_trie(container)
+            self.label_tries[container] = trie
+        return trie
+
+    def on_change(self, event):
+        if event["op"] == "place_book":
+            self.add_book(event["book"])
+        elif event["op"] == "add_container":
+            container = event["container"]
+            trie = self.label_tries.get(event["parent"])
+            if trie is not None:
+                trie.add(container.label, container)
+            for book in container.get_leaf_nodes():
+                self.add_book(book)
+        elif event["op"] == "snapshot":
+            # Rebuilt when next needed.
+            event["library"]._autocomplete_index = None
+            event["library"].remove_listener(self.on_change)
+
+
+def build_label_trie(container):
+    '''Returns (PrefixTrie) - The children of container by label.'''
+    trie = PrefixTrie()
+    for child in container.children:
+        trie.add(child.label, child)
+    return trie
+
+
+def get_label_trie(container):
+    '''Returns (PrefixTrie) - The children of container by label, kept
+                             current if container is in a library.'''
+    library = l.find_library(container)
+    if library is None:
+        return build_label_trie(container)
+    return get_autocomplete_index(library).get_label_trie(container)
+
+
+def get_autocomplete_index(library):
+    '''Returns (AutocompleteIndex) - The autocomplete index of library,
+                                    built the first time it is needed.'''
+    if library._autocomplete_index is None:
+        library._autocomplete_index = AutocompleteIndex(library)
+    return library._autocomplete_index
+
+
+def run_unit_tests():
+    '''Run unit tests of the typo tolerant search.'''
+    import random
+    print("Running Search Unit Tests")
+
+    def table_distance(a, b):
+        # Levenshtein distance row by row, to check edit_distance against.
+        row = list(range(len(b) + 1))
+        for i, c in enumerate(a):
+            previous, row[0] = row[0], i + 1
+            for j, d in enumerate(b):
+                previous, row[j + 1] = row[j + 1], min(
+                    row[j + 1] + 1, row[j] + 1, previous + (c != d))
+        return row[-1]
+
+    rng = random.Random(7)
+    for i in range(500):
+        # Few letters so the strings share a lot, up to past 64 of them.
+        a = "".join(rng.choice("abc") for j in range(rng.randrange(70)))
+        b = "".join(rng.choice("abc") for j in range(rng.randrange(70)))
+        assert(edit_distance(a, b) == table_distance(a, b))
+    assert(edit_distance("kitten", "sitting") == 3)
+    assert(edit_distance("", "abc") == 3)
+
+    words = ["".join(rng.choice("abcd") for j in range(rng.randrange(1, 8)))
+             for i in range(300)]
+    tree = BKTree()
+    for word in words:
+        tree.add(word)
+    assert(tree.size == len(set(words)))
+    for word in words[:30]:
+        for max_distance in range(3):
+            assert(sorted(tree.search(word, max_distance)) ==
+                   sorted((found, table_distance(word, found))
+                          for found in set(words)
+                          if table_distance(word, found) <= max_distance))
+
+    library = l.make_test_library()
+    wanted = l.Book("The Hound of the Baskervilles", "Arthur Conan Doyle",
+                    256, "Mystery")
+    library.add_book(wanted)
+    assert(("baskervilles", 0) in get_index(library).tree.search(
+        "baskervilles", 0))
+    assert(("baskervilles", 1) in get_index(library).tree.search(
+        "baskerviles", 2))
+    found = fuzzy_search(library, "Hund of the Baskerviles Doyel", 3)
+    assert(found[0][0] is wanted)
+    assert(0 < found[0][1] < 1)
+    # The index follows books added after it was built.
+    added = l.Book("Moby Dick", "Herman Melville", 635, "Adventure")
+    library.add_book(added)
+    assert(fuzzy_search(library, "Mobey Dik", 1)[0][0] is added)
+
+    trie = PrefixTrie()
+    trie.add("Roman", 1)
+    trie.add("Romance", 2)
+    # Splits the "roman" edge at "rom".
+    trie.add("Rome", 3)
+    edge, node = trie.root.children["r"]
+    assert(edge == "rom" and node.count == 3 and node.values is None)
+    assert(sorted(node.children) == ["a", "e"])
+    assert(node.children["a"][0] == "an")
+    assert(node.children["a"][1].count == 2)
+    # Ends on the split node itself.
+    trie.add("ROM", 4)
+    assert(node.values == [4] and node.count == 4)
+    trie.add("Rome", 5)
+    trie.add("Apple", 6)
+    assert(trie.count() == 6 and trie.count("rom") == 5)
+    assert(trie.count("roma") == 2 and trie.count("ro") == 5)
+    assert(trie.count("romb") == 0 and trie.count("romances") == 0)
+    assert(trie.items() == [6, 4, 1, 2, 3, 5])
+
+    # Paging skips whole subtrees and stops part way through a node.
+    for offset in range(8):
+        for limit in range(8):
+            assert(trie.items("", offset, limit) ==
+                   [6, 4, 1, 2, 3, 5][offset:offset + limit])
+    assert(trie.items("rom", 1, 3) == [1, 2, 3])
+    assert(trie.items("rome", 1, 10) == [5])
+
+    # Removing keeps the counts of every node on the path.
+    assert(not trie.remove("Rome", 1))
+    assert(not trie.remove("Ro", 4))
+    assert(trie.remove("rome", 3))
+    assert(trie.count() == 5 and trie.count("rom") == 4)
+    assert(node.count == 4 and node.children["e"][1].count == 1)
+    assert(trie.remove("Romance", 2))
+    assert(trie.count("roma") == 1 and trie.items("rom", 0, 10) == [4, 1, 5])
+    assert(trie.items("", 1, 2) == [4, 1])
+    trie = PrefixTrie()
+    for key, value in [("ab", 1), ("abc", 2), ("ab", 3)]:
+        trie.add(key, value)
+    assert(trie.items("", 1, 2) == [3, 2])
+
+    index = get_autocomplete_index(library)
+    assert(index.get_trie("title").count("the hound") == 1)
+    assert(index.find_containing("title", "HOUND") == [wanted])
+    assert(index.find_containing("author", "conan") == [wanted])
+    titles = [book.title for book in index.find_containing("title", "1")]
+    assert(titles == sorted(book.title for book in library.get_all_books()
+                            if "1" in book.title))
+    assert(index.find_containing("title", "nowhere") == [])
@@ -0,0 +1,195 @@
+'''Library Instrumentation.
+Contains opt-in counters, histograms and profiling hooks used to see where
+time goes inside Library and Shelf operations. Everything is disabled by
+default; instrumented code only checks STATS.enabled before doing any work.
+'''
+import json
+import time
+
+
+class Histogram:
+    '''Class recording a distribution of values in power of two buckets.
+    Bucket keys are upper bounds, so a value of 5 is counted in bucket 8.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = dict()
+
+    def observe(self, value):
+        '''Record a single value.'''
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        bound = 1
+        while bound < value:
+            bound *= 2
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    def get_mean(self):
+        '''Returns the average recorded value, or 0 if nothing was recorded.'''
+        if self.count:
+            return self.total / self.count
+        return 0
+
+    def to_dict(self):
+        return {"count": self.count,
+                "total": self.total,
+                "min": self.min,
+                "max": self.max,
+                "mean": self.get_mean(),
+                "buckets": {str(bound): self.buckets[bound]
+                            for bound in sorted(self.buckets)}}
+
+
+class Stats:
+    '''Class collecting counters and histograms for named operations.
+
+    Hooks registered with add_hook are called after every timed operation
+    as hook(operation, elapsed_seconds, info) where info is a dict of
+    operation specific details (shelves scanned, books displaced, ...).
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.counters = dict()
+        self.histograms = dict()
+        self.hooks = []
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        '''Forget everything recorded so far. Hooks are kept.'''
+        self.counters = dict()
+        self.histograms = dict()
+
+    def add_hook(self, hook):
+        '''Register a function called after every timed operation.'''
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def increment(self, name, amount=1):
+        '''Add amount to the named counter.'''
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        '''Record value in the named histogram.'''
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+        histogram.observe(value)
+
+    def start(self):
+        '''Returns a start time to be passed to finish.'''
+        return time.perf_counter()
+
+    def finish(self, operation, started, **info):
+        '''Record the latency of an operation started with start(), record
+        every numeric detail in info as a histogram and call the hooks.
+
+        Args:
+           operation - Name of the operation, e.g. "add_book"
+           started - Value returned by start()
+           info - Operation specific details
+        '''
+        elapsed = time.perf_counter() - started
+        self.increment(operation + ".calls")
+        self.observe(operation + ".latency_us", elapsed * 1000000)
+        for key, value in info.items():
+            if (isinstance(value, (int, float)) and
+                    not isinstance(value, bool)):
+                self.observe(operation + "." + key, value)
+        for hook in self.hooks:
+            hook(operation, elapsed, info)
+
+    def report_json(self):
+        '''Returns (str) - The recorded counters and histograms as json.'''
+        report = {"counters": dict(sorted(self.counters.items())),
+                  "histograms": {name: self.histograms[name].to_dict()
+                                 for name in sorted(self.histograms)}}
+        return json.dumps(report, indent=2)
+
+    def report_text(self):
+        '''Returns (str) - The recorded counters and histograms as text.'''
+        lines = ["Counters:"]
+        for name in sorted(self.counters):
+            lines.append("  {}: {}".format(name, self.counters[name]))
+        lines.append("Histograms:")
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            lines.append("  {}: count={} mean={:.2f} min={:g} max={:g}".format(
+                name, histogram.count, histogram.get_mean(),
+                histogram.min, histogram.max))
+            for bound in sorted(histogram.buckets):
+                lines.append("    <= {}: {}".format(bound,
+                                                    histogram.buckets[bound]))
+        return "\n".join(lines)
+
+
+# The single Stats instance used by the library classes.
+STATS = Stats()
+
+
+def run_unit_tests():
+    '''Run unit tests of the statistics recorded for make_test_library.'''
+    import library
+    print("Running Stats Unit Tests")
+    histogram = Histogram()
+    for value in [0, 1, 2, 5, 8, 9]:
+        histogram.observe(value)
+    assert(histogram.buckets == {1: 2, 2: 1, 8: 2, 16: 1})
+    assert(histogram.min == 0 and histogram.max == 9)
+    assert(histogram.get_mean() == 25 / 6)
+    assert(Histogram().get_mean() == 0)
+
+    calls = []
+
+    def hook(operation, elapsed, info):
+        calls.append((operation, info))
+
+    STATS.reset()
+    STATS.add_hook(hook)
+    STATS.enable()
+    try:
+        test_library = library.make_test_library()
+    finally:
+        STATS.disable()
+        STATS.remove_hook(hook)
+    books = len(test_library.get_all_books())
+    counters = dict(STATS.counters)
+    histograms = dict(STATS.histograms)
+    report = json.loads(STATS.report_json())
+    text = STATS.report_text()
+    STATS.reset()
+
+    assert(books == 50)
+    assert(counters["add_book.calls"] == 50)
+    assert(counters["find_shelf_with_space.calls"] == 50)
+    assert(counters["shelf.get_remaining_space"] > 0)
+    assert(histograms["add_book.shelves_touched"].count == 50)
+    assert(histograms["add_book.shelves_touched"].min == 1)
+    assert(histograms["add_book.latency_us"].count == 50)
+    # Booleans such as found_space go to the hooks but are not observed.
+    assert("add_book.found_space" not in histograms)
+    add_book_calls = [info for operation, info in calls
+                      if operation == "add_book"]
+    assert(len(add_book_calls) == 50)
+    assert(all(info["found_space"] for info in add_book_calls))
+    assert(report["counters"]["add_book.calls"] == 50)
+    assert(report["histograms"]["add_book.shelves_touched"]["count"] == 50)
+    assert("  add_book.calls: 50" in text.split("\n"))
+    # Nothing is recorded while disabled.
+    library.make_test_library(books=5)
+    assert(not STATS.counters and not STATS.histograms)
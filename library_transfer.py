@@ -0,0 +1,291 @@
+'''Library Transfer.
+Contains streaming import and export of books as CSV or JSON lines files.
+Files are read and written a chunk of CHUNK_SIZE records at a time, so
+memory use does not grow with the size of the file. Imported books are
+checked with the same rules as books typed in at the menu and placed on
+shelves by Library.add_book.
+
+Every record has the fields in FIELDS. Exports fill in where each book is;
+imports ignore the location and loan fields, since books are placed where
+the library has room for them.
+'''
+import csv
+import itertools
+import json
+import os
+import library as l
+
+# Records read or written at a time.
+CHUNK_SIZE = 10000
+FIELDS = ["title", "author", "edition", "pages", "genre", "width", "room",
+          "case", "shelf", "is_on_shelf", "lent_to"]
+# File formats by file name extension.
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+# Number of rejected records whose reasons are kept.
+MAX_ERRORS = 100
+
+
+def get_format(file_name):
+    '''Returns (str) - "csv" or "jsonl", from the file name's extension.
+    Raises ValueError for other extensions.'''
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError("Can not tell the format of {}, use one of {}".format(
+            file_name, ", ".join(sorted(FORMATS))))
+    return FORMATS[extension]
+
+
+def iter_chunks(records, size=CHUNK_SIZE):
+    '''Iterate over lists of up to size records.'''
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_book_records(library):
+    '''Iterate over a record for every book in the library, in shelf
+    order. Lazily loaded rooms are loaded as they are reached.'''
+    for shelf in library.iter_shelves():
+        case = shelf.contained_in
+        for book in shelf.children:
+            yield {"title": book.title,
+                   "author": book.author,
+                   "edition": book.edition,
+                   "pages": book.pages,
+                   "genre": book.genre,
+                   "width": book.width,
+                   "room": case.contained_in.label,
+                   "case": case.label,
+                   "shelf": shelf.label,
+                   "is_on_shelf": book.is_on_shelf,
+                   "lent_to": book.lent_to.name if book.lent_to else None}
+
+
+def export_books(library, file_name):
+    '''Write every book in the library to a CSV or JSON lines file,
+    replacing it once the whole file is written.
+
+    Returns (int) - Number of books written.
+    '''
+    file_format = get_format(file_name)
+    temp_name = file_name + ".tmp"
+    written = 0
+    with open(temp_name, "wt", newline="", encoding="utf-8") as f:
+        if file_format == "csv":
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+        for chunk in iter_chunks(iter_book_records(library)):
+            if file_format == "csv":
+                writer.writerows(chunk)
+            else:
+                f.write("".join(json.dumps(record) + "\n"
+                                for record in chunk))
+            written += len(chunk)
+    os.replace(temp_name, file_name)
+    return written
+
+
+def iter_file_records(f, file_format):
+    '''Iterate over (int, dict) - The line number and fields of each record
+    in an open CSV or JSON lines file. The fields are None for a line that
+    is not a JSON object.'''
+    if file_format == "csv":
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record if isinstance(record, dict) else None
+
+
+def get_text(record, field):
+    '''Returns (str) - A field of a record as stripped text, "" if missing.'''
+    value = record.get(field)
+    return "" if value is None else str(value).strip()
+
+
+def make_book(record, max_width=None):
+    '''Check a record and make the book it describes.
+
+    Returns (Book, str) - The book, or None and why the record was
+                          rejected.
+    Args:
+       record: dict of FIELDS read from a file, or None.
+       max_width: Width of the widest shelf, if any. Wider books could
+                  never be placed.
+    '''
+    if record is None:
+        return None, "not a record"
+    title = get_text(record, "title")
+    author = get_text(record, "author")
+    if not title or not author:
+        return None, "title and author are required"
+    pages = l.get_int(get_text(record, "pages"), min=1)
+    if pages is None:
+        return None, "pages must be a positive integer"
+    width = get_text(record, "width")
+    width = l.get_int(width, min=1) if width else 1
+    if width is None:
+        return None, "width must be a positive integer"
+    if max_width is not None and width > max_width:
+        return None, "width is more than the widest shelf ({})".format(
+            max_width)
+    return l.Book(title, author, pages, get_text(record, "genre"), width,
+                  get_text(record, "edition") or None), None
+
+
+class ShelfFinder:
+    '''Class finding the first shelf with room for a book, like
+    Library.add_book does, without scanning every shelf for every book.
+    While books are only being added, space on a shelf never grows, so
+    the first shelf that can fit a width only moves forward.
+    '''
+    def __init__(self, library):
+        self.library = library
+        self.reset()
+
+    def reset(self):
+        '''Start over after books were moved between shelves.'''
+        self.shelves = self.library.get_all_shelves_flattened()
+        self.remaining = [shelf.get_remaining_space()
+                          for shelf in self.shelves]
+        self.first = dict()
+
+    def place(self, book):
+        '''Add a book to the library.
+
+        Returns (Shelf) - The shelf the book was added to, or None if the
+                          library is full.
+        '''
+        i = self.first.get(book.width, 0)
+        while i < len(self.shelves) and self.remaining[i] < book.width:
+            i += 1
+        self.first[book.width] = i
+        if i == len(self.shelves):
+            # Books may still fit by moving others along the shelves.
+            shelf = self.library.add_book(book, note_copies=False)
+            if shelf is not None:
+                self.reset()
+            return shelf
+        shelf = self.shelves[i]
+        # Added after the books already there, keeping the file's order.
+        self.library.add_book(book, shelf, len(shelf.children),
+                              note_copies=False)
+        self.remaining[i] -= book.width
+        return shelf
+
+
+def import_books(library, file_name, chunk_size=CHUNK_SIZE):
+    '''Add every book in a CSV or JSON lines file to the library. Records
+    that fail the checks are skipped; the import stops if the library is
+    full.
+
+    Returns (dict) - Number of records "read", books "added", books added
+                     that were further "copies" of a book in the library
+                     and records "rejected", the first MAX_ERRORS
+                     rejections as "errors" (list of (line number,
+                     reason)), and the line number the library was "full"
+                     at, or None.
+    Args:
+       library: The library to add to.
+       file_name: The file to read; its extension gives the format.
+       chunk_size: Number of records read and checked at a time.
+    '''
+    file_format = get_format(file_name)
+    result = {"read": 0, "added": 0, "copies": 0, "rejected": 0,
+              "errors": [], "full": None}
+    finder = ShelfFinder(library)
+    max_width = max((shelf.width for shelf in finder.shelves), default=None)
+    with open(file_name, "rt", newline="", encoding="utf-8") as f:
+        for chunk in iter_chunks(iter_file_records(f, file_format),
+                                 chunk_size):
+            books = []
+            for line_number, record in chunk:
+                book, error = make_book(record, max_width)
+                if error is not None:
+                    result["rejected"] += 1
+                    if len(result["errors"]) < MAX_ERRORS:
+                        result["errors"].append((line_number, error))
+                else:
+                    books.append((line_number, book))
+            result["read"] += len(chunk)
+            for line_number, book in books:
+                if finder.place(book) is None:
+                    result["full"] = line_number
+                    return result
+                result["added"] += 1
+                if library.count_copies(book) > 1:
+                    result["copies"] += 1
+    return result
+
+
+def run_unit_tests():
+    '''Run unit tests of exporting and importing books.'''
+    import tempfile
+    print("Running Transfer Unit Tests")
+
+    def get_books(library):
+        return [(book.title, book.author, book.edition, book.pages,
+                 book.genre, book.width) for book in library.get_all_books()]
+
+    def make_empty_copy(library):
+        copy = l.Library(library.label)
+        for room in library.get_rooms():
+            copy.add_room(l.Room(room.label))
+            for case in room.get_cases():
+                copy.get_rooms()[-1].add_case(l.Case(case.label))
+                for shelf in case.get_shelves():
+                    copy.get_rooms()[-1].get_cases()[-1].add_shelf(
+                        l.Shelf(shelf.label, shelf.width))
+        return copy
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Books exported to either format and imported into an empty copy
+        # of the layout come back the same and on the same shelves, since
+        # the export is in shelf order.
+        library = l.make_test_library(books=40)
+        library.get_all_books()[0].edition = "2nd, \"revised\""
+        library.get_all_books()[1].genre = ""
+        for extension in (".csv", ".jsonl"):
+            file_name = os.path.join(directory, "books" + extension)
+            assert(export_books(library, file_name) == 40)
+            copy = make_empty_copy(library)
+            result = import_books(copy, file_name, chunk_size=7)
+            assert(result["read"] == result["added"] == 40)
+            assert(result["rejected"] == 0 and result["full"] is None)
+            assert(get_books(copy) == get_books(library))
+            assert(list(iter_book_records(copy)) ==
+                   list(iter_book_records(library)))
+
+        # A book wider than every shelf is rejected, and the import goes on.
+        file_name = os.path.join(directory, "wide.csv")
+        with open(file_name, "wt", newline="", encoding="utf-8") as f:
+            f.write("title,author,pages,width\n"
+                    "Atlas,Author,300,11\n"
+                    "Novel,Author,300,2\n")
+        library = l.make_test_library(books=10)
+        result = import_books(library, file_name)
+        assert(result["added"] == 1 and result["full"] is None)
+        assert(result["errors"] ==
+               [(2, "width is more than the widest shelf (10)")])
+        # Further copies of books in the library are counted.
+        file_name = os.path.join(directory, "copies.jsonl")
+        with open(file_name, "wt", encoding="utf-8") as f:
+            f.write(json.dumps({"title": "Title 3", "author": "Author 3",
+                                "pages": 200}) + "\n")
+            f.write(json.dumps({"title": "Novel", "author": "Author",
+                                "pages": 300, "width": 2}) + "\n")
+        result = import_books(library, file_name)
+        assert(result["added"] == 2 and result["copies"] == 2)
+        # Adding one from the menu finds no shelf rather than failing.
+        assert(library.add_book(l.Book("Atlas", "Author", 300, "", 11)) is
+               None)
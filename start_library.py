@@ -6,8 +6,23 @@ Author: Shawn Kessler
 Project 1 for INFO W18: PYTHON BRIDGE 2
 '''
 import argparse
+import os
 import random
+import shutil
+import sys
 import library as l
+import library_catalog
+import library_forecast
+import library_history
+import library_packed
+import library_query
+import library_render
+import library_replication
+import library_search
+import library_stats
+import library_transfer
+from library import get_int
+from library_stats import STATS
 
 # Key combination that takes a user back to the main menu.
 CANCEL_INPUT_KEYS = "!z"
@@ -16,6 +31,8 @@ SKIP_PAUSE_PROMPT = "SKIP_PROMPT"
 # Where the system looks for the saved library. Can be changed from
 # command line.
 DEFAULT_LIBRARY_FILE_NAME = "library.json"
+# Number of choices listed at a time in selection menus.
+PAGE_SIZE = 10
 
 
 class MenuActionCanceledError(Exception):
@@ -56,71 +73,117 @@ def read_input(prompt, enter_on_new_line=True):
     return input_text
 
 
-def get_int(string, upper_boundary=None, min=0):
-    '''Get integer object based on the passed in string and boundaries
+def select_by_prefix(label, trie, describe, unfiltered=None, search=None):
+    '''Generic function used to allow the user to select a single value
+    out of a PrefixTrie. Values are listed a page at a time. Typing text
+    lists only the values whose keys start with it, or if there are none
+    the values search finds for it, '>' and '<' move between pages and
+    typing a listed number selects that value.
 
-    Return (int): Integer representation or None if string
-                  could not be converted to integer.
+    Return: The selected value.
 
     Args:
-       string - The string to convert to an integer
-       upper_boundary - return None if the converted string is
-                        not less than this value
-       min - return None if the converted string is less than this
-             value.
+       label: label printed to screen used to identify what the values are.
+       trie: library_search.PrefixTrie holding the values.
+       describe: function returning the text listed for each value.
+       unfiltered: optional list of the values listed in its own order
+                   until a filter is typed, instead of in key order.
+       search: optional function returning the list of values whose keys
+               contain the typed text, used when none start with it.
     '''
-    if string.isdigit():
-        integer = int(string)
-        is_valid = ((upper_boundary is None or integer < upper_boundary) and
-                    integer >= min)
-        if is_valid:
-            return integer
+    prefix = ""
+    matching = "starting with"
+    # Values listed instead of those in the trie starting with prefix.
+    listed = unfiltered
+    page = 0
+    while True:
+        start = page * PAGE_SIZE
+        if listed is None:
+            total = trie.count(prefix)
+            shown = trie.items(prefix, start, PAGE_SIZE)
         else:
-            return None
-    else:
-        return None
+            total = len(listed)
+            shown = listed[start:start + PAGE_SIZE]
+        pages = max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
+
+        print("\nPlease select a {} ({} {} '{}', page {} of {}):"
+              .format(label, total, matching, prefix, page + 1, pages))
+        for i, value in enumerate(shown):
+            print("{}: {}".format(start + i, describe(value)))
+
+        text = read_input("Enter a number to select, text to filter by, " +
+                          "'>' or '<' to change page,")
+        if text.isdigit():
+            index = get_int(text, total)
+            if index is None:
+                print("Error: Invalid Entry")
+            elif start <= index < start + len(shown):
+                return shown[index - start]
+            elif listed is None:
+                return trie.items(prefix, index, 1)[0]
+            else:
+                return listed[index]
+        elif text == ">":
+            if page + 1 < pages:
+                page += 1
+            else:
+                print("Already on the last page.")
+        elif text == "<":
+            if page > 0:
+                page -= 1
+            else:
+                print("Already on the first page.")
+        elif text and not trie.count(text):
+            found = search(text) if search else []
+            if found:
+                prefix = text
+                matching = "containing"
+                listed = found
+                page = 0
+            else:
+                print("Nothing {} '{}'.".format(
+                    "contains" if search else "starts with", text))
+        else:
+            prefix = text
+            matching = "starting with"
+            listed = None if text else unfiltered
+            page = 0
 
 
-def select_container(containers, label):
+def select_container(parent, label):
     '''Generic function used to allow the user to select a single
-    container out of a list of containers.
+    container out of the children of a container.
 
     Return (Container): The selected item.
 
     Args:
-       containers: list of containers to select from
+       parent: container whose children to select from
        label: label printed to screen used to identify what sub-type
               the selectable containers are.
     '''
-    if not containers:
+    if not parent.children:
         raise NoContainersError("You must add a " + label +
                                 " prior to taking this action.")
 
-    while True:
-        print("Please select a", label, "to add to:")
-        for i, container in enumerate(containers):
-            print("{}: {}".format(i, container.label))
-
-        index = get_int(input("> "), len(containers))
-        if (index is not None):
-            return containers[index]
-        else:
-            print("Error: Invalid Entry")
+    return select_by_prefix(label + " to add to",
+                            library_search.get_label_trie(parent),
+                            lambda container: container.label,
+                            parent.children)
 
 
 def select_room(library):
     '''Display list of Rooms and allow the user to select one.'''
-    return select_container(library.get_rooms(), "Room")
+    return select_container(library, "Room")
 
 
 def select_case(room):
     '''Display list of Cases and allow the user to select one.'''
-    return select_container(room.get_cases(), "Case")
+    return select_container(room, "Case")
 
 
 def select_shelf(case):
     '''Display list of Shelf and allow the user to select one.'''
-    return select_container(case.get_shelves(), "Shelf")
+    return select_container(case, "Shelf")
 
 
 def add_room_from_menu(library):
@@ -171,6 +234,7 @@ def enter_book_details_from_menu():
     '''
     title = read_input("Enter Book Title")
     author = read_input("Enter Book Author")
+    edition = read_input("Enter Book Edition (leave blank if not known)")
 
     while True:
         pages = read_input("Enter Book Pages (positive integer)")
@@ -190,10 +254,43 @@ def enter_book_details_from_menu():
         else:
             print("Width must be a positive integer.")
 
-    book = l.Book(title, author, pages, genre, width)
+    book = l.Book(title, author, pages, genre, width, edition or None)
     return book
 
 
+def get_location_text(book):
+    '''Returns (str) - Room, case and shelf a book is on, on one line.'''
+    return " / ".join(node.label for node in book.get_full_location()[1:-1])
+
+
+def print_copies(library, book):
+    '''Print how many copies of a book the library has and where.'''
+    copies = library.find_copies(book)
+    print('The library has {} cop{} of "{}" by {}{}'.format(
+        len(copies), "y" if len(copies) == 1 else "ies", book.title,
+        book.author, ":" if copies else "."))
+    for copy in copies:
+        lent = " (lent to {})".format(copy.lent_to.name) \
+            if copy.lent_to else ""
+        print("  {}{}{}".format(get_location_text(copy), lent,
+                                " <- this copy" if copy is book else ""))
+
+
+def confirm_new_copy(library, book):
+    '''Warn the user if the library already has copies of a book.
+
+    Return (bool): True if the book should be added.
+    '''
+    if not library.count_copies(book):
+        return True
+    print_copies(library, book)
+    while True:
+        answer = read_input("Add another copy? (y/n)").lower()
+        if answer in ("y", "n"):
+            return answer == "y"
+        print("Please enter y or n.")
+
+
 def print_add_book_results(book, shelf):
     '''Prints where a book was added.'''
     print('"{}" placed {} {}.'.format(book.title,
@@ -206,21 +303,94 @@ def add_book_from_menu(library):
     '''Enter new book details and add it to first available shelf.'''
     if library.has_shelves():
         book = enter_book_details_from_menu()
-        shelf = library.add_book(book)
+        if not confirm_new_copy(library, book):
+            print("Book not added.")
+            return
+        shelf = library.add_book(book, note_copies=False)
         print_add_book_results(book, shelf)
     else:
         raise NoContainersError("You must add at least one shelf " +
                                 "prior to taking this action.")
 
 
+def get_shelf_location_text(shelf):
+    '''Returns (str) - Room, case and shelf label on one line.'''
+    return " / ".join(node.label for node in shelf.get_full_location()[1:])
+
+
+def print_placement_preview(events):
+    '''Print the books an add_book would place, move and push off the
+    last shelf, given the change events it caused.'''
+    displaced = []
+    for event in events:
+        book = event["book"]
+        if event["op"] == "place_book":
+            print('"{}" would be placed on {} at position {}.'.format(
+                book.title, get_shelf_location_text(event["shelf"]),
+                event["position"]))
+        elif event["op"] == "displace_book":
+            displaced.append(book)
+        elif event["op"] == "move_book":
+            displaced = [other for other in displaced if other is not book]
+            print('"{}" would move from {} to {}.'.format(
+                book.title, get_shelf_location_text(event["moved_from"]),
+                get_shelf_location_text(event["shelf"])))
+    for book in displaced:
+        print('"{}" would be pushed off the last shelf.'.format(book.title))
+
+
+def preview_add_book_from_menu(library):
+    '''Enter new book details and show where adding it would place it
+    and which books it would move, then let the user decide to add it.'''
+    if not library.has_shelves():
+        raise NoContainersError("You must add at least one shelf " +
+                                "prior to taking this action.")
+    book = enter_book_details_from_menu()
+    history = library_history.get_history(library)
+    shelf, events = history.preview(
+        lambda: library.add_book(book, note_copies=False))
+    if shelf is None:
+        return
+    print_placement_preview(events)
+    while True:
+        answer = read_input("Add the book? (y/n)").lower()
+        if answer in ("y", "n"):
+            break
+        print("Please enter y or n.")
+    if answer == "y":
+        shelf = library.add_book(book)
+        print_add_book_results(book, shelf)
+
+
+def undo_from_menu(library):
+    '''Undo the last change made from the main menu.'''
+    description = library_history.get_history(library).undo()
+    if description is None:
+        print("Nothing to undo.")
+    else:
+        print("Undid: {}".format(description))
+
+
+def redo_from_menu(library):
+    '''Redo the last change undone.'''
+    description = library_history.get_history(library).redo()
+    if description is None:
+        print("Nothing to redo.")
+    else:
+        print("Redid: {}".format(description))
+
+
 def add_book_to_shelf_from_menu(library):
     '''Enter new book details and add it to a user selected shelf.'''
     if library.has_shelves():
         book = enter_book_details_from_menu()
+        if not confirm_new_copy(library, book):
+            print("Book not added.")
+            return
         room = select_room(library)
         case = select_case(room)
         shelf = select_shelf(case)
-        library.add_book(book, shelf)
+        library.add_book(book, shelf, note_copies=False)
         print_add_book_results(book, shelf)
     else:
         raise NoContainersError("You must add at least one shelf " +
@@ -233,7 +403,7 @@ def add_person_from_menu(library):
     person = library.borrowers.get(name)
     if not person:
         person = l.Person(name)
-        library.borrowers[name] = person
+        library.add_borrower(person)
         print("Person added.")
     else:
         print("Person already exists in the library system.")
@@ -264,15 +434,28 @@ def find_book_by_key(library, key_function):
             print("No Books found that match your search text. " +
                   "Please try again.")
 
+    return select_book_from_list(library, found_books)
+
+
+def select_book_from_list(library, found_books,
+                          describe=lambda book: book.title):
+    '''Let the user pick one of the found books, then run the book
+    action menu on it.
+
+    Args:
+       library: The library the books are in.
+       found_books: The books to pick from.
+       describe: function returning the text listed for each book.
+    '''
     if len(found_books) > 1:
         print("Enter the number of the book you would like more details on.")
         for i, book in enumerate(found_books):
-            print("{}: {}".format(i, book.title))
+            print("{}: {}".format(i, describe(book)))
 
         while True:
             index = get_int(input("> "), len(found_books))
             if index is not None:
-                book = found_books[i]
+                book = found_books[index]
                 break
             else:
                 print("Invalid Input, Please enter a valid number")
@@ -283,6 +466,50 @@ def find_book_by_key(library, key_function):
     return run_book_action_menu(library, book)
 
 
+def fuzzy_find_book_from_menu(library):
+    '''Allow user to search titles and authors, tolerating typos. The
+    closest matches are listed best first.'''
+    while True:
+        text = read_input("Enter title or author to search for")
+        found = library.fuzzy_search(text, 10)
+        if found:
+            break
+        print("No Books found that are close to your search text. " +
+              "Please try again.")
+
+    scores = {id(book): score for book, score in found}
+    return select_book_from_list(
+        library, [book for book, score in found],
+        lambda book: '{} by {} ({:.0%} match)'.format(book.title, book.author,
+                                                      scores[id(book)]))
+
+
+def find_books_by_query_from_menu(library):
+    '''Allow user to search for books with a query such as
+    genre == "Fiction" and pages > 300 and not lent
+    Starting the query with "explain" shows how it would be run instead.
+    '''
+    while True:
+        text = read_input('Enter a query, e.g. genre == "Fiction" and ' +
+                          'pages > 300 and not lent')
+        explain = text.lower().startswith("explain ")
+        if explain:
+            text = text[len("explain "):]
+        try:
+            if explain:
+                print(library.explain_query(text))
+                continue
+            found_books = library.query(text)
+        except library_query.QueryError as e:
+            print("Invalid query: {}".format(e))
+            continue
+        if found_books:
+            break
+        print("No Books match your query. Please try again.")
+
+    return select_book_from_list(library, found_books)
+
+
 def run_book_action_menu(library, book):
     '''Display the book menu of actions and handle all potential actions.
     Args:
@@ -299,19 +526,22 @@ def run_book_action_menu(library, book):
                 print("s: Take Off Shelf")
             else:
                 print("s: Put on Shelf")
+        print("c: Show All Copies")
         print("q: Return to Main Menu")
         action = input("> ").lower()
         if action == "q":
             return SKIP_PAUSE_PROMPT
-        if action in ["s", "v", "l"]:
+        if action in ["s", "v", "l", "c"]:
             if action == "v":
                 print("Book Details:")
                 print(book.get_full_details())
                 print("Book Location:")
                 book.print_human_readable_full_location()
+            if action == "c":
+                print_copies(library, book)
             if action == "s":
                 if not book.lent_to:
-                    book.is_on_shelf = not book.is_on_shelf
+                    book.set_on_shelf(not book.is_on_shelf)
                 else:
                     print("Invalid Input")
             if action == "l":
@@ -344,14 +574,37 @@ def lend_book_from_menu(library, book):
             print("Invalid Selection\n")
 
 
+def find_book_by_prefix(library, field):
+    '''Generic function used to find a book by the start of its title or
+    author, narrowing the listed books as the user types more. Text no
+    title or author starts with finds those containing it instead.
+
+    Args:
+       library: The library to search.
+       field: "title" or "author"
+    '''
+    index = library_search.get_autocomplete_index(library)
+    trie = index.get_trie(field)
+    if not trie.count():
+        print("There are no books in the library.")
+        return
+    book = select_by_prefix("Book", trie,
+                            lambda book: "{} by {}".format(book.title,
+                                                           book.author),
+                            search=lambda text: index.find_containing(
+                                field, text))
+    print("Book Found, select action and press <Enter>:")
+    return run_book_action_menu(library, book)
+
+
 def find_book_by_title_from_menu(library):
-    '''Allow user to input string and search for books by title.'''
-    return find_book_by_key(library, lambda x: x.title)
+    '''Allow user to input the start of a title and select a book.'''
+    return find_book_by_prefix(library, "title")
 
 
 def find_book_by_author_from_menu(library):
-    '''Allow user to input string and search for books by author.'''
-    return find_book_by_key(library, lambda x: x.author)
+    '''Allow user to input the start of an author and select a book.'''
+    return find_book_by_prefix(library, "author")
 
 
 def find_book_by_genre_from_menu(library):
@@ -367,6 +620,127 @@ def find_random_book_from_menu(library):
     return run_book_action_menu(library, book)
 
 
+def get_page_size():
+    '''Returns (int) - Lines that fit on the terminal, or None if output
+                       is not going to a terminal and should not pause.'''
+    if not sys.stdout.isatty():
+        return None
+    return max(1, shutil.get_terminal_size().lines - 2)
+
+
+def describe_library_from_menu(library, include_leaves=True):
+    '''Display the library layout a screen at a time.'''
+    renderer = library_render.Renderer(page_size=get_page_size())
+    renderer.render(library.iter_describe(include_leaves))
+
+
+def export_library_from_menu(library):
+    '''Write the library layout to a text file, optionally leaving out
+    the books or the levels below a given depth.'''
+    file_name = read_input("Enter the file to write to")
+    include_leaves = read_input("Include books? (y/n)").lower() != "n"
+    while True:
+        depth = read_input("Enter how many levels below the library to " +
+                           "include (blank for all)")
+        max_depth = get_int(depth)
+        if not depth or max_depth is not None:
+            break
+        print("Levels must be a whole number.")
+    try:
+        lines = library_render.render_to_file(
+            library.iter_describe(include_leaves, max_depth=max_depth),
+            file_name)
+    except OSError as e:
+        print("Could not write {}: {}".format(file_name, e))
+    else:
+        print("Wrote {} lines to {}.".format(lines, file_name))
+
+
+# Facet browsed by each key of the browse menu.
+BROWSE_FACETS = {"g": "genre", "a": "author", "r": "room", "s": "status"}
+
+
+def forecast_from_menu(library):
+    '''Simulate future acquisitions and show when each room and case is
+    expected to fill up. Widths and genres of future books are drawn like
+    those already in the library.'''
+    if not library.has_shelves():
+        raise NoContainersError("There are no shelves to fill. " +
+                                "Add a shelf first.")
+    while True:
+        rate = get_int(read_input("Enter how many books you get per month " +
+                                  "(positive integer)"), min=1)
+        if rate is not None:
+            break
+        print("Invalid Input, Please enter a valid number")
+    print("Simulating...")
+    forecast = library_forecast.forecast(library, rate)
+    renderer = library_render.Renderer(page_size=get_page_size())
+    renderer.render(forecast.iter_lines(max_depth=2))
+
+
+def browse_from_menu(library):
+    '''Display how many books the library has by genre, author, room and
+    status, and let the user drill down into one value of a facet, e.g.
+    the genres of the books in one room.
+    '''
+    filters = dict()
+    while True:
+        status = library.get_facet_counts("status", **filters)
+        print("\n{}: {} on shelf, {} lent, {} off shelf".format(
+            ", ".join("{} {}".format(facet, value)
+                      for facet, value in filters.items()) or "All books",
+            status.get("on_shelf", 0), status.get("lent", 0),
+            status.get("off_shelf", 0)))
+        for key, facet in BROWSE_FACETS.items():
+            if facet not in filters:
+                print("{}: Count by {}".format(key, facet))
+        if filters:
+            print("c: Clear filters")
+        print("q: Return to Main Menu")
+
+        action = input("> ").lower()
+        if action == "q":
+            return SKIP_PAUSE_PROMPT
+        if action == "c":
+            filters = dict()
+        elif BROWSE_FACETS.get(action) not in (None, *filters):
+            value = browse_facet_from_menu(library, BROWSE_FACETS[action],
+                                           filters)
+            if value is not None:
+                filters[BROWSE_FACETS[action]] = value
+        else:
+            print("Invalid input")
+
+
+def browse_facet_from_menu(library, facet, filters):
+    '''List the counts of the most common values of a facet and let the
+    user pick one to drill down into.
+
+    Return (str): The selected value, or None to go back.
+    '''
+    counts = library.get_facet_counts(facet, **filters)
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))
+    shown = ranked[:PAGE_SIZE * 2]
+    for i, (value, count) in enumerate(shown):
+        print("{}: {} ({})".format(i, value, count))
+    if len(ranked) > len(shown):
+        print("... and {} more".format(len(ranked) - len(shown)))
+    if not shown:
+        print("No books.")
+        return None
+
+    while True:
+        text = input("Enter a number to count only those books, " +
+                     "or press Enter to go back\n> ")
+        if not text:
+            return None
+        index = get_int(text, len(shown))
+        if index is not None:
+            return shown[index][0]
+        print("Invalid Input, Please enter a valid number")
+
+
 # Main menu configuration.
 # key: the key combination the user should input to run the action.
 # description: the description displayed to the user to explain the command
@@ -374,11 +748,20 @@ def find_random_book_from_menu(library):
 MAIN_MENU_ACTIONS = [{"key": "l",
                       "description":
                       "Display Entire Library (including books)",
-                      "func": lambda x: x.describe()},
+                      "func": lambda x: describe_library_from_menu(x)},
                      {"key": "d",
                       "description":
                       "Display Library Layout (without books)",
-                      "func": lambda x: x.describe(False)},
+                      "func": lambda x: describe_library_from_menu(x, False)},
+                     {"key": "x",
+                      "description": "Export Library Layout to a File",
+                      "func": export_library_from_menu},
+                     {"key": "b",
+                      "description": "Browse Book Counts",
+                      "func": browse_from_menu},
+                     {"key": "fc",
+                      "description": "Forecast When Shelves Fill Up",
+                      "func": forecast_from_menu},
                      {"key": "fbt",
                       "description": "Find Book by Title",
                       "func": find_book_by_title_from_menu},
@@ -388,6 +771,13 @@ MAIN_MENU_ACTIONS = [{"key": "l",
                      {"key": "fbg",
                       "description": "Find Book by Genre",
                       "func": find_book_by_genre_from_menu},
+                     {"key": "fz",
+                      "description": "Find Book by Title or Author " +
+                                     "(tolerates typos)",
+                      "func": fuzzy_find_book_from_menu},
+                     {"key": "fq",
+                      "description": "Find Books by Query",
+                      "func": find_books_by_query_from_menu},
                      {"key": "r",
                       "description": "Find Random Book",
                       "func": find_random_book_from_menu},
@@ -408,7 +798,18 @@ MAIN_MENU_ACTIONS = [{"key": "l",
                       "func": add_book_to_shelf_from_menu},
                      {"key": "ap",
                       "description": "Add Person",
-                      "func": add_person_from_menu}]
+                      "func": add_person_from_menu},
+                     {"key": "pb",
+                      "description": "Preview Adding a Book",
+                      "func": preview_add_book_from_menu},
+                     {"key": "u",
+                      "description": "Undo Last Change",
+                      "func": undo_from_menu,
+                      "record": False},
+                     {"key": "re",
+                      "description": "Redo Last Undone Change",
+                      "func": redo_from_menu,
+                      "record": False}]
 
 
 def run_menu(library, file_name):
@@ -422,8 +823,10 @@ def run_menu(library, file_name):
     print(" q!: Quit and don't save")
 
     action = input("> ").lower()
+    history = library_history.get_history(library)
     for possible_action in MAIN_MENU_ACTIONS:
         if possible_action["key"] == action:
+            before = history.begin()
             try:
                 result = possible_action["func"](library)
                 if result != SKIP_PAUSE_PROMPT:
@@ -435,10 +838,15 @@ def run_menu(library, file_name):
                 print(e)
                 input("\nPress Enter to Continue...")
                 pass
+            finally:
+                # Anything the action changed, even if it was canceled
+                # part way, can be undone in one step.
+                if possible_action.get("record", True):
+                    history.commit(possible_action["description"], before)
             break
     else:
         if action == "q":
-            library.save_to_file(file_name)
+            save_library(library, file_name)
             return True
         elif action == "q!":
             return True
@@ -448,22 +856,174 @@ def run_menu(library, file_name):
     return False
 
 
-def start_library_system(file_name):
-    '''Load the library from disk and start menu of actions.'''
+def is_directory_layout(file_name):
+    '''Return True if file_name names a library saved as a directory with
+    one file per room rather than as a single json file.'''
+    return os.path.isdir(file_name) or file_name.endswith(os.sep)
+
+
+def load_library(file_name, lazy=False):
+    '''Load a library saved as a json file or as a directory.
+
+    Return (Library) - The loaded library or None if there is none yet.
+    '''
+    if is_directory_layout(file_name):
+        return l.Library.load_from_directory(file_name, lazy)
+    return l.Library.load_from_file(file_name, lazy=lazy)
+
+
+def save_library(library, file_name):
+    '''Save a library in the layout load_library expects for file_name.'''
+    if is_directory_layout(file_name):
+        library.save_to_directory(file_name)
+    else:
+        library.save_to_file(file_name)
+
+
+def print_library_diff(file_name, other_file_name):
+    '''Print every book that was added, removed, moved, lent, returned
+    or shelved between two saved libraries.'''
+    changes = list(l.diff(load_library(file_name, True),
+                          load_library(other_file_name, True)))
+    for change in changes:
+        print(change)
+    print("{} change(s) found.".format(len(changes)))
+
+
+def export_packed_library(file_name, packed_file_name):
+    '''Write a saved library to a packed catalog for library_catalog and
+    other readers that do not need Book objects.'''
+    library = load_library(file_name)
+    if library is None:
+        print("No library in {}.".format(file_name))
+        return
+    library_packed.export_packed(library, packed_file_name)
+    print("Wrote {} books to {}.".format(len(library.get_all_books()),
+                                         packed_file_name))
+
+
+def import_books_from_file(file_name, books_file_name):
+    '''Add the books in a CSV or JSON lines file to a saved library and
+    save it.'''
+    library = load_library(file_name)
+    if library is None:
+        print("No library in {}.".format(file_name))
+        return
+    result = library_transfer.import_books(library, books_file_name)
+    for line_number, error in result["errors"]:
+        print("Line {}: {}".format(line_number, error))
+    if result["full"] is not None:
+        print("The library is full, stopped at line {}.".format(
+            result["full"]))
+    print("Read {read} records, added {added} books, rejected "
+          "{rejected}.".format(**result))
+    if result["copies"]:
+        print("{} of the books added were further copies of books in the "
+              "library.".format(result["copies"]))
+    if result["added"]:
+        save_library(library, file_name)
+
+
+def export_books_to_file(file_name, books_file_name):
+    '''Write every book in a saved library, with where it is, to a CSV or
+    JSON lines file.'''
+    library = load_library(file_name, True)
+    if library is None:
+        print("No library in {}.".format(file_name))
+        return
+    written = library_transfer.export_books(library, books_file_name)
+    print("Wrote {} books to {}.".format(written, books_file_name))
+
+
+def start_library_system(file_name, lazy=False, feed_log=None,
+                         feed_port=None):
+    '''Load the library from disk and start menu of actions.
+
+    Args:
+       file_name: The library json file.
+       lazy: If True only load each room when it is first used.
+       feed_log: If given append every change to this log file for
+                 replicas, with a checkpoint next to it.
+       feed_port: If given serve every change to replicas on this port.
+    '''
     print("Loading library in file {}.".format(file_name))
-    library = l.Library.load_from_file(file_name)
+    library = load_library(file_name, lazy)
     if not library:
         library_label = input("Enter New Library Name: ")
         library = l.Library(library_label)
+    # The library lives until the program exits, so it is never unfrozen;
+    # keep the collector from walking it again and again.
+    l.freeze_objects()
+
+    change_log = None
+    if feed_log:
+        change_log = library_replication.ChangeLog(library, feed_log)
+        change_log.write_checkpoint(feed_log + ".checkpoint")
+    feed_server = None
+    if feed_port is not None:
+        feed_server = library_replication.FeedServer(library, port=feed_port)
+        print("Serving changes on {}:{}.".format(*feed_server.address))
 
     print("Your Current Library Layout:")
-    library.describe(False)
+    if library.is_fully_loaded():
+        library.describe(False)
+    else:
+        library.describe_summary()
     print()
 
     while True:
         if run_menu(library, file_name):
             break
 
+    if change_log:
+        change_log.write_checkpoint(feed_log + ".checkpoint")
+        change_log.close()
+    if feed_server:
+        feed_server.close()
+
+
+def run_unit_tests():
+    '''Run unit tests of selecting a book by the start of its title, with
+    the answers to the prompts given up front.'''
+    import builtins
+    import contextlib
+    import io
+    print("Running Menu Unit Tests")
+    library = l.make_test_library()
+    index = library_search.get_autocomplete_index(library)
+
+    def select(answers, search=None):
+        replies = iter(answers)
+        saved_input = builtins.input
+        builtins.input = lambda prompt="": next(replies)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                book = select_by_prefix("Book", index.get_trie("title"),
+                                        lambda book: book.title,
+                                        search=search)
+        finally:
+            builtins.input = saved_input
+        return book.title, output.getvalue()
+
+    def search(text):
+        return index.find_containing("title", text)
+
+    title, output = select(["Title 4", "0"], search)
+    assert(title == "Title 4")
+    assert("11 starting with 'Title 4'" in output)
+    # Nothing starts with the text, so titles containing it are listed.
+    title, output = select(["itle 12", "0"], search)
+    assert(title == "Title 12")
+    assert("1 containing 'itle 12'" in output)
+    title, output = select(["e 1", ">", "10"], search)
+    assert(title == "Title 19")
+    assert("11 containing 'e 1', page 2 of 2" in output)
+    title, output = select(["zzz", "itle 3", "Title 3", "0"], search)
+    assert(title == "Title 3")
+    assert("Nothing contains 'zzz'." in output)
+    title, output = select(["itle 3", "Title 3", "0"])
+    assert("Nothing starts with 'itle 3'." in output)
+
 
 def parse_command_line():
     '''Parse command line arguments.
@@ -474,9 +1034,44 @@ def parse_command_line():
     parser.add_argument('--test', dest='test', action='store_const',
                         const=True, default=False,
                         help='Run Unit Tests')
+    parser.add_argument('--stats', dest='stats', action='store_const',
+                        const=True, default=False,
+                        help='Record operation counters and latencies and '
+                             'print them on exit')
+    parser.add_argument('--stats-format', dest='stats_format',
+                        choices=['text', 'json'], default='text',
+                        help='Format used by --stats (default: text)')
+    parser.add_argument('--diff', dest='diff', metavar='OTHER_FILE',
+                        default=None,
+                        help='Print the books that differ between the '
+                             'library and OTHER_FILE, then exit')
+    parser.add_argument('--export-packed', dest='export_packed',
+                        metavar='PACKED_FILE', default=None,
+                        help='Write the library to a compact read-only '
+                             'catalog file, then exit')
+    parser.add_argument('--import-books', dest='import_books',
+                        metavar='BOOKS_FILE', default=None,
+                        help='Add the books in a .csv or .jsonl file to the '
+                             'library, save it and exit')
+    parser.add_argument('--export-books', dest='export_books',
+                        metavar='BOOKS_FILE', default=None,
+                        help='Write every book and its location to a .csv '
+                             'or .jsonl file, then exit')
+    parser.add_argument('--feed-log', dest='feed_log', default=None,
+                        help='Append every change to this log file so '
+                             'replicas can follow it')
+    parser.add_argument('--feed-port', dest='feed_port', type=int,
+                        default=None,
+                        help='Serve every change to replicas on this '
+                             'local port')
+    parser.add_argument('--lazy', dest='lazy', action='store_const',
+                        const=True, default=False,
+                        help='Load rooms on first use instead of at startup')
     parser.add_argument('file_name', nargs='?',
                         default=DEFAULT_LIBRARY_FILE_NAME,
-                        help='Library JSON File Name')
+                        help='Library JSON File Name, or a directory '
+                             '(ending in {}) to keep one file per '
+                             'room'.format(os.sep))
 
     return parser.parse_args()
 
@@ -484,5 +1079,33 @@ if __name__ == '__main__':
     args = parse_command_line()
     if args.test:
         l.run_unit_tests()
+        library_history.run_unit_tests()
+        library_query.run_unit_tests()
+        library_transfer.run_unit_tests()
+        library_packed.run_unit_tests()
+        library_replication.run_unit_tests()
+        library_forecast.run_unit_tests()
+        library_catalog.run_unit_tests()
+        library_search.run_unit_tests()
+        library_stats.run_unit_tests()
+        library_render.run_unit_tests()
+        run_unit_tests()
+    elif args.diff:
+        print_library_diff(args.file_name, args.diff)
+    elif args.export_packed:
+        export_packed_library(args.file_name, args.export_packed)
+    elif args.import_books:
+        import_books_from_file(args.file_name, args.import_books)
+    elif args.export_books:
+        export_books_to_file(args.file_name, args.export_books)
     else:
-        start_library_system(args.file_name)
+        if args.stats:
+            STATS.enable()
+        try:
+            start_library_system(args.file_name, args.lazy, args.feed_log,
+                                 args.feed_port)
+        finally:
+            if args.stats and args.stats_format == "json":
+                print(STATS.report_json())
+            elif args.stats:
+                print(STATS.report_text())